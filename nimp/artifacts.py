@@ -21,9 +21,12 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 ''' Provides functions for build artifacts '''
+import collections
+import concurrent.futures
 import copy
 import hashlib
 import glob
+import io
 import json
 import logging
 import os
@@ -31,8 +34,13 @@ import platform
 import re
 import shutil
 import stat
+import struct
+import tempfile
+import threading
 import time
+import uuid
 import zipfile
+import zlib
 
 import requests
 
@@ -45,17 +53,28 @@ if platform.system() != 'Windows':
         import magic
     except ImportError:
         magic = None
+else:
+    magic = None
 
 try:
-    import BitTornado.Meta.Info
-    import BitTornado.Meta.BTTree
     import BitTornado.Meta.bencode
 except ImportError as exception:
     BitTornado = None
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+_CATALOG_FILE_NAME = '.catalog.jsonl'
+
 
-def list_artifacts(artifact_pattern, format_arguments, api_context):
-    ''' List all artifacts and their revision using the provided pattern after formatting '''
+def list_artifacts(artifact_pattern, format_arguments, api_context, use_catalog = True):
+    ''' List all artifacts and their revision using the provided pattern after
+        formatting. The catalog of the collection is used instead of listing
+        the collection directory when it is known to be complete, and
+        otherwise only provides the timestamps of registered revisions. '''
 
     format_arguments = copy.deepcopy(format_arguments)
     format_arguments['revision'] = '{revision}'
@@ -63,34 +82,145 @@ def list_artifacts(artifact_pattern, format_arguments, api_context):
     artifact_pattern = artifact_pattern.format(**format_arguments)
     artifact_source = nimp.system.sanitize_path(os.path.dirname(artifact_pattern))
     artifact_escaped_name = re.escape(os.path.basename(artifact_pattern)).replace(r'\{revision\}', '{revision}')
-    artifact_regex = re.compile(r'^' + artifact_escaped_name.format(revision = r'(?P<revision>[a-zA-Z0-9]+)') + r'(.zip)?$')
+    artifact_regex = re.compile(r'^' + artifact_escaped_name.format(revision = r'(?P<revision>[a-zA-Z0-9]+)') + r'(.zip|\.manifest)?$')
 
-    all_files = _list_files(artifact_source, False)
+    all_catalog_entries, last_catalog_entry = _load_catalog(artifact_source) if use_catalog else ([], None)
+    all_catalog_entries = [ entry for entry in all_catalog_entries if artifact_regex.match(entry['name']) ]
+    if all_catalog_entries and _is_catalog_complete(artifact_source, last_catalog_entry, artifact_regex):
+        all_matches = [ (artifact_source + '/' + entry['name'], entry['revision'], True) for entry in all_catalog_entries ]
+    else:
+        if all_catalog_entries:
+            logging.debug('Catalog of %s may be incomplete, listing the collection', artifact_source)
+        all_files = _list_files(artifact_source, False)
+        all_matches = []
+        for file_uri in all_files:
+            file_name = os.path.basename(file_uri.rstrip('/'))
+            artifact_match = artifact_regex.match(file_name)
+            if artifact_match:
+                all_matches.append((file_uri, artifact_match.group('revision'), False))
+
+    if api_context:
+        all_catalog_timestamps = { entry['revision']: entry['timestamp'] for entry in all_catalog_entries if entry.get('timestamp') }
+        all_timestamps = nimp.utils.git.get_gitea_commit_timestamps(api_context, [ revision for _, revision, _ in all_matches
+                                                                                   if revision not in all_catalog_timestamps ])
+        all_timestamps.update(all_catalog_timestamps)
     all_artifacts = []
-    for file_uri in all_files:
-        file_name = os.path.basename(file_uri.rstrip('/'))
-        artifact_match = artifact_regex.match(file_name)
-        if artifact_match:
-            group_revision = artifact_match.group('revision')
-            sortable_revision = copy.deepcopy(group_revision)
-            if api_context:
-                sortable_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, group_revision)
-            if sortable_revision is not None:
-                artifact = {
-                    'revision': group_revision,
-                    'sortable_revision': sortable_revision,
-                    'uri': file_uri,
-                }
-                all_artifacts.append(artifact)
+    for file_uri, group_revision, is_cataloged in all_matches:
+        sortable_revision = copy.deepcopy(group_revision)
+        if api_context:
+            sortable_revision = all_timestamps[group_revision]
+        if sortable_revision is not None:
+            artifact = {
+                'revision': group_revision,
+                'sortable_revision': sortable_revision,
+                'uri': file_uri,
+            }
+            if is_cataloged:
+                artifact['is_cataloged'] = True
+            all_artifacts.append(artifact)
     return all_artifacts
 
 
+def _load_catalog(collection_uri):
+    ''' Returns the entries of the catalog of a collection, and its last
+        entry, or None if some lines could not be read '''
+    catalog_uri = collection_uri + '/' + _CATALOG_FILE_NAME
+    if _is_http_uri(catalog_uri):
+        catalog_request = _get_http_session().get(catalog_uri, timeout = _HTTP_TIMEOUT)
+        if catalog_request.status_code == 404:
+            return [], None
+        catalog_request.raise_for_status()
+        catalog_content = catalog_request.text
+    elif os.path.isfile(catalog_uri):
+        with open(catalog_uri, 'r', encoding = 'utf-8') as catalog_file:
+            catalog_content = catalog_file.read()
+    else:
+        return [], None
+
+    # Artifacts uploaded again with --force appear several times, keep the last one
+    all_entries = {}
+    last_entry = None
+    is_intact = True
+    for line_index, line in enumerate(catalog_content.splitlines()):
+        try:
+            entry = json.loads(line)
+            all_entries[entry['name']] = entry
+            last_entry = entry
+        except (ValueError, TypeError, KeyError):
+            # Lines appended concurrently may be incomplete, the entries they
+            # held are only found by listing the collection
+            logging.warning('Ignoring malformed line %d of %s', line_index + 1, catalog_uri)
+            is_intact = False
+    return list(all_entries.values()), last_entry if is_intact else None
+
+
+def _is_catalog_complete(collection_uri, last_entry, artifact_regex):
+    # Every matching artifact is registered if the collection did not change
+    # since it was last listed while registering an artifact, and if that
+    # listing found no other matching artifact
+    if last_entry is None or last_entry.get('collection_mtime') is None or _is_http_uri(collection_uri):
+        return False
+    try:
+        collection_mtime = os.stat(collection_uri).st_mtime_ns
+    except OSError:
+        return False
+    if collection_mtime != last_entry['collection_mtime']:
+        return False
+    return not any(artifact_regex.match(name) for name in last_entry.get('unregistered', []))
+
+
+def register_artifact(artifact_path, revision, timestamp = None, file_hash = None):
+    ''' Adds an artifact to the catalog of its collection '''
+    artifact_full_path = _find_artifact(artifact_path)
+    if not artifact_full_path:
+        raise FileNotFoundError(f'Artifact not found: {artifact_path}')
+
+    entry = {
+        'name': os.path.basename(artifact_full_path),
+        'revision': revision,
+        'timestamp': timestamp,
+        'size': os.path.getsize(artifact_full_path) if os.path.isfile(artifact_full_path) else None,
+        'hash': file_hash,
+    }
+    collection_path = os.path.dirname(artifact_path)
+    catalog_path = os.path.join(collection_path, _CATALOG_FILE_NAME)
+    logging.debug('Adding %s to %s', entry['name'], catalog_path)
+    # A single append per artifact, so concurrent uploads don't overwrite each other
+    with open(catalog_path, 'a', encoding = 'utf-8') as catalog_file:
+        # The catalog was created first, so that it doesn't modify the collection afterwards
+        entry.update(_get_collection_state(collection_path, entry['name']))
+        catalog_file.write(json.dumps(entry) + '\n')
+
+
+def _get_collection_state(collection_path, artifact_name):
+    # Artifacts which are not registered are recorded, so that listing their
+    # collection can tell whether the catalog is enough
+    collection_mtime = os.stat(collection_path).st_mtime_ns
+    all_file_names = os.listdir(collection_path)
+    if os.stat(collection_path).st_mtime_ns != collection_mtime:
+        return { 'collection_mtime': None }
+    all_registered_names = { entry['name'] for entry in _load_catalog(collection_path)[0] }
+    all_registered_names.update([ artifact_name, _CATALOG_FILE_NAME ])
+    return {
+        'collection_mtime': collection_mtime,
+        'unregistered': sorted(name for name in all_file_names if name not in all_registered_names),
+    }
+
+
+def artifact_exists(artifact_uri):
+    ''' Checks an artifact is still available in the repository '''
+    if _is_http_uri(artifact_uri):
+        head_request = _get_http_session().head(artifact_uri, allow_redirects = True, timeout = _HTTP_TIMEOUT)
+        return head_request.status_code < 400
+    return os.path.exists(artifact_uri)
+
+
 def _list_files(source, recursive):
     all_files = []
     source = source.rstrip('/')
 
-    if source.startswith('http://') or source.startswith('https://'):
-        source_request = requests.get(source)
+    if _is_http_uri(source):
+        source_request = _get_http_session().get(source, timeout = _HTTP_TIMEOUT)
         source_request.raise_for_status()
         file_regex = re.compile(r'<a href="(?P<file_name>[^"/\\\?]+/?)">')
 
@@ -118,13 +248,19 @@ def _list_files(source, recursive):
     return all_files
 
 
-def download_artifact(workspace_directory, artifact_uri):
-    ''' Download an artifact to the workspace '''
+def download_artifact(workspace_directory, artifact_uri, manifest = None, installed_manifest = None, workers = None):
+    ''' Download an artifact to the workspace. For stored artifacts, the
+        manifest can be given if it was already loaded, and only files that
+        differ from the installed manifest are downloaded. '''
+
+    workers = nimp.system.get_worker_count(workers)
 
     download_directory = os.path.join(workspace_directory, '.nimp', 'downloads')
     artifact_name = os.path.basename(artifact_uri.rstrip('/'))
     if artifact_name.endswith('.zip'):
         artifact_name = artifact_name[:-4]
+    elif artifact_name.endswith('.manifest'):
+        artifact_name = artifact_name[:-9]
     # Use a hash instead of the artifact name to reduce path length
     artifact_hash = hashlib.md5(artifact_name.encode('utf-8')).hexdigest()
     local_artifact_path = os.path.join(download_directory, artifact_hash[:10])
@@ -135,33 +271,284 @@ def download_artifact(workspace_directory, artifact_uri):
         shutil.rmtree(local_artifact_path)
 
     if artifact_uri.endswith('.zip'):
-        _download_file(artifact_uri, local_artifact_path + '.zip')
+        _download_file(artifact_uri, local_artifact_path + '.zip', workers)
         _extract_archive(local_artifact_path + '.zip', local_artifact_path)
         os.remove(local_artifact_path + '.zip')
+    elif artifact_uri.endswith('.manifest'):
+        if manifest is None:
+            manifest = load_manifest(artifact_uri)
+        _download_stored_artifact(artifact_uri, manifest, installed_manifest, local_artifact_path, workers)
     else:
         artifact_uri = artifact_uri.rstrip('/') + '/'
         all_files = [ uri for uri in _list_files(artifact_uri, True) if not uri.endswith('/') ]
-        for file_uri in all_files:
-            file_path = file_uri[ len(artifact_uri) : ]
-            _download_file(file_uri, os.path.join(local_artifact_path, file_path))
+        all_downloads = [ (file_uri, os.path.join(local_artifact_path, file_uri[ len(artifact_uri) : ])) for file_uri in all_files ]
+        statistics = _TransferStatistics()
+        _download_files(all_downloads, workers, statistics)
+        statistics.log('Downloaded', artifact_uri)
 
     return local_artifact_path
 
 
-def _download_file(file_uri, output_path):
+_HTTP_ATTEMPT_MAXIMUM = 5
+_HTTP_POOL_SIZE = 32
+# Files bigger than two segments are downloaded with parallel range requests
+_HTTP_SEGMENT_SIZE = 64 * 1024 * 1024
+_HTTP_TIMEOUT = (10, 60)
+_http_session = None # pylint: disable = invalid-name
+_http_session_lock = threading.Lock() # pylint: disable = invalid-name
+
+
+def _is_http_uri(uri):
+    return uri.startswith('http://') or uri.startswith('https://')
+
+
+def _get_http_session():
+    # A single session keeps connections alive between requests, so files
+    # don't each pay for a new TCP and TLS handshake
+    global _http_session # pylint: disable = invalid-name, global-statement
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections = _HTTP_POOL_SIZE, pool_maxsize = _HTTP_POOL_SIZE)
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+        return _http_session
+
+
+def _download_files(all_downloads, workers, statistics):
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        all_futures = [ executor.submit(_download_file, file_uri, output_path) for file_uri, output_path in all_downloads ]
+        for future in all_futures:
+            statistics.add(future.result())
+
+
+def _download_file(file_uri, output_path, workers = 1):
     if os.path.exists(output_path):
         os.remove(output_path)
-    output_directory = os.path.dirname(output_path)
-    if not os.path.isdir(output_directory):
-        os.makedirs(output_directory)
+    os.makedirs(os.path.dirname(output_path), exist_ok = True)
 
-    if file_uri.startswith('http://') or file_uri.startswith('https://'):
-        file_request = requests.get(file_uri, stream = True)
-        file_request.raise_for_status()
-        with open(output_path, 'wb') as output_file:
-            shutil.copyfileobj(file_request.raw, output_file)
+    if _is_http_uri(file_uri):
+        _download_http_file(file_uri, output_path, workers)
     else:
         shutil.copyfile(file_uri, output_path)
+    return os.path.getsize(output_path)
+
+
+def _download_http_file(file_uri, output_path, workers):
+    file_size = 0
+    if workers > 1:
+        head_request = _get_http_session().head(file_uri, allow_redirects = True, timeout = _HTTP_TIMEOUT)
+        head_request.raise_for_status()
+        if head_request.headers.get('Accept-Ranges') == 'bytes':
+            file_size = int(head_request.headers.get('Content-Length', 0))
+
+    with open(output_path, 'wb') as output_file:
+        output_file.truncate(file_size)
+
+    if file_size < 2 * _HTTP_SEGMENT_SIZE:
+        _download_http_range(file_uri, output_path, 0, None)
+        return
+
+    all_segments = [ (start, min(start + _HTTP_SEGMENT_SIZE, file_size) - 1) for start in range(0, file_size, _HTTP_SEGMENT_SIZE) ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        all_futures = [ executor.submit(_download_http_range, file_uri, output_path, start, end) for start, end in all_segments ]
+        for future in all_futures:
+            future.result()
+
+
+def _download_http_range(file_uri, output_path, start, end):
+    ''' Downloads bytes start to end (inclusive, or up to the end of the file
+        if None) into an existing file, resuming where the transfer stopped
+        when retrying after an error '''
+    offset = start
+    attempt = 1
+    while True:
+        headers = {}
+        if offset > 0 or end is not None:
+            headers['Range'] = 'bytes=%d-%s' % (offset, end if end is not None else '')
+        try:
+            with _get_http_session().get(file_uri, headers = headers, stream = True, timeout = _HTTP_TIMEOUT) as file_request:
+                file_request.raise_for_status()
+                if headers and file_request.status_code != 206:
+                    if end is not None:
+                        raise OSError('Server ignored range request for %s' % file_uri)
+                    # Server does not support resuming, the whole file is sent again
+                    offset = 0
+                with open(output_path, 'r+b') as output_file:
+                    output_file.seek(offset)
+                    for buffer in file_request.iter_content(_COPY_BUFFER_SIZE):
+                        output_file.write(buffer)
+                        offset += len(buffer)
+                    if end is None:
+                        output_file.truncate()
+            return
+        except requests.RequestException as exception:
+            is_client_error = exception.response is not None and exception.response.status_code < 500
+            if is_client_error or attempt >= _HTTP_ATTEMPT_MAXIMUM:
+                raise
+            retry_delay = 2 ** (attempt - 1)
+            logging.warning('%s, resuming at byte %d in %ds (Attempt %s of %s)',
+                            exception, offset, retry_delay, attempt, _HTTP_ATTEMPT_MAXIMUM)
+            time.sleep(retry_delay)
+            attempt += 1
+
+
+def _read_text(file_uri):
+    if _is_http_uri(file_uri):
+        file_request = _get_http_session().get(file_uri, timeout = _HTTP_TIMEOUT)
+        file_request.raise_for_status()
+        return file_request.text
+    with open(file_uri, 'r', encoding = 'utf-8') as input_file:
+        return input_file.read()
+
+
+def load_manifest(manifest_uri):
+    ''' Loads the manifest of a stored artifact '''
+    return json.loads(_read_text(manifest_uri))
+
+
+def get_executable_paths(manifest):
+    ''' Returns the paths of executable files in a manifest, or None if the
+        manifest was created before they were recorded '''
+    if not manifest.get('has_executable_flags'):
+        return None
+    return { entry['path'] for entry in manifest['files'] if entry.get('executable') }
+
+
+def diff_manifests(previous_manifest, manifest):
+    ''' Returns the entries of manifest which are new or modified since
+        previous_manifest, and the paths which were removed '''
+    all_changed_entries, all_removed_paths = _diff_manifest_entries(previous_manifest, manifest, [ 'hash', 'size' ])
+    return [ entry for entry, _ in all_changed_entries ], all_removed_paths
+
+
+def _diff_manifest_entries(previous_manifest, manifest, all_compared_keys):
+    ''' Returns the entries of manifest which are new or modified since
+        previous_manifest, each with its previous entry or None if it is new,
+        and the paths which were removed '''
+    all_previous_entries = { entry['path']: entry for entry in previous_manifest['files'] }
+    all_changed_entries = []
+    for entry in manifest['files']:
+        previous_entry = all_previous_entries.pop(entry['path'], None)
+        if previous_entry is None or any(previous_entry[key] != entry[key] for key in all_compared_keys):
+            all_changed_entries.append((entry, previous_entry))
+    return all_changed_entries, list(all_previous_entries)
+
+
+_FILESET_MANIFEST_VERSION = 1
+
+
+def create_fileset_manifest(file_collection, hash_method = None, previous_manifest = None, workers = None):
+    ''' Lists the size and modification time of files, and their hash if a
+        hash method is given. Hashes of a previous manifest are reused for
+        files whose size and modification time didn't change. '''
+    all_previous_entries = {}
+    if hash_method is not None and previous_manifest is not None and previous_manifest['hash_method'] == hash_method:
+        all_previous_entries = { entry['path']: entry for entry in previous_manifest['files'] }
+
+    def _get_entry(file):
+        source, destination = file
+        file_stat = os.stat(source)
+        if stat.S_ISDIR(file_stat.st_mode):
+            return None
+        entry = { 'path': destination, 'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns }
+        if hash_method is not None:
+            previous_entry = all_previous_entries.get(destination)
+            if previous_entry is not None and previous_entry['size'] == entry['size'] and previous_entry['mtime_ns'] == entry['mtime_ns']:
+                entry['hash'] = previous_entry['hash']
+            else:
+                entry['hash'] = get_file_hash(source, hash_method)
+        return entry
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = nimp.system.get_worker_count(workers)) as executor:
+        all_entries = { entry['path']: entry for entry in executor.map(_get_entry, file_collection) if entry is not None }
+    return { 'hash_method': hash_method, 'files': [ all_entries[path] for path in sorted(all_entries) ] }
+
+
+def save_fileset_manifest(manifest_path, manifest):
+    ''' Saves a fileset manifest as JSON lines, a header followed by one
+        line per file, so that large filesets don't need a single document '''
+    with TempArtifact(manifest_path, 'w', force = True, encoding = 'utf-8') as manifest_file:
+        manifest_file.write(json.dumps({ 'version': _FILESET_MANIFEST_VERSION, 'hash_method': manifest['hash_method'] }) + '\n')
+        for entry in manifest['files']:
+            manifest_file.write(json.dumps(entry, separators = (',', ':')) + '\n')
+
+
+def load_fileset_manifest(manifest_uri):
+    ''' Loads a fileset manifest saved by save_fileset_manifest '''
+    all_lines = _read_text(manifest_uri).splitlines()
+    header = json.loads(all_lines[0]) if all_lines else {}
+    if header.get('version') != _FILESET_MANIFEST_VERSION:
+        raise ValueError(f'Unsupported fileset manifest: {manifest_uri}')
+    return { 'hash_method': header['hash_method'], 'files': [ json.loads(line) for line in all_lines[1:] if line ] }
+
+
+def diff_fileset_manifests(previous_manifest, manifest):
+    ''' Returns the paths which were added, modified and removed since
+        previous_manifest. Files are compared by hash when both manifests
+        have the same hash method, by size and modification time otherwise. '''
+    compare_hashes = previous_manifest['hash_method'] is not None and previous_manifest['hash_method'] == manifest['hash_method']
+    compared_key = 'hash' if compare_hashes else 'mtime_ns'
+    all_changed_entries, all_removed_paths = _diff_manifest_entries(previous_manifest, manifest, [ 'size', compared_key ])
+    all_added_paths = [ entry['path'] for entry, previous_entry in all_changed_entries if previous_entry is None ]
+    all_modified_paths = [ entry['path'] for entry, previous_entry in all_changed_entries if previous_entry is not None ]
+    return all_added_paths, all_modified_paths, all_removed_paths
+
+
+def _download_stored_artifact(manifest_uri, manifest, installed_manifest, output_path, workers):
+    blob_store_uri = manifest['blob_store']
+    # Blob stores on another drive or share than the manifest have an absolute path
+    if not _is_http_uri(blob_store_uri) and not os.path.isabs(blob_store_uri) and not re.match(r'^[a-zA-Z]:/', blob_store_uri):
+        blob_store_uri = os.path.dirname(manifest_uri) + '/' + blob_store_uri
+
+    all_entries = manifest['files']
+    if installed_manifest is not None:
+        all_entries, _ = diff_manifests(installed_manifest, manifest)
+        logging.info('%d of %d files changed since the installed revision', len(all_entries), len(manifest['files']))
+    # The artifact is installed even when no file changed
+    os.makedirs(output_path, exist_ok = True)
+
+    # Each blob is downloaded once, straight to the first file with its hash,
+    # and copied from there to the other files with the same content
+    all_first_destinations = {}
+    all_copies = []
+    for entry in all_entries:
+        destination = os.path.join(output_path, entry['path'])
+        first_destination = all_first_destinations.setdefault(entry['hash'], destination)
+        if first_destination != destination:
+            all_copies.append((first_destination, destination))
+
+    def _download_blob(blob_hash, destination):
+        blob_uri = _get_blob_path(blob_store_uri, blob_hash)
+        logging.debug('Downloading blob %s to %s', blob_uri, destination)
+        # Download next to the destination first so interrupted transfers
+        # are not mistaken for a complete file
+        file_size = _download_file(blob_uri, destination + '.tmp')
+        os.replace(destination + '.tmp', destination)
+        return file_size
+
+    statistics = _TransferStatistics()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        all_futures = [ executor.submit(_download_blob, blob_hash, destination) for blob_hash, destination in all_first_destinations.items() ]
+        for future in all_futures:
+            statistics.add(future.result())
+
+    for source, destination in all_copies:
+        os.makedirs(os.path.dirname(destination), exist_ok = True)
+        shutil.copyfile(source, destination)
+    statistics.log('Downloaded missing blobs for', manifest_uri)
+
+
+def _get_relative_blob_store(blob_store, manifest_path):
+    try:
+        return os.path.relpath(blob_store, os.path.dirname(manifest_path)).replace('\\', '/')
+    except ValueError:
+        # On Windows, paths on another drive or share can't be made relative
+        return os.path.abspath(blob_store).replace('\\', '/')
+
+
+def _get_blob_path(blob_store, blob_hash):
+    return blob_store + '/' + blob_hash[:2] + '/' + blob_hash
 
 
 def _extract_archive(archive_path, output_path):
@@ -182,15 +569,14 @@ def _extract_archive(archive_path, output_path):
             os.remove(inner_archive_path)
 
 
-def install_artifact(artifact_path, destination_directory):
-    ''' Install an artifact in the workspace '''
+def install_artifact(artifact_path, destination_directory, all_executable_paths = None):
+    ''' Install an artifact in the workspace. If the executable files are
+        known, for instance from the artifact manifest, they are not detected
+        again when installing. '''
 
     if not os.path.exists(artifact_path):
         raise ValueError('Artifact does not exist: ' + artifact_path)
 
-    if platform.system() != 'Windows' and magic is None:
-        logging.warning('python-magic is not available, executable permissions will not be set')
-
     all_files = [ file_path for file_path in _list_files(artifact_path, True) if os.path.isfile(file_path) ]
     for source in all_files:
         destination = os.path.join(destination_directory, source[ len(artifact_path) + 1 : ])
@@ -200,73 +586,305 @@ def install_artifact(artifact_path, destination_directory):
         if not os.path.isdir(os.path.dirname(destination)):
             os.makedirs(os.path.dirname(destination))
         shutil.move(source, destination)
-        _try_make_executable(destination)
-
+        if all_executable_paths is None:
+            _try_make_executable(destination)
+        elif source[ len(artifact_path) + 1 : ].replace('\\', '/') in all_executable_paths:
+            _try_make_executable(destination, True)
+
+
+def install_archive(workspace_directory, archive_uri, destination_directory):
+    ''' Install a zip artifact in the workspace, extracting files directly
+        from the repository to their destination '''
+
+    if _is_http_uri(archive_uri):
+        head_request = _get_http_session().head(archive_uri, allow_redirects = True, timeout = _HTTP_TIMEOUT)
+        head_request.raise_for_status()
+        archive_size = int(head_request.headers.get('Content-Length', 0))
+        if head_request.headers.get('Accept-Ranges') != 'bytes' or archive_size <= 0:
+            logging.info('%s does not support range requests, downloading it first', archive_uri)
+            local_artifact_path = download_artifact(workspace_directory, archive_uri)
+            install_artifact(local_artifact_path, destination_directory)
+            shutil.rmtree(local_artifact_path)
+            return
+        archive_file = io.BufferedReader(_HttpRangeFile(archive_uri, archive_size), buffer_size = _HTTP_READ_BUFFER_SIZE)
+    else:
+        archive_file = open(archive_uri, 'rb')
 
-def _try_make_executable(file_path):
+    download_directory = os.path.join(workspace_directory, '.nimp', 'downloads')
+    statistics = _TransferStatistics()
+    with archive_file, zipfile.ZipFile(archive_file) as archive:
+        all_members = [ member for member in archive.infolist() if not member.is_dir() ]
+        is_archive_package = all(member.filename.endswith('.zip') for member in all_members)
+        for member in all_members:
+            if not is_archive_package:
+                _install_archive_member(archive, member, destination_directory, statistics)
+                continue
+            # Inner archives need random access, so they are staged one at a time
+            os.makedirs(download_directory, exist_ok = True)
+            with tempfile.TemporaryFile(dir = download_directory) as inner_archive_file:
+                with archive.open(member) as member_file:
+                    shutil.copyfileobj(member_file, inner_archive_file, _COPY_BUFFER_SIZE)
+                with zipfile.ZipFile(inner_archive_file) as inner_archive:
+                    for inner_member in inner_archive.infolist():
+                        if not inner_member.is_dir():
+                            _install_archive_member(inner_archive, inner_member, destination_directory, statistics)
+    statistics.log('Installed', archive_uri)
+
+
+def _install_archive_member(archive, member, destination_directory, statistics):
+    logging.debug('Installing %s to %s', member.filename, destination_directory)
+    destination = os.path.join(destination_directory, member.filename)
+    if os.path.exists(destination):
+        os.remove(destination)
+    destination = archive.extract(member, destination_directory)
+    _try_make_executable(destination)
+    statistics.add(member.file_size)
+
+
+_HTTP_READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class _HttpRangeFile(io.RawIOBase):
+    ''' Read-only seekable file reading a remote file with range requests '''
+    def __init__(self, file_uri, file_size):
+        super().__init__()
+        self._file_uri = file_uri
+        self._file_size = file_size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._file_size
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, buffer):
+        if self._position >= self._file_size:
+            return 0
+        end = min(self._position + len(buffer), self._file_size) - 1
+        data = nimp.system.try_execute(lambda: self._read_range(self._position, end), requests.RequestException,
+                                       attempt_maximum = _HTTP_ATTEMPT_MAXIMUM, retry_delay = 2)
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def _read_range(self, start, end):
+        headers = { 'Range': 'bytes=%d-%d' % (start, end) }
+        range_request = _get_http_session().get(self._file_uri, headers = headers, timeout = _HTTP_TIMEOUT)
+        range_request.raise_for_status()
+        if range_request.status_code != 206:
+            raise OSError('Server ignored range request for %s' % self._file_uri)
+        return range_request.content
+
+
+def _try_make_executable(file_path, is_executable = None):
     if platform.system() == 'Windows':
         return
 
-    if magic is not None:
-        file_type = magic.from_file(file_path)
-        if isinstance(file_type, bytes):
-            # Older versions of python-magic return bytes instead of a string
-            file_type = file_type.decode('ascii')
-
-        if 'executable' in file_type or 'script' in file_type:
-            try:
-                file_stat = os.stat(file_path)
-                os.chmod(file_path, file_stat.st_mode | stat.S_IEXEC)
-            except OSError as exception:
-                logging.warning('Failed to make file executable: %s (FilePath: %s)', exception, file_path)
+    if is_executable is None:
+        is_executable = is_executable_file(file_path)
+    if is_executable:
+        try:
+            file_stat = os.stat(file_path)
+            os.chmod(file_path, file_stat.st_mode | stat.S_IEXEC)
+        except OSError as exception:
+            logging.warning('Failed to make file executable: %s (FilePath: %s)', exception, file_path)
+
+
+# Mach-O magic numbers and the byte order of their headers
+_MACHO_BYTE_ORDERS = { b'\xfe\xed\xfa\xce': '>', b'\xce\xfa\xed\xfe': '<', b'\xfe\xed\xfa\xcf': '>', b'\xcf\xfa\xed\xfe': '<' }
+_ELF_TYPE_EXECUTABLE = 2
+_ELF_TYPE_SHARED = 3
+_ELF_PROGRAM_DYNAMIC = 2
+_ELF_PROGRAM_INTERPRETER = 3
+_ELF_DYNAMIC_FLAGS_1 = 0x6ffffffb
+_ELF_FLAG_PIE = 0x08000000
+_MACHO_TYPE_EXECUTE = 2
+
+
+def is_executable_file(file_path):
+    ''' Checks whether a file is a program or a script from its first bytes.
+        libmagic is only used for files which can't be told apart this way. '''
+    with open(file_path, 'rb') as file_handle:
+        header = file_handle.read(64)
+        if header.startswith(b'#!') or header.startswith(b'MZ'):
+            return True
+        try:
+            if header.startswith(b'\x7fELF'):
+                return _is_elf_executable(file_handle, header)
+            if header[:4] in _MACHO_BYTE_ORDERS:
+                return struct.unpack_from(_MACHO_BYTE_ORDERS[header[:4]] + 'I', header, 12)[0] == _MACHO_TYPE_EXECUTE
+            # Universal binaries share their magic bytes with Java classes
+            if not header.startswith(b'\xca\xfe\xba\xbe'):
+                return False
+        except struct.error:
+            # Truncated headers are left to libmagic
+            pass
+    return _is_executable_from_libmagic(file_path)
+
+
+def _is_elf_executable(file_handle, header):
+    # Unpacked rather than indexed so truncated identifications are left to libmagic too
+    byte_order = '<' if struct.unpack_from('B', header, 5)[0] == 1 else '>'
+    elf_type = struct.unpack_from(byte_order + 'H', header, 16)[0]
+    if elf_type != _ELF_TYPE_SHARED:
+        return elf_type == _ELF_TYPE_EXECUTABLE
+    # Both position independent executables and shared libraries are shared
+    # objects, only executables need a program interpreter or are flagged PIE
+    is_64_bits = struct.unpack_from('B', header, 4)[0] == 2
+    if is_64_bits:
+        program_header_offset = struct.unpack_from(byte_order + 'Q', header, 32)[0]
+        program_header_size, program_header_count = struct.unpack_from(byte_order + 'HH', header, 54)
+    else:
+        program_header_offset = struct.unpack_from(byte_order + 'I', header, 28)[0]
+        program_header_size, program_header_count = struct.unpack_from(byte_order + 'HH', header, 42)
+    file_handle.seek(program_header_offset)
+    program_headers = file_handle.read(program_header_size * program_header_count)
+    dynamic_section = None
+    for offset in range(0, len(program_headers) - program_header_size + 1, max(program_header_size, 1)):
+        segment_type = struct.unpack_from(byte_order + 'I', program_headers, offset)[0]
+        if segment_type == _ELF_PROGRAM_INTERPRETER:
+            return True
+        if segment_type == _ELF_PROGRAM_DYNAMIC:
+            if is_64_bits:
+                dynamic_section = (struct.unpack_from(byte_order + 'Q', program_headers, offset + 8)[0],
+                                   struct.unpack_from(byte_order + 'Q', program_headers, offset + 32)[0])
+            else:
+                dynamic_section = (struct.unpack_from(byte_order + 'I', program_headers, offset + 4)[0],
+                                   struct.unpack_from(byte_order + 'I', program_headers, offset + 16)[0])
+    if dynamic_section is None:
+        return False
+
+    # Static PIE executables have no interpreter
+    file_handle.seek(dynamic_section[0])
+    dynamic_entries = file_handle.read(dynamic_section[1])
+    entry_format = byte_order + ('qQ' if is_64_bits else 'iI')
+    for tag, value in struct.iter_unpack(entry_format, dynamic_entries[:len(dynamic_entries) - len(dynamic_entries) % struct.calcsize(entry_format)]):
+        if tag == _ELF_DYNAMIC_FLAGS_1:
+            return bool(value & _ELF_FLAG_PIE)
+    return False
+
+
+def _is_executable_from_libmagic(file_path):
+    if magic is None:
+        logging.debug('python-magic is not available, cannot tell whether %s is executable', file_path)
+        return False
+    file_type = magic.from_file(file_path)
+    if isinstance(file_type, bytes):
+        # Older versions of python-magic return bytes instead of a string
+        file_type = file_type.decode('ascii')
+    return 'executable' in file_type or 'script' in file_type
 
 def _try_rename(src, dst, max_attempts=5, retry_delay=2):
     def _rename():
         os.rename(src, dst)
     nimp.system.try_execute(_rename, OSError, attempt_maximum=max_attempts, retry_delay=retry_delay)
 
-def create_artifact(artifact_path, file_collection, archive, compress, dry_run):
-    ''' Create an artifact '''
+def create_artifact(artifact_path, file_collection, archive, compress, dry_run, workers = None, blob_store = None, hash_method = None,
+                    torrent = False, torrent_announce = None):
+    ''' Create an artifact. If a blob store is given, only a manifest is
+        created for the artifact and files are stored by content in the store.
+        If a hash method is given, the artifact is hashed while it is written
+        and its hash is returned. Torrent pieces are also hashed while the
+        artifact is written, so its data is only read once. The artifact is
+        moved in place last, so a failed attempt can simply be retried. '''
+
+    if torrent and BitTornado is None:
+        raise ImportError('Required module "BitTornado" is not available')
+    if torrent and blob_store is not None:
+        raise ValueError('Cannot create a torrent for a stored artifact')
 
-    if os.path.isfile(artifact_path + '.zip') or os.path.isdir(artifact_path):
+    if _find_artifact(artifact_path):
         raise ValueError('Artifact already exists: %s' % artifact_path)
 
     if not dry_run:
         if os.path.isfile(artifact_path + '.zip.tmp'):
             os.remove(artifact_path + '.zip.tmp')
+        if os.path.isfile(artifact_path + '.manifest.tmp'):
+            os.remove(artifact_path + '.manifest.tmp')
         if os.path.isdir(artifact_path + '.tmp'):
             shutil.rmtree(artifact_path + '.tmp')
+        if torrent:
+            _remove_torrent(artifact_path)
+        # Hashes are written before their artifact, a previous attempt may
+        # have left one behind
+        for hash_path in [ artifact_path + '.zip.hash', artifact_path + '.manifest.hash', artifact_path + '.hash' ]:
+            if os.path.isfile(hash_path):
+                os.remove(hash_path)
+
+    workers = nimp.system.get_worker_count(workers)
+    statistics = _TransferStatistics()
+    file_hash = None
+    all_file_hashes = None
+    # Files may be streamed while their fileset is walked, they are only
+    # gathered first when a torrent needs their total size. Streamed files
+    # may be repeated, each writer only keeps the first file of a destination.
+    all_files = ( (source, destination) for source, destination in file_collection if not os.path.isdir(source) )
+    torrent_piece_length = None
+    if torrent:
+        all_unique_files = {}
+        for source, destination in all_files:
+            all_unique_files.setdefault(destination, (source, destination))
+        all_files = list(all_unique_files.values())
+        torrent_piece_length = _get_torrent_piece_length(sum(os.path.getsize(source) for source, _ in all_files))
 
     if dry_run:
-        for source, destination in file_collection:
-            if os.path.isdir(source):
-                continue
+        for source, destination in all_files:
             logging.debug('Adding %s as %s', source, destination)
 
+    elif blob_store is not None:
+        manifest_path = artifact_path + '.manifest'
+        _create_stored_artifact(manifest_path, file_collection, blob_store, workers, statistics)
+        if hash_method is not None:
+            file_hash = get_file_hash(manifest_path + '.tmp', hash_method)
+            _save_hash(manifest_path, hash_method, file_hash, None)
+        shutil.move(manifest_path + '.tmp', manifest_path)
+        statistics.log('Stored new blobs for', manifest_path)
+
     elif archive:
         archive_path = artifact_path + '.zip'
         compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
-        with zipfile.ZipFile(archive_path + '.tmp', 'w', compression = compression) as archive_file:
-            for source, destination in file_collection:
-                if os.path.isdir(source):
-                    continue
-                logging.debug('Adding %s as %s', source, destination)
-                archive_file.write(source, destination)
-        with zipfile.ZipFile(archive_path + '.tmp', 'r') as archive_file:
-            if archive_file.testzip():
-                raise OSError('Archive is corrupted')
+        hash_object = create_hash_object(hash_method) if hash_method is not None else None
+        torrent_hasher = _TorrentPieceHasher(torrent_piece_length) if torrent else None
+        _create_archive(archive_path + '.tmp', all_files, compression, workers, statistics,
+                        [ output_hash for output_hash in [ hash_object, torrent_hasher ] if output_hash is not None ])
+        if hash_object is not None:
+            file_hash = hash_object.hexdigest()
+            _save_hash(archive_path, hash_method, file_hash, None)
+        if torrent:
+            torrent_info = _get_torrent_info(os.path.basename(archive_path), torrent_piece_length, torrent_hasher.digest(),
+                                             file_size = os.path.getsize(archive_path + '.tmp'))
+            _write_torrent(artifact_path, torrent_info, torrent_announce)
         logging.debug('Renaming %s to %s' % (archive_path + '.tmp', artifact_path))
         shutil.move(archive_path + '.tmp', archive_path)
+        statistics.log('Created', archive_path)
 
     else:
         artifact_path_tmp = artifact_path + '.tmp'
-        for source, destination in file_collection:
-            if os.path.isdir(source):
-                continue
-            logging.debug('Adding %s as %s', source, destination)
-            destination = os.path.join(artifact_path_tmp, destination)
-            os.makedirs(os.path.dirname(destination), exist_ok = True)
-            shutil.copyfile(source, destination)
+        torrent_pieces = None
+        if torrent:
+            # Torrent files are listed by path, each copy hashes the pieces starting in its file
+            all_files.sort(key = lambda file: file[1].replace('\\', '/'))
+            torrent_pieces = _TorrentPieces([ (source, 0, os.path.getsize(source)) for source, _ in all_files ], torrent_piece_length)
+        all_file_hashes, all_pieces = _copy_files(artifact_path_tmp, all_files, workers, statistics, hash_method, torrent_pieces)
+        if hash_method is not None:
+            file_hash = _get_directory_hash(all_file_hashes, hash_method)
+            _save_hash(artifact_path, hash_method, file_hash, all_file_hashes)
+        if torrent:
+            all_torrent_files = [ (destination.replace('\\', '/'), segment[2]) for (_, destination), segment in zip(all_files, torrent_pieces.all_segments) ]
+            torrent_info = _get_torrent_info(os.path.basename(artifact_path), torrent_piece_length, all_pieces, all_files = all_torrent_files)
+            _write_torrent(artifact_path, torrent_info, torrent_announce)
         logging.debug('Try : renaming %s to %s' % (artifact_path_tmp, artifact_path))
         try:
             # Sometimes shutils.move copies files instead of moving them, maybe
@@ -277,85 +895,509 @@ def create_artifact(artifact_path, file_collection, archive, compress, dry_run):
         except Exception as ex:
             logging.debug('Renaming failed (%s), trying alternate method' % (ex))
             shutil.move(artifact_path_tmp, artifact_path)
+        statistics.log('Created', artifact_path)
 
+    return file_hash
 
-def create_torrent(artifact_path, announce, dry_run):
+
+_BLOB_HASH_METHOD = 'sha256'
+_COPY_BUFFER_SIZE = 1024 * 1024
+# Compressed entries bigger than this are spooled to a temporary file instead
+# of memory, which bounds the memory used by pending entries to a few MiB each
+_SPOOL_MAX_SIZE = 1024 * 1024
+# zipfile has no public API to add already compressed data, so archives are
+# only compressed in parallel when these internals are available
+_ZIPFILE_INTERNALS = [ '_writecheck', '_didModify', 'fp', 'start_dir', 'filelist', 'NameToInfo' ]
+
+
+class _TransferStatistics():
+    ''' Counts files and bytes processed to report throughput '''
+    def __init__(self):
+        self.file_count = 0
+        self.byte_count = 0
+        self._start_time = time.monotonic()
+
+    def add(self, byte_count):
+        ''' Records a processed file '''
+        self.file_count += 1
+        self.byte_count += byte_count
+
+    def log(self, action, path):
+        ''' Logs the throughput since this object was created '''
+        elapsed_time = max(time.monotonic() - self._start_time, 0.001)
+        logging.info('%s %s: %d files, %.1f MiB in %.1fs (%.1f MiB/s, %.1f files/s)',
+                     action, path, self.file_count, self.byte_count / (1024 * 1024), elapsed_time,
+                     self.byte_count / (1024 * 1024) / elapsed_time, self.file_count / elapsed_time)
+
+
+def _copy_files(output_directory, all_files, workers, statistics, hash_method = None, torrent_pieces = None):
+    def _copy_file(index, source, destination):
+        os.makedirs(os.path.dirname(destination), exist_ok = True)
+        if hash_method is None and torrent_pieces is None:
+            shutil.copyfile(source, destination)
+            return os.path.getsize(destination), None, None
+        # Hash the data while it is copied instead of reading the copy again
+        hash_object = create_hash_object(hash_method) if hash_method is not None else None
+        torrent_hasher = torrent_pieces.create_hasher(index) if torrent_pieces is not None else None
+        file_size = 0
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            for buffer in iter(lambda: source_file.read(_COPY_BUFFER_SIZE), b''):
+                if hash_object is not None:
+                    hash_object.update(buffer)
+                if torrent_hasher is not None:
+                    torrent_hasher.update(buffer)
+                destination_file.write(buffer)
+                file_size += len(buffer)
+        return (file_size,
+                hash_object.hexdigest() if hash_object is not None else None,
+                torrent_hasher.digest() if torrent_hasher is not None else None)
+
+    all_file_hashes = {}
+    all_pieces = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        all_futures = {}
+        for index, (source, destination) in enumerate(all_files):
+            if destination in all_futures:
+                continue
+            logging.debug('Adding %s as %s', source, destination)
+            all_futures[destination] = executor.submit(_copy_file, index, source, os.path.join(output_directory, destination))
+        for destination, future in all_futures.items():
+            file_size, file_hash, pieces = future.result()
+            statistics.add(file_size)
+            all_file_hashes[destination.replace('\\', '/')] = file_hash
+            all_pieces.append(pieces)
+    return (all_file_hashes if hash_method is not None else None,
+            b''.join(all_pieces) if torrent_pieces is not None else None)
+
+
+def _create_stored_artifact(manifest_path, file_collection, blob_store, workers, statistics):
+    def _store_file(source):
+        # Files are hashed locally first, so that only missing blobs are
+        # written to the blob store
+        file_hash = get_file_hash(source, _BLOB_HASH_METHOD)
+        is_executable = is_executable_file(source)
+        blob_path = _get_blob_path(blob_store, file_hash)
+        if os.path.isfile(blob_path):
+            return file_hash, os.path.getsize(source), is_executable, False
+        # Several uploads may store the same blob concurrently, so each one
+        # writes its own temporary file before atomically replacing the blob
+        blob_path_tmp = '%s.%s.tmp' % (blob_path, uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(blob_path), exist_ok = True)
+        shutil.copyfile(source, blob_path_tmp)
+        os.replace(blob_path_tmp, blob_path)
+        return file_hash, os.path.getsize(blob_path), is_executable, True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        all_entries = {}
+        for source, destination in file_collection:
+            if os.path.isdir(source) or destination in all_entries:
+                continue
+            logging.debug('Adding %s as %s', source, destination)
+            all_entries[destination] = executor.submit(_store_file, source)
+
+        all_files = []
+        for destination, future in all_entries.items():
+            file_hash, file_size, is_executable, is_new = future.result()
+            if is_new:
+                statistics.add(file_size)
+            entry = { 'path': destination.replace('\\', '/'), 'size': file_size, 'hash': file_hash }
+            if is_executable:
+                entry['executable'] = True
+            all_files.append(entry)
+
+    logging.info('%d of %d files were already in the blob store', len(all_files) - statistics.file_count, len(all_files))
+    manifest = {
+        'hash_method': _BLOB_HASH_METHOD,
+        # Relative to the manifest so it can be resolved from any repository source
+        'blob_store': _get_relative_blob_store(blob_store, manifest_path),
+        # Executable files are detected when uploading so installs don't have to
+        'has_executable_flags': True,
+        'files': all_files,
+    }
+    # The manifest is only written to its temporary path, it is moved in place
+    # by the caller once everything describing it is written
+    os.makedirs(os.path.dirname(manifest_path), exist_ok = True)
+    with open(manifest_path + '.tmp', 'w', encoding = 'utf-8') as manifest_file:
+        json.dump(manifest, manifest_file)
+
+
+def _create_archive(archive_path, all_files, compression, workers, statistics, all_output_hashes = ()):
+    # Members are read, checksummed and compressed concurrently, then written
+    # in order by this thread; the window bounds the number of spooled members.
+    window_size = workers * 2
+    with open(archive_path, 'wb') as output_file, \
+         zipfile.ZipFile(_HashingWriter(output_file, all_output_hashes), 'w', compression = compression) as archive_file:
+        if not all(hasattr(archive_file, name) for name in _ZIPFILE_INTERNALS):
+            logging.debug('Compressing archive members sequentially, zipfile internals are not available')
+            for source, destination in all_files:
+                if _is_archive_member(archive_file, destination):
+                    continue
+                logging.debug('Adding %s as %s', source, destination)
+                archive_file.write(source, destination)
+                statistics.add(os.path.getsize(source))
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+            pending_entries = collections.deque()
+            for source, destination in all_files:
+                if _is_archive_member(archive_file, destination) or any(entry[1] == destination for entry in pending_entries):
+                    continue
+                logging.debug('Adding %s as %s', source, destination)
+                future = executor.submit(_compress_file, source, compression)
+                pending_entries.append((source, destination, future))
+                if len(pending_entries) > window_size:
+                    _write_archive_entry(archive_file, compression, *pending_entries.popleft(), statistics)
+            while pending_entries:
+                _write_archive_entry(archive_file, compression, *pending_entries.popleft(), statistics)
+
+
+def _is_archive_member(archive_file, name):
+    try:
+        archive_file.getinfo(name)
+        return True
+    except KeyError:
+        return False
+
+
+class _HashingWriter():
+    ''' Write-only file wrapper hashing data as it is written '''
+    def __init__(self, output_file, all_hash_objects):
+        self._output_file = output_file
+        self._all_hash_objects = all_hash_objects
+
+    def write(self, data):
+        for hash_object in self._all_hash_objects:
+            hash_object.update(data)
+        return self._output_file.write(data)
+
+    def tell(self):
+        return self._output_file.tell()
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        # Seeking back would rewrite data which has already been hashed, so
+        # zipfile is told the file isn't seekable and writes sizes after data
+        raise OSError('Cannot seek in a hashed output file')
+
+    def flush(self):
+        self._output_file.flush()
+
+
+def _compress_file(source, compression):
+    spool = tempfile.SpooledTemporaryFile(max_size = _SPOOL_MAX_SIZE)
+    compressor = None
+    if compression == zipfile.ZIP_DEFLATED:
+        # Same settings as zipfile uses for ZIP_DEFLATED
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    crc = 0
+    file_size = 0
+    with open(source, 'rb') as source_file:
+        for buffer in iter(lambda: source_file.read(_COPY_BUFFER_SIZE), b''):
+            crc = zlib.crc32(buffer, crc)
+            file_size += len(buffer)
+            spool.write(compressor.compress(buffer) if compressor else buffer)
+    if compressor:
+        spool.write(compressor.flush())
+
+    compress_size = spool.tell()
+    spool.seek(0)
+    return spool, file_size, compress_size, crc
+
+
+def _write_archive_entry(archive_file, compression, source, destination, future, statistics):
+    spool, file_size, compress_size, crc = future.result()
+    with spool:
+        zip_info = zipfile.ZipInfo.from_file(source, destination)
+        zip_info.compress_type = compression
+        zip_info.file_size = file_size
+        zip_info.compress_size = compress_size
+        zip_info.CRC = crc
+
+        # This mimics what ZipFile.write does with the member sizes known
+        # upfront, using the internals listed in _ZIPFILE_INTERNALS.
+        archive_file._writecheck(zip_info) # pylint: disable = protected-access
+        archive_file._didModify = True # pylint: disable = protected-access
+        zip_info.header_offset = archive_file.fp.tell()
+        archive_file.fp.write(zip_info.FileHeader())
+        data_offset = archive_file.fp.tell()
+        shutil.copyfileobj(spool, archive_file.fp, _COPY_BUFFER_SIZE)
+        if archive_file.fp.tell() - data_offset != compress_size:
+            raise OSError('Archive is corrupted: %s' % destination)
+        archive_file.filelist.append(zip_info)
+        archive_file.NameToInfo[zip_info.filename] = zip_info
+        archive_file.start_dir = archive_file.fp.tell()
+
+    statistics.add(file_size)
+
+
+def create_torrent(artifact_path, announce, dry_run, workers = None):
     ''' Create a torrent for an existing artifact '''
 
     if BitTornado is None:
         raise ImportError('Required module "BitTornado" is not available')
 
-    torrent_path = artifact_path + '.torrent'
     if not dry_run:
-        if os.path.isfile(torrent_path + '.tmp'):
-            os.remove(torrent_path + '.tmp')
-        if os.path.isfile(torrent_path):
-            os.remove(torrent_path)
+        _remove_torrent(artifact_path)
 
     if os.path.isfile(artifact_path + '.zip'):
         torrent_name = os.path.basename(artifact_path + '.zip')
-        all_torrent_trees = [ BitTornado.Meta.BTTree.BTTree(artifact_path + '.zip', [ os.path.basename(artifact_path + '.zip') ]) ]
+        all_files = [ (artifact_path + '.zip', torrent_name) ]
     elif os.path.isdir(artifact_path):
         torrent_name = os.path.basename(artifact_path)
-        all_torrent_trees = []
+        all_files = []
         for source in glob.glob(os.path.join(artifact_path, '**'), recursive = True):
             if os.path.isfile(source):
-                destination = os.path.relpath(source, artifact_path)
-                all_torrent_trees.append(BitTornado.Meta.BTTree.BTTree(source, os.path.normpath(destination).split(os.path.sep)))
+                all_files.append((source, os.path.relpath(source, artifact_path).replace('\\', '/')))
+        all_files.sort(key = lambda file: file[1])
     else:
         raise FileNotFoundError('Artifact not found: %s' % artifact_path)
 
-    torrent_info = BitTornado.Meta.Info.Info(torrent_name, sum(tree.size for tree in all_torrent_trees))
-    for torrent_tree in all_torrent_trees:
-        torrent_tree.addFileToInfos([torrent_info])
-        BitTornado.Meta.Info.check_info(torrent_info)
+    all_files = [ (source, destination, os.path.getsize(source)) for source, destination in all_files ]
+    piece_length = _get_torrent_piece_length(sum(file_size for _, _, file_size in all_files))
+    # Big files are split so that pieces of a single archive are hashed in parallel too
+    all_segments = []
+    segment_size = piece_length * _TORRENT_SEGMENT_PIECE_COUNT
+    for source, _, file_size in all_files:
+        all_segments += [ (source, offset, min(segment_size, file_size - offset)) for offset in range(0, file_size, segment_size) ]
+        if file_size == 0:
+            all_segments.append((source, 0, 0))
+    pieces = _TorrentPieces(all_segments, piece_length).hash_all(nimp.system.get_worker_count(workers))
 
-    torrent_metainfo_parameters = { 'announce': announce }
-    torrent_metainfo_parameters = { key: value for key, value in torrent_metainfo_parameters.items() if value is not None }
-    torrent_metainfo = BitTornado.Meta.Info.MetaInfo(info = torrent_info, **torrent_metainfo_parameters)
+    if os.path.isfile(artifact_path + '.zip'):
+        torrent_info = _get_torrent_info(torrent_name, piece_length, pieces, file_size = all_files[0][2])
+    else:
+        torrent_info = _get_torrent_info(torrent_name, piece_length, pieces, all_files = [ (destination, file_size) for _, destination, file_size in all_files ])
 
     if not dry_run:
-        with open(torrent_path + '.tmp', 'wb') as torrent_file:
-            torrent_file.write(BitTornado.Meta.bencode.bencode(torrent_metainfo))
-        shutil.move(torrent_path + '.tmp', torrent_path)
+        _write_torrent(artifact_path, torrent_info, announce)
+
+
+# Number of pieces hashed by a single task when hashing existing artifacts
+_TORRENT_SEGMENT_PIECE_COUNT = 64
+
+
+def _get_torrent_piece_length(total_size):
+    # Aims for about a thousand pieces, between 32KiB and 4MiB
+    piece_length = 32 * 1024
+    while piece_length < 4 * 1024 * 1024 and total_size > piece_length * 1024:
+        piece_length *= 2
+    return piece_length
+
+
+class _TorrentPieceHasher():
+    ''' Hashes the torrent pieces starting in a file segment. The start of the
+        segment belonging to a previous piece is skipped, and the end of its
+        last piece is read from the following segments. '''
+    def __init__(self, piece_length, skip_size = 0, all_next_segments = ()):
+        self._piece_length = piece_length
+        self._skip_size = skip_size
+        self._all_next_segments = all_next_segments
+        self._piece_hash = hashlib.sha1()
+        self._piece_size = 0
+        self._all_pieces = []
+
+    def update(self, data):
+        ''' Hashes the next bytes of the segment '''
+        data = memoryview(data)
+        if self._skip_size > 0:
+            skipped_size = min(self._skip_size, len(data))
+            self._skip_size -= skipped_size
+            data = data[skipped_size:]
+        while len(data) > 0:
+            size = min(self._piece_length - self._piece_size, len(data))
+            self._piece_hash.update(data[:size])
+            self._piece_size += size
+            data = data[size:]
+            if self._piece_size == self._piece_length:
+                self._all_pieces.append(self._piece_hash.digest())
+                self._piece_hash = hashlib.sha1()
+                self._piece_size = 0
+
+    def digest(self):
+        ''' Completes the last piece and returns all piece hashes '''
+        for path, offset, size in self._all_next_segments:
+            if self._piece_size == 0:
+                break
+            with open(path, 'rb') as segment_file:
+                segment_file.seek(offset)
+                self.update(segment_file.read(min(size, self._piece_length - self._piece_size)))
+        if self._piece_size > 0:
+            self._all_pieces.append(self._piece_hash.digest())
+            self._piece_size = 0
+        return b''.join(self._all_pieces)
+
+
+class _TorrentPieces():
+    ''' Torrent pieces of file segments laid out end to end, the pieces
+        starting in each segment being hashed independently '''
+    def __init__(self, all_segments, piece_length):
+        self.all_segments = all_segments
+        self.piece_length = piece_length
+        self._all_skip_sizes = []
+        offset = 0
+        for _, _, size in all_segments:
+            self._all_skip_sizes.append(-offset % piece_length)
+            offset += size
+
+    def create_hasher(self, index):
+        ''' Creates the hasher for the segment at the given index '''
+        return _TorrentPieceHasher(self.piece_length, self._all_skip_sizes[index], _SegmentSlice(self.all_segments, index + 1))
+
+    def hash_segment(self, index):
+        ''' Reads a segment and returns the hashes of the pieces starting in it '''
+        path, offset, size = self.all_segments[index]
+        hasher = self.create_hasher(index)
+        with open(path, 'rb') as segment_file:
+            segment_file.seek(offset)
+            while size > 0:
+                buffer = segment_file.read(min(size, _COPY_BUFFER_SIZE))
+                if not buffer:
+                    raise EOFError('Unexpected end of file: %s' % path)
+                hasher.update(buffer)
+                size -= len(buffer)
+        return hasher.digest()
+
+    def hash_all(self, workers):
+        ''' Hashes all segments in parallel and returns all piece hashes '''
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+            return b''.join(executor.map(self.hash_segment, range(len(self.all_segments))))
+
+
+class _SegmentSlice():
+    ''' Iterates over segments from an index without copying the list '''
+    def __init__(self, all_segments, start):
+        self._all_segments = all_segments
+        self._start = start
+
+    def __iter__(self):
+        for index in range(self._start, len(self._all_segments)):
+            yield self._all_segments[index]
+
+
+def _get_torrent_info(name, piece_length, pieces, file_size = None, all_files = None):
+    torrent_info = { 'name': name, 'piece length': piece_length, 'pieces': pieces }
+    if all_files is None:
+        torrent_info['length'] = file_size
+    else:
+        torrent_info['files'] = [ { 'length': size, 'path': path.split('/') } for path, size in all_files ]
+    return torrent_info
+
+
+def _write_torrent(artifact_path, torrent_info, announce):
+    torrent_path = artifact_path + '.torrent'
+    torrent_metainfo = { 'info': torrent_info, 'creation date': int(time.time()) }
+    if announce is not None:
+        torrent_metainfo['announce'] = announce
+    with open(torrent_path + '.tmp', 'wb') as torrent_file:
+        torrent_file.write(BitTornado.Meta.bencode.bencode(torrent_metainfo))
+    shutil.move(torrent_path + '.tmp', torrent_path)
+
+
+def _remove_torrent(artifact_path):
+    torrent_path = artifact_path + '.torrent'
+    if os.path.isfile(torrent_path + '.tmp'):
+        os.remove(torrent_path + '.tmp')
+    if os.path.isfile(torrent_path):
+        os.remove(torrent_path)
 
 
-def create_hash(artifact_path, hash_method, dry_run):
+def create_hash(artifact_path, hash_method, dry_run, workers = None):
     artifact_full_path = _find_artifact(artifact_path)
     if not artifact_full_path:
         raise FileNotFoundError(f'Artifact not found: {artifact_path}')
 
-    file_hash = get_file_hash(artifact_full_path, hash_method)
+    all_file_hashes = None
+    if os.path.isdir(artifact_full_path):
+        all_file_hashes = get_directory_file_hashes(artifact_full_path, hash_method, workers)
+        file_hash = _get_directory_hash(all_file_hashes, hash_method)
+    else:
+        file_hash = get_file_hash(artifact_full_path, hash_method)
     if not file_hash:
         raise ValueError(f'Something went wrong while hashing {artifact_full_path}')
 
     if not dry_run:
-        with TempArtifact(f'{artifact_full_path}.hash', 'w', force=True) as fh:
-            json.dump({hash_method: file_hash}, fh)
+        _save_hash(artifact_full_path, hash_method, file_hash, all_file_hashes)
 
+    return file_hash
+
+
+def _save_hash(artifact_full_path, hash_method, file_hash, all_file_hashes):
+    hash_content = { hash_method: file_hash }
+    if all_file_hashes is not None:
+        hash_content['files'] = all_file_hashes
+    with TempArtifact(f'{artifact_full_path}.hash', 'w', force=True) as fh:
+        json.dump(hash_content, fh)
 
-def get_file_hash(file_path, hash_method):
-    ''' helper function to parse potentially big files '''
-    assert getattr(hashlib, hash_method)()
-    hash_lib = getattr(hashlib, hash_method)()
 
-    _BLOCK_SIZE = 65536
+_HASH_BUFFER_SIZE = 8 * 1024 * 1024
+# Fast non-cryptographic hashes from the optional xxhash module
+_XXHASH_METHODS = [ 'xxh32', 'xxh64', 'xxh3_64', 'xxh3_128', 'xxh128' ]
 
-    with open(file_path, 'rb') as fh:
-        file_buffer = fh.read(_BLOCK_SIZE)
-        while len(file_buffer) > 0:
-            hash_lib.update(file_buffer)
-            file_buffer = fh.read(_BLOCK_SIZE)
-    file_hash = hash_lib.hexdigest()
+
+def create_hash_object(hash_method):
+    ''' Creates a hash object from its name, either any hashlib algorithm
+        (md5, sha256, blake2b...) or an xxhash algorithm '''
+    if hash_method in _XXHASH_METHODS:
+        if xxhash is None:
+            raise ImportError('Required module "xxhash" is not available')
+        return getattr(xxhash, hash_method)()
+    return hashlib.new(hash_method)
+
+
+def is_hash_method_available(hash_method):
+    ''' Checks a hash method can be used to hash artifacts '''
+    try:
+        create_hash_object(hash_method)
+    except (ImportError, ValueError):
+        return False
+    return True
+
+
+def get_file_hash(file_path, hash_method):
+    ''' helper function to parse potentially big files '''
+    hash_object = create_hash_object(hash_method)
+
+    with open(file_path, 'rb', buffering = 0) as fh:
+        # Large reads into a single buffer, sized down for small files
+        file_size = os.fstat(fh.fileno()).st_size
+        file_buffer = bytearray(max(min(file_size, _HASH_BUFFER_SIZE), 1))
+        file_view = memoryview(file_buffer)
+        read_size = fh.readinto(file_buffer)
+        while read_size > 0:
+            hash_object.update(file_view[:read_size])
+            read_size = fh.readinto(file_buffer)
+    file_hash = hash_object.hexdigest()
 
     logging.debug(f"{file_path} {hash_method}: {file_hash}")
     return file_hash
 
 
+def get_directory_file_hashes(directory, hash_method, workers = None):
+    ''' Hashes all files in a directory in parallel, indexed by relative path '''
+    all_files = []
+    for parent_directory, _, all_file_names in os.walk(directory):
+        for file_name in all_file_names:
+            file_path = os.path.join(parent_directory, file_name)
+            all_files.append((os.path.relpath(file_path, directory).replace('\\', '/'), file_path))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = nimp.system.get_worker_count(workers)) as executor:
+        all_hashes = executor.map(lambda file_path: get_file_hash(file_path, hash_method), [ file_path for _, file_path in all_files ])
+        return { relative_path: file_hash for (relative_path, _), file_hash in zip(all_files, all_hashes) }
+
+
+def _get_directory_hash(all_file_hashes, hash_method):
+    # Hash of the sorted file list, so it doesn't depend on the copy order
+    hash_object = create_hash_object(hash_method)
+    for file_path in sorted(all_file_hashes):
+        hash_object.update(('%s %s\n' % (all_file_hashes[file_path], file_path)).encode('utf-8'))
+    return hash_object.hexdigest()
+
+
 # TODO (l.cahour): this is workaround the fact we don't use artifact objects containing the info we need
 def _find_artifact(artifact_path):
     if os.path.isfile(artifact_path + '.zip'):
         return artifact_path + '.zip'
+    elif os.path.isfile(artifact_path + '.manifest'):
+        return artifact_path + '.manifest'
     elif os.path.isdir(artifact_path):
         return artifact_path
     else:
@@ -365,16 +1407,17 @@ def _find_artifact(artifact_path):
 # TODO (l.cahour): this is a naive first attempt at using a wrapper class to clean how we handle artifacts saving
 #                  Try to make this better and use it everywhere else in the future
 class TempArtifact(object):
-    def __init__(self, file_path, mode, force=False):
+    def __init__(self, file_path, mode, force=False, encoding=None):
         self.name = file_path
         self.temp = f'{file_path}.tmp'
         self.mode = mode
         self.force = force
+        self.encoding = encoding
 
     def __enter__(self):
         if self.force:
             self.clear()
-        self.file_handle = open(self.temp, self.mode)
+        self.file_handle = open(self.temp, self.mode, encoding=self.encoding)
         return self.file_handle
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -71,6 +71,10 @@ class Build(nimp.command.Command):
                             help='activate most verbose mode when available',
                             action='store_true')
 
+        parser.add_argument('--tools-workers',
+                            help='number of extra tools built in parallel',
+                            metavar = '<count>', type = int, default = 1)
+
         return True
 
     def is_available(self, env):
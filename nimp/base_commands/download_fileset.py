@@ -23,13 +23,16 @@
 ''' Downloads a previously uploaded fileset to the local workspace '''
 
 
+import bisect
 import copy
+import json
 import logging
 import os
 import shutil
 
 import nimp.artifacts
 import nimp.command
+import nimp.system
 
 
 class DownloadFileset(nimp.command.Command):
@@ -43,6 +46,9 @@ class DownloadFileset(nimp.command.Command):
         parser.add_argument('--min-revision', metavar = '<revision>', help = 'find a revision newer or equal to this one')
         parser.add_argument('--destination', metavar = '<path>', help = 'set a destination relative to the workspace')
         parser.add_argument('--track', choices = [ 'binaries', 'symbols', 'package', 'staged' ], help = 'track the installed revision in the workspace status')
+        parser.add_argument('--delta', action = 'store_true', help = 'only download files that changed since the tracked revision (requires --track)')
+        parser.add_argument('--workers', metavar = '<count>', type = int, default = None, help = 'number of parallel downloads')
+        parser.add_argument('--rescan', action = 'store_true', help = 'list the artifact collection even when its catalog seems complete')
         parser.add_argument('fileset', metavar = '<fileset>', help = 'fileset to download')
         return True
 
@@ -52,23 +58,49 @@ class DownloadFileset(nimp.command.Command):
 
 
     def run(self, env):
+        if env.delta and not env.track:
+            logging.error('Delta downloads require --track')
+            return False
+
         api_context = nimp.utils.git.initialize_gitea_api_context(env)
         artifact_uri_pattern = env.artifact_repository_source + '/' + env.artifact_collection[env.fileset]
         install_directory = env.root_dir + ('/' + env.format(env.destination) if env.destination else '')
         format_arguments = copy.deepcopy(vars(env))
         format_arguments['revision'] = '*'
         logging.info('Searching %s', artifact_uri_pattern.format(**format_arguments))
-        all_artifacts = nimp.system.try_execute(lambda: nimp.artifacts.list_artifacts(artifact_uri_pattern, format_arguments, api_context), OSError)
-        artifact_to_download = DownloadFileset._find_matching_artifact(all_artifacts, env.revision, env.min_revision, env.max_revision, api_context)
-
-        logging.info('Downloading %s%s', artifact_to_download['uri'], ' (simulation)' if env.dry_run else '')
-        if not env.dry_run:
-            local_artifact_path = nimp.system.try_execute(lambda: nimp.artifacts.download_artifact(env.root_dir, artifact_to_download['uri']), OSError)
-
-        logging.info('Installing %s in %s%s', artifact_to_download['uri'], install_directory, ' (simulation)' if env.dry_run else '')
-        if not env.dry_run:
-            nimp.artifacts.install_artifact(local_artifact_path, install_directory)
-            shutil.rmtree(local_artifact_path)
+        artifact_to_download = DownloadFileset._find_artifact_to_download(env, artifact_uri_pattern, format_arguments, api_context)
+
+        manifest = None
+        installed_manifest = None
+        if artifact_to_download['uri'].endswith('.manifest'):
+            manifest = nimp.system.try_execute(lambda: nimp.artifacts.load_manifest(artifact_to_download['uri']), OSError)
+            if env.delta:
+                installed_manifest = DownloadFileset._load_installed_manifest(env, install_directory)
+        elif env.delta:
+            logging.warning('%s has no manifest, downloading all files', artifact_to_download['uri'])
+
+        if artifact_to_download['uri'].endswith('.zip'):
+            # Archives are extracted in place, without downloading them first
+            logging.info('Installing %s in %s%s', artifact_to_download['uri'], install_directory, ' (simulation)' if env.dry_run else '')
+            if not env.dry_run:
+                nimp.system.try_execute(lambda: nimp.artifacts.install_archive(env.root_dir, artifact_to_download['uri'], install_directory), OSError)
+        else:
+            logging.info('Downloading %s%s', artifact_to_download['uri'], ' (simulation)' if env.dry_run else '')
+            if not env.dry_run:
+                local_artifact_path = nimp.system.try_execute(lambda: nimp.artifacts.download_artifact(env.root_dir, artifact_to_download['uri'],
+                                                                                                      manifest, installed_manifest, env.workers), OSError)
+
+            logging.info('Installing %s in %s%s', artifact_to_download['uri'], install_directory, ' (simulation)' if env.dry_run else '')
+            if not env.dry_run:
+                all_executable_paths = nimp.artifacts.get_executable_paths(manifest) if manifest is not None else None
+                nimp.artifacts.install_artifact(local_artifact_path, install_directory, all_executable_paths)
+                shutil.rmtree(local_artifact_path)
+
+        if installed_manifest is not None and not env.dry_run:
+            _, all_removed_paths = nimp.artifacts.diff_manifests(installed_manifest, manifest)
+            for path in all_removed_paths:
+                logging.debug('Removing %s', path)
+                nimp.system.safe_delete(os.path.join(install_directory, path))
 
         if env.track:
             workspace_status = nimp.system.load_status(env)
@@ -82,33 +114,104 @@ class DownloadFileset(nimp.command.Command):
                 workspace_status[env.track]['name'] = os.path.basename(os.path.normpath(workspace_status[env.track]['path']))
             # if not env.dry_run:
             nimp.system.save_status(env, workspace_status)
+            if not env.dry_run:
+                DownloadFileset._save_installed_manifest(env, manifest, artifact_to_download['revision'], install_directory)
 
         return True
 
 
+    @staticmethod
+    def _get_installed_manifest_path(env):
+        return os.path.join(env.root_dir, '.nimp', 'manifests', f'{env.track}-{env.platform}.manifest')
+
+    @staticmethod
+    def _load_installed_manifest(env, install_directory):
+        manifest_path = DownloadFileset._get_installed_manifest_path(env)
+        workspace_status = nimp.system.load_status(env)
+        tracked_revision = workspace_status[env.track].get(env.platform)
+        if not os.path.isfile(manifest_path):
+            logging.info('No manifest for the tracked revision, downloading all files')
+            return None
+        with open(manifest_path, encoding = 'utf-8') as manifest_file:
+            installed_manifest = json.load(manifest_file)
+        if installed_manifest['revision'] != tracked_revision or installed_manifest['destination'] != install_directory:
+            logging.info('Installed manifest does not match the tracked revision, downloading all files')
+            return None
+
+        # Files modified or removed since their installation must be downloaded again
+        all_installed_entries = []
+        for entry in installed_manifest['files']:
+            file_path = os.path.join(install_directory, entry['path'])
+            if os.path.isfile(file_path) and os.path.getsize(file_path) == entry['size']:
+                all_installed_entries.append(entry)
+        installed_manifest['files'] = all_installed_entries
+        return installed_manifest
+
+    @staticmethod
+    def _save_installed_manifest(env, manifest, revision, install_directory):
+        manifest_path = DownloadFileset._get_installed_manifest_path(env)
+        if manifest is None:
+            if os.path.isfile(manifest_path):
+                os.remove(manifest_path)
+            return
+        os.makedirs(os.path.dirname(manifest_path), exist_ok = True)
+        installed_manifest = dict(manifest, revision = revision, destination = install_directory)
+        with nimp.artifacts.TempArtifact(manifest_path, 'w', force = True, encoding = 'utf-8') as manifest_file:
+            json.dump(installed_manifest, manifest_file)
+
+    @staticmethod
+    def _find_artifact_to_download(env, artifact_uri_pattern, format_arguments, api_context):
+        # The collection is listed unless its catalog is known to be complete,
+        # or when asked to, or when the catalog lists a deleted artifact
+        use_catalog = not env.rescan
+        while True:
+            all_artifacts = nimp.system.try_execute(lambda: nimp.artifacts.list_artifacts(artifact_uri_pattern, format_arguments,
+                                                                                          api_context, use_catalog), OSError)
+            try:
+                artifact = DownloadFileset._find_matching_artifact(all_artifacts, env.revision, env.min_revision, env.max_revision, api_context)
+            except ValueError:
+                if any(artifact.get('is_cataloged') for artifact in all_artifacts):
+                    logging.error('No matching artifact in the catalog, use --rescan to search artifacts which were not registered')
+                raise
+            if not use_catalog or not artifact.get('is_cataloged') or nimp.artifacts.artifact_exists(artifact['uri']):
+                return artifact
+            logging.warning('%s is missing from the repository, listing all artifacts', artifact['uri'])
+            use_catalog = False
+
     # TODO: Handle revision comparison when identified by a hash
     @staticmethod
     def _find_matching_artifact(all_artifacts, exact_revision, minimum_revision, maximum_revision, api_context):
-        all_artifacts = sorted(all_artifacts, key=lambda artifact: int(artifact['sortable_revision'], 16), reverse=True)
+        all_artifacts = sorted(all_artifacts, key=lambda artifact: int(artifact['sortable_revision'], 16))
+        all_keys = [ int(artifact['sortable_revision'], 16) for artifact in all_artifacts ]
         has_revision_input = exact_revision or minimum_revision or maximum_revision
 
         if api_context:
-            exact_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, exact_revision)
-            minimum_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, minimum_revision)
-            maximum_revision = nimp.utils.git.get_gitea_commit_timestamp(api_context, maximum_revision)
+            all_timestamps = nimp.utils.git.get_gitea_commit_timestamps(api_context, [ exact_revision, minimum_revision, maximum_revision ])
+            exact_revision = all_timestamps[exact_revision]
+            minimum_revision = all_timestamps[minimum_revision]
+            maximum_revision = all_timestamps[maximum_revision]
             revision_not_found = not exact_revision and not minimum_revision and not maximum_revision
             if has_revision_input and revision_not_found:
                 raise ValueError('Searched commit not found on gitea repo')
 
-        try:
-            if exact_revision is not None:
-                return next(a for a in all_artifacts if a['sortable_revision'] == exact_revision)
-            if minimum_revision is not None and maximum_revision is not None:
-                return next(a for a in all_artifacts if int(a['sortable_revision']) >= int(minimum_revision) and int(a['sortable_revision']) <= int(maximum_revision))
-            if minimum_revision is not None:
-                return next(a for a in all_artifacts if int(a['sortable_revision']) >= int(minimum_revision))
-            if maximum_revision is not None:
-                return next(a for a in all_artifacts if int(a['sortable_revision']) <= int(maximum_revision))
-            return next(a for a in all_artifacts)
-        except StopIteration:
+        # Revisions are sorted by ascending key so they can be searched by bisection.
+        # Decimal revisions compare the same when read as hexadecimal.
+        if exact_revision is not None:
+            try:
+                exact_key = int(exact_revision, 16)
+            except ValueError as exception:
+                raise ValueError('Matching artifact not found') from exception
+            index = bisect.bisect_left(all_keys, exact_key)
+            while index < len(all_keys) and all_keys[index] == exact_key:
+                if all_artifacts[index]['sortable_revision'] == exact_revision:
+                    return all_artifacts[index]
+                index += 1
+            raise ValueError('Matching artifact not found')
+
+        index = len(all_keys) - 1
+        if maximum_revision is not None:
+            index = bisect.bisect_right(all_keys, int(maximum_revision, 16)) - 1
+        if index < 0 or (minimum_revision is not None and all_keys[index] < int(minimum_revision, 16)):
             raise ValueError('Matching artifact not found')
+        # Among artifacts with the same key, keep the first one listed
+        return all_artifacts[bisect.bisect_left(all_keys, all_keys[index])]
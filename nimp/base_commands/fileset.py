@@ -22,11 +22,15 @@
 
 ''' Fileset related commands '''
 
+import collections
+import concurrent.futures
 import hashlib
 import logging
 import os
 import shutil
+import time
 
+import nimp.artifacts
 import nimp.command
 import nimp.system
 
@@ -49,20 +53,77 @@ class FilesetCommand(nimp.command.Command):
     def _run_fileset(self, env, file_mapper):
         pass
 
+def _add_workers_argument(parser):
+    parser.add_argument('--workers', metavar = '<count>', type = int, default = None, help = 'number of files processed in parallel')
+
+
+def _map_in_parallel(action, all_arguments, workers):
+    ''' Runs an action on a worker pool while its arguments are produced,
+        yielding each argument with the result or exception of the action,
+        in order. Only a few actions per worker are pending at once. '''
+    workers = nimp.system.get_worker_count(workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        pending_actions = collections.deque()
+        for argument in all_arguments:
+            pending_actions.append((argument, executor.submit(action, argument)))
+            if len(pending_actions) > workers * 4:
+                yield _get_action_result(*pending_actions.popleft())
+        while pending_actions:
+            yield _get_action_result(*pending_actions.popleft())
+
+
+def _get_action_result(argument, future):
+    try:
+        return argument, future.result(), None
+    except OSError as exception:
+        return argument, None, exception
+
+
+def _move_file(source, destination):
+    # Renaming is atomic and fast on the same volume, shutil.move copies otherwise
+    try:
+        os.replace(source, destination)
+    except OSError:
+        if not os.path.lexists(source):
+            raise
+        if os.path.lexists(destination):
+            os.remove(destination)
+        shutil.move(source, destination)
+
+
+def _get_sources(file_mapper):
+    # Different rules may map the same file, so a source may be yielded more
+    # than once. Actions on sources ignore files already processed instead of
+    # keeping every source, so that memory doesn't grow with the fileset.
+    for source, _ in file_mapper.stream():
+        yield source
+
+
+def _list_fileset_files(env):
+    file_mapper = nimp.system.FileMapper(None, vars(env))
+    file_mapper.load_set(env.fileset)
+    return file_mapper.to_list(env.root_dir if file_mapper.root_based else '.', '.')
+
+
 class Fileset(nimp.command.CommandGroup):
     ''' Fileset related commands '''
     def __init__(self):
-        super().__init__([ _List(), _Delete(), _Stash(), _Unstash() ])
+        super().__init__([ _List(), _Delete(), _Stash(), _Unstash(), _Profile(), _Manifest(), _Diff() ])
 
     def is_available(self, env):
         return True, ''
 
 class _Delete(FilesetCommand):
     ''' Loads a fileset and delete mapped files '''
+    def configure_arguments(self, env, parser):
+        super().configure_arguments(env, parser)
+        _add_workers_argument(parser)
+        return True
+
     def _run_fileset(self, env, file_mapper):
-        for path, _ in file_mapper():
+        # Files are deleted while the fileset is still being walked
+        for path, _, _ in _map_in_parallel(nimp.system.safe_delete, _get_sources(file_mapper), env.workers):
             logging.info("Deleting %s", path)
-            nimp.system.safe_delete(path)
 
         return True
 
@@ -76,9 +137,7 @@ class _List(FilesetCommand):
         return True
 
     def run(self, env):
-        file_mapper = nimp.system.FileMapper(None, vars(env))
-        file_mapper.load_set(env.fileset)
-        all_files = file_mapper.to_list(env.root_dir if file_mapper.root_based else '.', '.')
+        all_files = _list_fileset_files(env)
 
         if env.destination:
             with open(env.destination, 'w') as export_file:
@@ -92,6 +151,11 @@ class _List(FilesetCommand):
 
 class _Stash(FilesetCommand):
     ''' Loads a fileset and moves files out of the way '''
+    def configure_arguments(self, env, parser):
+        super().configure_arguments(env, parser)
+        _add_workers_argument(parser)
+        return True
+
     def _run_fileset(self, env, file_mapper):
         stash_name = env.format('{fileset}-{platform}-{target}-{configuration}')
         stash_directory = env.format('{root_dir}/.nimp/stash/' + stash_name)
@@ -100,20 +164,46 @@ class _Stash(FilesetCommand):
             logging.info('Removing previous stash %s', stash_name)
             shutil.rmtree(stash_directory)
 
+        def _stash_file(src):
+            if not os.path.isfile(src):
+                return None
+            src_hash = hashlib.md5(src.encode('utf8')).hexdigest()
+            stash_path = os.path.join(stash_directory, src_hash)
+            try:
+                _move_file(src, stash_path)
+            except FileNotFoundError:
+                # The same file mapped twice may be stashed by another worker
+                if os.path.lexists(src) or not os.path.lexists(stash_path):
+                    raise
+                return None
+            return src_hash
+
         logging.info('Creating stash %s', stash_name)
         os.makedirs(stash_directory)
-        with open(os.path.join(stash_directory, '.stash.txt'), 'w') as stash_file:
-            for src, _ in file_mapper():
-                if os.path.isfile(src):
-                    src_hash = hashlib.md5(src.encode('utf8')).hexdigest()
+        # Files are listed as soon as they are moved, so that the stash can
+        # be applied even if stashing fails midway
+        success = True
+        with open(os.path.join(stash_directory, '.stash.txt'), 'w', buffering = 1024 * 1024) as stash_file:
+            for src, src_hash, exception in _map_in_parallel(_stash_file, _get_sources(file_mapper), env.workers):
+                if exception is not None:
+                    logging.error('Failed to stash %s: %s', src, exception)
+                    success = False
+                elif src_hash is not None:
                     logging.info('Stashing %s as %s', src, src_hash)
-                    shutil.move(src, os.path.join(stash_directory, src_hash))
                     stash_file.write('%s %s\n' % (src_hash, src))
 
+        if not success:
+            raise RuntimeError('Stash failed')
+
         return True
 
 class _Unstash(FilesetCommand):
     ''' Restores a stashed fileset; does not actually use the fileset '''
+    def configure_arguments(self, env, parser):
+        super().configure_arguments(env, parser)
+        _add_workers_argument(parser)
+        return True
+
     def _run_fileset(self, env, file_mapper):
         stash_name = env.format('{fileset}-{platform}-{target}-{configuration}')
         stash_directory = env.format('{root_dir}/.nimp/stash/' + stash_name)
@@ -121,26 +211,110 @@ class _Unstash(FilesetCommand):
         if not os.path.exists(stash_directory):
             raise RuntimeError('Stash {stash_name} does not exist'.format(**locals()))
 
+        def _unstash_file(entry):
+            md5, dst = entry
+            src = os.path.join(stash_directory, md5)
+            # The stash is kept when unstashing fails, files which were
+            # already restored are skipped when it is applied again
+            if not os.path.exists(src) and os.path.exists(dst):
+                return False
+            os.makedirs(os.path.dirname(dst), exist_ok = True)
+            _move_file(src, dst)
+            return True
+
         logging.info('Applying stash %s', stash_name)
         success = True
+        all_entries = []
         with open(os.path.join(stash_directory, '.stash.txt'), 'r') as stash_file:
-            for dst in stash_file.readlines():
-                try:
-                    md5, dst = dst.strip().split()
-                    src = os.path.join(stash_directory, md5)
-                    logging.info('Unstashing %s as %s', md5, dst)
-                    os.makedirs(os.path.dirname(dst), exist_ok = True)
-                    if os.path.exists(dst):
-                        os.remove(dst)
-                    shutil.move(src, dst)
-                except OSError as exception:
-                    logging.error(exception)
-                    success = False
+            # Paths may end with spaces, only the new line is removed
+            for line_index, line in enumerate(stash_file):
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                entry = line.split(' ', 1)
+                if len(entry) != 2 or not entry[1]:
+                    raise RuntimeError('Invalid entry in stash %s at line %d: %s' % (stash_name, line_index + 1, line))
+                all_entries.append(entry)
+
+        for (md5, dst), is_restored, exception in _map_in_parallel(_unstash_file, all_entries, env.workers):
+            if exception is not None:
+                logging.error('Failed to unstash %s as %s: %s', md5, dst, exception)
+                success = False
+            elif is_restored:
+                logging.info('Unstashing %s as %s', md5, dst)
+            else:
+                logging.info('%s was already unstashed as %s', md5, dst)
 
         if success is False:
-            raise RuntimeError('Unstash failed')
+            raise RuntimeError('Unstash failed, apply the stash again to resume')
 
         logging.info('Removing stash %s', stash_name)
         shutil.rmtree(stash_directory)
 
         return True
+
+class _Profile(FilesetCommand):
+    ''' Loads a fileset and reports the time spent in each of its rules '''
+    def _run_fileset(self, env, file_mapper):
+        start_time = time.perf_counter()
+        all_files, profile = file_mapper.profile()
+        total_time = time.perf_counter() - start_time
+
+        logging.info('%9s %9s %9s %9s  %s', 'Time', 'Files in', 'Files out', 'FS calls', 'Rule')
+        for depth, node, node_statistics in profile.get_tree(file_mapper):
+            logging.info('%8.3fs %9d %9d %9d  %s%s', node_statistics.time, node_statistics.input_count,
+                         node_statistics.output_count, node_statistics.file_system_call_count, '  ' * depth, node.get_description())
+            for pattern, glob_path in node_statistics.all_unmatched_patterns:
+                logging.info('%40s  %sNo match for “%s” (aka. “%s”)', '', '  ' * (depth + 1), pattern, glob_path)
+        logging.info('Resolved %d files in %.3fs', len(all_files), total_time)
+
+        return True
+
+class _Manifest(FilesetCommand):
+    ''' Writes the size, modification time and optionally hash of the files
+        of a fileset to a JSON lines manifest '''
+    def configure_arguments(self, env, parser):
+        super().configure_arguments(env, parser)
+        parser.add_argument('manifest', metavar = '<manifest>', help = 'path of the manifest to write')
+        parser.add_argument('--hash', metavar = '<method>', default = None, help = 'hash files (any hashlib algorithm, or xxh64, xxh3_128... if xxhash is installed)')
+        parser.add_argument('--previous', metavar = '<manifest>', default = None, help = 'reuse hashes of files whose size and modification time did not change since this manifest')
+        _add_workers_argument(parser)
+        return True
+
+    def run(self, env):
+        if env.hash is not None and not nimp.artifacts.is_hash_method_available(env.hash):
+            logging.error('Unsupported hash method: %s', env.hash)
+            return False
+
+        previous_manifest = nimp.artifacts.load_fileset_manifest(env.previous) if env.previous else None
+        manifest = nimp.artifacts.create_fileset_manifest(_list_fileset_files(env), env.hash, previous_manifest, env.workers)
+        nimp.artifacts.save_fileset_manifest(env.manifest, manifest)
+        logging.info('Wrote %d files to %s', len(manifest['files']), env.manifest)
+
+        return True
+
+class _Diff(FilesetCommand):
+    ''' Compares a manifest with the files of a fileset, or with another manifest '''
+    def configure_arguments(self, env, parser):
+        super().configure_arguments(env, parser)
+        parser.add_argument('manifest', metavar = '<manifest>', help = 'manifest to compare from')
+        parser.add_argument('--against', metavar = '<manifest>', default = None, help = 'compare with this manifest instead of the files of the fileset')
+        _add_workers_argument(parser)
+        return True
+
+    def run(self, env):
+        previous_manifest = nimp.artifacts.load_fileset_manifest(env.manifest)
+        if env.against:
+            manifest = nimp.artifacts.load_fileset_manifest(env.against)
+        else:
+            # Only files whose size or modification time changed are hashed again
+            manifest = nimp.artifacts.create_fileset_manifest(_list_fileset_files(env), previous_manifest['hash_method'],
+                                                              previous_manifest, env.workers)
+
+        all_added_paths, all_modified_paths, all_removed_paths = nimp.artifacts.diff_fileset_manifests(previous_manifest, manifest)
+        for status, all_paths in [ ('A', all_added_paths), ('M', all_modified_paths), ('D', all_removed_paths) ]:
+            for path in all_paths:
+                logging.info('%s %s', status, path)
+        logging.info('%d added, %d modified, %d removed', len(all_added_paths), len(all_modified_paths), len(all_removed_paths))
+
+        return True
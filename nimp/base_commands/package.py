@@ -138,6 +138,7 @@ class UnrealPackageConfiguration():
         self.no_compile_packaging = False
 
         self.msixvc = False
+        self.package_workers = 1
         self.ps4_title_collection = []
         self.xbox_product_id = None
         self.xbox_content_id = None
@@ -166,6 +167,7 @@ class Package(nimp.command.Command):
         parser.add_argument('--msixvc', action = 'store_true', help = 'create a MSIXVC package')
         parser.add_argument('--ps4-regions', metavar = '<region>', nargs = '+', help = 'set the PS4 regions to package for')
         parser.add_argument('--dlc', action = 'store_true', help = 'package as a DLC (necessary on PS5)')
+        parser.add_argument('--workers', metavar = '<count>', type = int, default = 1, help = 'number of PS4 packages created or verified in parallel')
 
         #region Legacy
         parser.add_argument('--layout', metavar = '<file_path>', help = '(deprecated) set the layout file to use for the package (for consoles)')
@@ -236,6 +238,7 @@ class Package(nimp.command.Command):
         package_configuration.is_nintendo = env.is_nintendo_platform
         package_configuration.is_final_submission = env.final
         package_configuration.msixvc = env.msixvc or env.platform == 'xboxone'
+        package_configuration.package_workers = env.workers
 
         package_configuration.package_tool_path = platform_desc.package_tool_path
         package_configuration.layout_file_extension = env.layout_file_extension
@@ -311,19 +314,23 @@ class Package(nimp.command.Command):
         with Package.configure_variant(env, package_configuration.project_directory):
             if 'cook' in env.steps:
                 logging.info('=== Cook ===')
-                Package.cook(env, package_configuration)
+                with nimp.sys.process.trace_step('cook'):
+                    Package.cook(env, package_configuration)
                 logging.info('')
             if 'stage' in env.steps:
                 logging.info('=== Stage ===')
-                Package.stage(env, package_configuration)
+                with nimp.sys.process.trace_step('stage'):
+                    Package.stage(env, package_configuration)
                 logging.info('')
             if 'package' in env.steps:
                 logging.info('=== Package ===')
-                Package.package_for_platform(env, package_configuration)
+                with nimp.sys.process.trace_step('package'):
+                    Package.package_for_platform(env, package_configuration)
                 logging.info('')
             if 'verify' in env.steps:
                 logging.info('=== Verify ===')
-                Package.verify(env, package_configuration)
+                with nimp.sys.process.trace_step('verify'):
+                    Package.verify(env, package_configuration)
                 logging.info('')
 
         return True
@@ -1058,36 +1065,48 @@ class Package(nimp.command.Command):
         source = package_configuration.stage_directory
         package_tool_path = package_configuration.package_tool_path
 
-        for title_data in package_configuration.ps4_title_collection:
-            for binary_configuration in package_configuration.binary_configuration.split('+'):
-                destination = title_data['region'] + '-' + binary_configuration + ('-Final' if package_configuration.is_final_submission else '')
-                destination = package_configuration.package_directory + '/' + destination
-                layout_file = source + '/' + package_configuration.project + '-' + title_data['region'] + '-' + binary_configuration + '.' + package_configuration.layout_file_extension
-                output_format = 'pkg'
-                if package_configuration.is_final_submission:
-                    if package_configuration.package_type == 'application' and title_data['storagetype'].startswith('bd'):
-                        output_format += '+iso'
-                    output_format += '+subitem'
-
+        # Packages of each region and configuration are independent, but
+        # packaging stops at the first failure
+        with nimp.sys.process.JobPool(package_configuration.package_workers, stop_on_failure = True) as job_pool:
+            for title_data in package_configuration.ps4_title_collection:
+                for binary_configuration in package_configuration.binary_configuration.split('+'):
+                    destination = title_data['region'] + '-' + binary_configuration + ('-Final' if package_configuration.is_final_submission else '')
+                    destination = package_configuration.package_directory + '/' + destination
+                    layout_file = source + '/' + package_configuration.project + '-' + title_data['region'] + '-' + binary_configuration + '.' + package_configuration.layout_file_extension
+                    output_format = 'pkg'
+                    if package_configuration.is_final_submission:
+                        if package_configuration.package_type == 'application' and title_data['storagetype'].startswith('bd'):
+                            output_format += '+iso'
+                        output_format += '+subitem'
+
+                    job_pool.submit(os.path.basename(destination), Package._create_sony_package,
+                                    package_tool_path, layout_file, destination, output_format, dry_run)
+
+            if not all(job_pool.wait()):
+                raise RuntimeError('Package generation failed')
 
-                _try_remove(destination, dry_run)
-                _try_remove(destination + '-Temporary', dry_run)
-                _try_create_directory(destination, dry_run)
-                _try_create_directory(destination + '-Temporary', dry_run)
 
-                create_package_command = [
-                    package_tool_path, 'img_create',
-                    '--no_progress_bar',
-                    '--tmp_path', destination + '-Temporary',
-                    '--oformat', output_format,
-                    layout_file, destination
-                ]
+    @staticmethod
+    def _create_sony_package(package_tool_path, layout_file, destination, output_format, dry_run):
+        _try_remove(destination, dry_run)
+        _try_remove(destination + '-Temporary', dry_run)
+        _try_create_directory(destination, dry_run)
+        _try_create_directory(destination + '-Temporary', dry_run)
+
+        create_package_command = [
+            package_tool_path, 'img_create',
+            '--no_progress_bar',
+            '--tmp_path', destination + '-Temporary',
+            '--oformat', output_format,
+            layout_file, destination
+        ]
 
-                package_success = nimp.sys.process.call(create_package_command, dry_run = dry_run)
-                if package_success != 0:
-                    raise RuntimeError('Package generation failed')
+        package_success = nimp.sys.process.call(create_package_command, dry_run = dry_run)
+        if package_success != 0:
+            return False
 
-                _try_remove(destination + '-Temporary', dry_run)
+        _try_remove(destination + '-Temporary', dry_run)
+        return True
 
 
     @staticmethod
@@ -1205,27 +1224,35 @@ class Package(nimp.command.Command):
     def verify_for_ps4(package_configuration, dry_run):
         package_tool_path = package_configuration.package_tool_path
 
-        for title_data in package_configuration.ps4_title_collection:
-            for binary_configuration in package_configuration.binary_configuration.split('+'):
-                directory = title_data['region'] + '-' + binary_configuration + ('-Final' if package_configuration.is_final_submission else '')
-                directory = package_configuration.package_directory + '/' + directory
+        # Packages of each region and configuration are independent
+        with nimp.sys.process.JobPool(package_configuration.package_workers) as job_pool:
+            for title_data in package_configuration.ps4_title_collection:
+                for binary_configuration in package_configuration.binary_configuration.split('+'):
+                    directory = title_data['region'] + '-' + binary_configuration + ('-Final' if package_configuration.is_final_submission else '')
+                    directory = package_configuration.package_directory + '/' + directory
+                    job_pool.submit(os.path.basename(directory), Package._verify_sony_package,
+                                    package_tool_path, directory, title_data['title_passcode'], dry_run)
+            job_pool.wait()
 
-                _try_remove(directory + '-Temporary', dry_run)
-                _try_create_directory(directory + '-Temporary', dry_run)
 
-                validate_package_command = [
-                    package_tool_path, 'img_verify',
-                    '--no_progress_bar',
-                    '--tmp_path', directory + '-Temporary',
-                    '--passcode', title_data['title_passcode'],
-                ]
-                validate_package_command += [ path.replace('\\', '/') for path in glob.glob(directory + '/*.pkg') ]
+    @staticmethod
+    def _verify_sony_package(package_tool_path, directory, title_passcode, dry_run):
+        _try_remove(directory + '-Temporary', dry_run)
+        _try_create_directory(directory + '-Temporary', dry_run)
+
+        validate_package_command = [
+            package_tool_path, 'img_verify',
+            '--no_progress_bar',
+            '--tmp_path', directory + '-Temporary',
+            '--passcode', title_passcode,
+        ]
+        validate_package_command += [ path.replace('\\', '/') for path in glob.glob(directory + '/*.pkg') ]
 
-                validation_success = nimp.sys.process.call(validate_package_command, dry_run = dry_run)
-                if validation_success != 0:
-                    logging.warning('Package validation failed')
+        validation_success = nimp.sys.process.call(validate_package_command, dry_run = dry_run)
+        if validation_success != 0:
+            logging.warning('Package validation failed')
 
-                _try_remove(directory + '-Temporary', dry_run)
+        _try_remove(directory + '-Temporary', dry_run)
 
 
     @staticmethod
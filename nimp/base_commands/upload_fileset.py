@@ -29,6 +29,7 @@ import zipfile
 
 import nimp.command
 import nimp.artifacts
+import nimp.utils.git
 
 
 def _try_remove(file_path, dry_run):
@@ -49,9 +50,12 @@ class UploadFileset(nimp.command.Command):
         nimp.command.add_common_arguments(parser, 'dry_run', 'revision', 'slice_job', 'free_parameters')
         parser.add_argument('--archive', action = 'store_true', help = 'upload the files as a zip archive')
         parser.add_argument('--compress', action = 'store_true', help = 'if uploading as an archive, compress it')
+        parser.add_argument('--deduplicate', action = 'store_true', help = 'upload the files to the content-addressed blob store with a manifest')
         parser.add_argument('--torrent', action = 'store_true', help = 'create a torrent for the uploaded fileset')
-        parser.add_argument('--hash', metavar = '<hashlib>', default = None, help = 'create a hash for the uploaded fs')
+        parser.add_argument('--hash', metavar = '<method>', default = None, help = 'create a hash for the uploaded fs (any hashlib algorithm, or xxh64, xxh3_128... if xxhash is installed)')
         parser.add_argument('--force', action = 'store_true', help = 'if the artifact already exists, overwrite it')
+        parser.add_argument('--workers', metavar = '<count>', type = int, default = None, help = 'number of files copied or compressed in parallel')
+        parser.add_argument('--stream', action = 'store_true', help = 'start uploading files while the fileset is walked, in walk order instead of sorted')
         parser.add_argument('fileset', metavar = '<fileset>', help = 'fileset to upload')
         return True
 
@@ -63,42 +67,94 @@ class UploadFileset(nimp.command.Command):
             logging.error('Failed to import BitTornado module (required for torrent option)')
             return False
 
-        if env.torrent and not hasattr(env, 'torrent_tracker_announce'):
+        if env.hash is not None and not nimp.artifacts.is_hash_method_available(env.hash):
+            logging.error('Unsupported hash method: %s', env.hash)
+            return False
+
+        if not hasattr(env, 'torrent_tracker_announce'):
             env.torrent_tracker_announce = None
 
-        artifact_path = f'{env.artifact_repository_destination}/{env.artifact_collection[env.fileset]}'
+        if env.deduplicate and (env.archive or env.torrent):
+            logging.error('Deduplicated filesets cannot be uploaded as an archive or a torrent')
+            return False
+
+        collection_artifact_path = f'{env.artifact_repository_destination}/{env.artifact_collection[env.fileset]}'
+        artifact_path = collection_artifact_path
         if env.slice_job_index and env.slice_job_count:
             artifact_path = f'{artifact_path}/slice-{env.slice_job_index}-of-{env.slice_job_count}'
         artifact_path = nimp.system.sanitize_path(env.format(artifact_path))
+        collection_artifact_path = nimp.system.sanitize_path(env.format(collection_artifact_path))
 
-        if os.path.isfile(artifact_path + '.zip') or os.path.isdir(artifact_path):
+        if os.path.isfile(artifact_path + '.zip') or os.path.isfile(artifact_path + '.manifest') or os.path.isdir(artifact_path):
             if not env.force:
                 raise ValueError('Artifact already exists: %s' % artifact_path)
             else:
                 _try_remove(artifact_path + '.torrent', env.dry_run)
                 _try_remove(artifact_path + '.zip', env.dry_run)
+                _try_remove(artifact_path + '.manifest', env.dry_run)
                 _try_remove(artifact_path, env.dry_run)
 
+        blob_store = None
+        if env.deduplicate:
+            blob_store = getattr(env, 'artifact_blob_store', None) or f'{env.artifact_repository_destination}/blobs'
+            blob_store = nimp.system.sanitize_path(env.format(blob_store))
+
         logging.info('Listing files for %s', artifact_path)
         file_mapper = nimp.system.FileMapper(None, vars(env))
         file_mapper.load_set(env.fileset)
-        all_files = file_mapper.to_list(env.root_dir if file_mapper.root_based else '.', '.')
-
-        if not all_files:
-            raise RuntimeError('Found no files to upload')
+        mapper_source = env.root_dir if file_mapper.root_based else '.'
+        all_files = None
+        if env.stream:
+            if next(UploadFileset._stream_files(file_mapper, mapper_source), None) is None:
+                raise RuntimeError('Found no files to upload')
+        else:
+            all_files = file_mapper.to_list(mapper_source, '.')
+            if not all_files:
+                raise RuntimeError('Found no files to upload')
+
+        def _get_all_files():
+            # Each attempt walks the fileset again, as its files are consumed while uploading
+            if all_files is None:
+                return UploadFileset._stream_files(file_mapper, mapper_source)
+            return all_files
 
         logging.info('Uploading to %s', artifact_path)
+        if env.hash is not None:
+            logging.info(f'Creating hash for {artifact_path}')
         if not env.dry_run:
             os.makedirs(os.path.dirname(artifact_path), exist_ok = True)
-        nimp.system.try_execute(
-            lambda: nimp.artifacts.create_artifact(artifact_path, all_files,
-                                                   env.archive, env.compress, env.dry_run),
-            (OSError, ValueError, zipfile.BadZipFile))
         if env.torrent:
             logging.info('Creating torrent for %s', artifact_path)
-            nimp.system.try_execute(lambda: nimp.artifacts.create_torrent(artifact_path, env.torrent_tracker_announce, env.dry_run), OSError)
-        if env.hash is not None:
-            logging.info(f'Creating hash for {artifact_path}')
-            nimp.artifacts.create_hash(artifact_path, env.hash, env.dry_run)
+        # The artifact is hashed while it is written, rather than read back afterwards
+        file_hash = nimp.system.try_execute(
+            lambda: nimp.artifacts.create_artifact(artifact_path, _get_all_files(),
+                                                   env.archive, env.compress, env.dry_run,
+                                                   env.workers, blob_store, env.hash,
+                                                   env.torrent, env.torrent_tracker_announce),
+            (OSError, ValueError, zipfile.BadZipFile))
+
+        if env.revision and not env.dry_run:
+            UploadFileset._register_artifact(env, artifact_path, collection_artifact_path, file_hash)
 
         return True
+
+    @staticmethod
+    def _stream_files(file_mapper, mapper_source):
+        # Files mapped by several rules are repeated, artifacts only add them once
+        default_result = (nimp.system.standardize_path(mapper_source), '.')
+        for source, destination in file_mapper.stream(mapper_source, '.'):
+            file = (nimp.system.standardize_path(source), nimp.system.standardize_path(destination))
+            if file != default_result:
+                yield file
+
+    @staticmethod
+    def _register_artifact(env, artifact_path, collection_artifact_path, file_hash):
+        # All slices of a job register the same artifact, the catalog keeps the last one
+        if artifact_path != collection_artifact_path:
+            file_hash = None
+        timestamp = None
+        api_context = nimp.utils.git.initialize_gitea_api_context(env)
+        if api_context:
+            timestamp = nimp.utils.git.get_gitea_commit_timestamp(api_context, env.revision)
+        logging.info('Adding %s to the artifact catalog', collection_artifact_path)
+        nimp.system.try_execute(lambda: nimp.artifacts.register_artifact(collection_artifact_path, env.revision, timestamp, file_hash), OSError)
@@ -41,7 +41,12 @@ def _try_excecute(command, cwd='.', capture_output=True, max_attemtps=5, delay=5
     while attempt <= max_attemtps:
         retry = False
         start_time = time.time()
-        result, output, err = nimp.sys.process.call(command, cwd=cwd, capture_output=True)
+        # Only failure markers are looked for, the output of builds is too large to be kept
+        output = nimp.sys.process.OutputSearch("Cannot run if when setup is in progress.",
+                                               "ERROR: Unhandled exception: System.", ":\\autoSDK\\HostWin64\\",
+                                               "Package 'RoslynPackage' failed to load",
+                                               "Package 'Visual Studio Build Manager Package' failed to load")
+        result = nimp.sys.process.call(command, cwd=cwd, output_callback=output)
         time_passed = time.time() - start_time
 
         if result != 0:
@@ -411,6 +416,8 @@ def upload_symbols(env, symbols, config, two_tier_mode=True):
         ('ZIP', zip_compression_symbols),
     ]
 
+    # Batches are not uploaded in parallel: symstore doesn't support
+    # concurrent transactions on the same store, which share its 000Admin files
     for (compression_type, symbols_list) in compressed_symbols_list:
         if not symbols_list:
             continue
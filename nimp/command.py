@@ -25,7 +25,6 @@
 import abc
 import logging
 import os
-import pkg_resources
 import re
 import sys
 import argparse
@@ -33,7 +32,7 @@ import argparse
 import nimp.base_commands
 import nimp.command
 
-from nimp.utils.python import get_class_instances
+from nimp.utils.python import get_class_instances, get_plugin_entry_points
 
 class Command(metaclass=abc.ABCMeta):
     ''' Abstract class for commands '''
@@ -137,7 +136,7 @@ def discover(env):
         pass
 
     # Import commands from plugins
-    for entry_point in pkg_resources.iter_entry_points('nimp.plugins'):
+    for entry_point in get_plugin_entry_points():
         try:
             module = entry_point.load()
             get_class_instances(module, nimp.command.Command, all_commands)
@@ -28,7 +28,6 @@ import re
 import inspect
 import logging
 import os
-import pkg_resources
 import sys
 import time
 import glob
@@ -41,6 +40,7 @@ import nimp.sys.platform
 import nimp.system
 import nimp.unreal
 import nimp.utils.profiling
+import nimp.utils.python
 
 
 _LOG_FORMATS = { # pylint: disable = invalid-name
@@ -104,6 +104,16 @@ class Environment:
                                      help='Profile nimp command',
                                      action='store_true')
 
+        profiling_group.add_argument('--process-trace',
+                                     help='Record the time, CPU and memory used by each child process as JSON lines, next to the log file',
+                                     action='store_true')
+
+        profiling_group.add_argument('--process-trace-file',
+                                     metavar='<file>',
+                                     help='Record the process trace to this file instead',
+                                     type=str,
+                                     default=None)
+
         nimp.command.add_commands_subparser(self.command_list, parser, self)
 
         return parser
@@ -238,7 +248,7 @@ class Environment:
                 success = True
             else:
                 try:
-                    with nimp.utils.profiling.nimp_profile(self):
+                    with nimp.utils.profiling.nimp_profile(self), nimp.utils.profiling.process_trace(self):
                         success = self.command.run(self)
                         if not success:
                             raise NimpCommandFailed("Nimp command failed.")
@@ -398,8 +408,8 @@ def execute_hook(hook_name, *args):
     # Always look for project level hook first
     hook_module = nimp.system.try_import('hooks.' + hook_name)
     if hook_module is None: # If none found, try plugins level
-        for entry in pkg_resources.iter_entry_points('nimp.plugins'):
-            hook_module = nimp.system.try_import(entry.module_name + '.hooks.' + hook_name)
+        for entry in nimp.utils.python.get_plugin_entry_points():
+            hook_module = nimp.system.try_import(nimp.utils.python.get_entry_point_module_name(entry) + '.hooks.' + hook_name)
             if hook_module:
                 break
     if hook_module is None:
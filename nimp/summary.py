@@ -29,6 +29,7 @@ from logging.handlers import WatchedFileHandler
 import os
 import re
 import sys
+import unicodedata
 
 class SummaryHandler(logging.Handler):
     """ Base class for summary handler.
@@ -43,10 +44,10 @@ class SummaryHandler(logging.Handler):
             self.log_all_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
 
         self._env = env
-        self._ignore_patterns = []
-        self._error_patterns = []
-        self._warning_patterns = []
-        self._context_patterns = []
+        self._ignore_patterns = _PatternList()
+        self._error_patterns = _PatternList()
+        self._warning_patterns = _PatternList()
+        self._context_patterns = _PatternList()
         self._summary = {'errors': [], 'warnings': []}
 
         error_patterns = [
@@ -175,10 +176,9 @@ class SummaryHandler(logging.Handler):
     def emit(self, record):
         msg = record.getMessage()
 
-        for pattern in self._ignore_patterns:
-            if pattern.match(msg):
-                self._add_notif(msg)
-                return
+        if self._ignore_patterns.match(msg):
+            self._add_notif(msg)
+            return
 
         if record.levelno == logging.CRITICAL or record.levelno == logging.ERROR:
             self._add_msg('error', self.format(record))
@@ -192,14 +192,13 @@ class SummaryHandler(logging.Handler):
         self._match_message(self._warning_patterns, msg, 'warning')
 
     def _match_message(self, patterns, msg, notif_lvl):
-        for pattern in patterns:
-            match = pattern.match(msg)
-            if match is not None:
-                group_dict = match.groupdict()
-                if 'message' in group_dict:
-                    msg = group_dict['message']
-                self._add_msg(notif_lvl, msg)
-                return True
+        match = patterns.match(msg)
+        if match is not None:
+            group_dict = match.groupdict()
+            if 'message' in group_dict:
+                msg = group_dict['message']
+            self._add_msg(notif_lvl, msg)
+            return True
         return False
 
     def _add_notif(self, msg):
@@ -212,6 +211,124 @@ class SummaryHandler(logging.Handler):
         pass
 
 
+class _PatternList():
+    ''' Compiled patterns tried in order on each message. Most patterns can
+        only match messages containing some literal text, which is searched
+        for first, as it is much cheaper than a failing match. '''
+    def __init__(self):
+        self._all_patterns = []
+
+    def __iter__(self):
+        return (pattern for _, pattern in self._all_patterns)
+
+    def __len__(self):
+        return len(self._all_patterns)
+
+    def append(self, pattern):
+        ''' Adds a pattern, tried after the ones already added '''
+        self._all_patterns.append((_get_required_literal(pattern), pattern))
+
+    def match(self, msg):
+        ''' Returns the match of the first pattern matching the start of a
+            message, or None '''
+        for literal, pattern in self._all_patterns:
+            if literal is None or literal in msg:
+                match = pattern.match(msg)
+                if match is not None:
+                    return match
+        return None
+
+    def all_matches(self, msg):
+        ''' Yields the matches of all the patterns matching the start of a
+            message, in order '''
+        for literal, pattern in self._all_patterns:
+            if literal is None or literal in msg:
+                match = pattern.match(msg)
+                if match is not None:
+                    yield match
+
+
+def _get_required_literal(pattern):
+    ''' Returns the longest text any match of a pattern must contain, from
+        the characters it matches literally outside groups, classes and
+        repetitions, or None if there is none '''
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE) or not isinstance(pattern.pattern, str):
+        return None
+
+    text = pattern.pattern
+    required_literal = ''
+    literal = []
+    depth = 0
+    index = 0
+    while index < len(text):
+        character = text[index]
+        index += 1
+        if character == '\\':
+            escape = _ESCAPE_PATTERN.match(text, index - 1)
+            escaped = _get_escaped_character(escape.group(1))
+            index = escape.end()
+            if depth == 0 and escaped is not None:
+                literal.append(escaped)
+                continue
+        elif character == '[':
+            index = _skip_character_class(text, index)
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif character == '|' and depth == 0:
+            return None
+        elif character in '*?{' and depth == 0:
+            # The repeated character may not be matched at all
+            quantifier = _QUANTIFIER_PATTERN.match(text, index - 1)
+            if character == '{' and quantifier is None:
+                required_literal = max(required_literal, ''.join(literal), key = len)
+                literal = []
+                continue
+            if quantifier is not None:
+                index = quantifier.end()
+            literal = literal[:-1]
+        elif depth == 0 and character not in '.^$+}':
+            literal.append(character)
+            continue
+        required_literal = max(required_literal, ''.join(literal), key = len)
+        literal = []
+    required_literal = max(required_literal, ''.join(literal), key = len)
+    return required_literal or None
+
+
+def _get_escaped_character(escaped):
+    ''' Returns the character an escape sequence matches literally, or None
+        for classes, anchors and references '''
+    if escaped[0] in 'xuU':
+        return chr(int(escaped[1:], 16))
+    if escaped[0] == 'N':
+        return unicodedata.lookup(escaped[2:-1])
+    if escaped[0] == '0' or len(escaped) == 3:
+        return chr(int(escaped, 8))
+    if not escaped.isalnum():
+        return escaped
+    return _ESCAPED_CHARACTERS.get(escaped)
+
+
+def _skip_character_class(text, index):
+    ''' Returns the index following the end of a character class starting
+        just before the given index '''
+    if text[index:index + 1] == '^':
+        index += 1
+    if text[index:index + 1] == ']':
+        index += 1
+    while index < len(text) and text[index] != ']':
+        index += 2 if text[index] == '\\' else 1
+    return index + 1
+
+
+_ESCAPED_CHARACTERS = { 'a': '\a', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v' }
+# Numeric escapes are listed before back-references, which they may start like
+_ESCAPE_PATTERN = re.compile(r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}|[0-3][0-7]{2}|0[0-7]?|[1-9][0-9]?|.)', re.DOTALL)
+_QUANTIFIER_PATTERN = re.compile(r'(?:[*?]|\{\d*(?:,\d*)?\})')
+
+
 class DefaultSummaryHandler(SummaryHandler):
     """ Default summary handler, showing one line by error / warning and
     adding three lines of context before / after errors """
@@ -220,13 +337,11 @@ class DefaultSummaryHandler(SummaryHandler):
         self._context = collections.deque([], 4)
 
     def _add_notif(self, msg):
-        for pattern in self._context_patterns:
-            match = pattern.match(msg)
-            if match is not None:
-                group_dict = match.groupdict()
-                if 'message' in group_dict:
-                    msg = group_dict['message']
-                    break
+        for match in self._context_patterns.all_matches(msg):
+            group_dict = match.groupdict()
+            if 'message' in group_dict:
+                msg = group_dict['message']
+                break
         self._context.append(msg)
 
     def _add_msg(self, notif_lvl, msg):
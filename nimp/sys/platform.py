@@ -4,11 +4,10 @@
 import abc
 import logging
 import platform
-import pkg_resources
 
 import nimp.base_platforms
 
-from nimp.utils.python import get_class_instances
+from nimp.utils.python import get_class_instances, get_plugin_entry_points
 
 _all_platforms = {}
 _all_aliases = {}
@@ -76,7 +75,7 @@ def discover(env):
     tmp = {}
     get_class_instances(nimp.base_platforms, Platform, tmp, instance_args=[env])
 
-    for e in pkg_resources.iter_entry_points('nimp.plugins'):
+    for e in get_plugin_entry_points():
         try:
             module = e.load()
             get_class_instances(module, Platform, tmp, instance_args=[env])
@@ -22,13 +22,20 @@
 
 ''' Process-related system utilities '''
 
+import concurrent.futures
+import contextlib
 import ctypes
 import logging
+import logging.handlers
+import json
 import locale
 import os
 import os.path
+import selectors
 import struct
 import subprocess
+import sys
+import tempfile
 import threading
 import time
 
@@ -37,11 +44,18 @@ import nimp.sys.platform
 
 def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
          capture_output=False, capture_debug=False, hide_output=False,
-         dry_run=False, timeout=None):
-    ''' Calls a process redirecting its output to nimp's output '''
+         dry_run=False, timeout=None, output_callback=None):
+    ''' Calls a process redirecting its output to nimp's output. Captured
+        output is kept in a temporary file past a few megabytes. To search
+        the output without capturing it, output_callback is called with the
+        decoded standard output, a chunk of whole lines at a time. While a
+        ProcessTrace is active, the resources used by the process are
+        recorded in it. '''
     command = _sanitize_command(command)
+    job_tag = getattr(_job_context, 'tag', None)
+    job_prefix = '[%s] ' % job_tag if job_tag else ''
     if not hide_output:
-        logging.info('%s "%s" in "%s"', '[DRY-RUN]' if dry_run else 'Running',' '.join(command), os.path.abspath(cwd))
+        logging.info('%s%s "%s" in "%s"', job_prefix, '[DRY-RUN]' if dry_run else 'Running',' '.join(command), os.path.abspath(cwd))
 
     if dry_run:
         return 0
@@ -52,6 +66,9 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
     else:
         debug_pipe = None
 
+    trace = _active_trace
+    start_time, start_counter = time.time(), time.perf_counter()
+
     # The bufsize = -1 is important; if we don’t bufferise the output, we’re
     # going to make the callee lag a lot. In Python 3.3.1 this is now the
     # default behaviour, but it used to default to 0.
@@ -75,70 +92,69 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
                   process.stderr,
                   debug_pipe.output if debug_pipe else None ]
 
-    all_captures = [ [] if capture_output else None,
-                     [] if capture_output else None,
-                     None ]
+    sink = _LogSink(logging.getLogger('child_processes'), job_tag) if not hide_output else None
+    all_streams = [ _OutputStream(encoding, sink, capture_output, output_callback),
+                    _OutputStream(encoding, sink, capture_output),
+                    _OutputStream(encoding, sink, False) ]
 
     debug_info = [ False ]
+    process_ended = threading.Event()
 
     def _heartbeat_worker(heartbeat):
-        last_time = time.monotonic()
-        while process is not None:
-            if heartbeat > 0 and time.monotonic() > last_time + heartbeat:
-                logging.info("Keepalive for %s", command[0])
-                last_time += heartbeat
-            time.sleep(0.050)
+        while not process_ended.wait(heartbeat):
+            logging.info("%sKeepalive for %s", job_prefix, command[0])
 
     def _input_worker(in_pipe, data):
         in_pipe.write(data)
         in_pipe.close()
 
-    def _output_worker(index, decoding_format):
+    def _output_worker():
+        # A single thread waits for data on all pipes, and reads whatever
+        # is available in one go
+        with selectors.DefaultSelector() as selector:
+            for index, in_pipe in enumerate(all_pipes):
+                if in_pipe is not None:
+                    selector.register(in_pipe, selectors.EVENT_READ, index)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, _OUTPUT_READ_SIZE)
+                    if data:
+                        all_streams[key.data].write(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        all_streams[key.data].close()
+
+    def _pipe_output_worker(index):
+        # Pipes can't be waited on with selectors on Windows, so each one is
+        # read by its own thread, blocking until data is available
         in_pipe = all_pipes[index]
-        capture_array = all_captures[index]
         if in_pipe is None:
             return
-        force_ascii = locale.getpreferredencoding().lower() != 'utf-8'
-        while process is not None:
-            logger = logging.getLogger('child_processes')
-            # Try to decode as UTF-8 with BOM first; if it fails, try CP850 on
-            # Windows, or UTF-8 with BOM and error substitution elsewhere. If
-            # it fails again, try CP850 with error substitution.
-            encodings = [
-                (decoding_format, 'strict'),
-                ('ascii', 'backslashreplace') if force_ascii else ('utf-8-sig', 'strict'),
-                ('cp850', 'strict') if nimp.sys.platform.is_windows() else ('utf-8-sig', 'replace'),
-                ('cp850', 'replace')
-            ]
-            for data in iter(in_pipe.readline, b''):
-                for encoding, errors in encodings:
-                    try:
-                        line = data.decode(encoding, errors=errors)
-                        break
-                    except UnicodeError:
-                        pass
-
-                if capture_array is not None:
-                    capture_array.append(line)
-
-                # Stop reading data from stdout if data has arrived on OutputDebugString
-                if index == 2:
-                    debug_info[0] = True
-                elif index == 0 and debug_info[0]:
-                    logging.info('Stopping stdout monitoring (OutputDebugString is active)')
-                    all_pipes[0].close()
-                    return
-
-                if not hide_output:
-                    logger.info(line.strip('\n').strip('\r'))
-
-            # Sleep for 10 milliseconds if there was no data,
-            # or we’ll hog the CPU.
-            time.sleep(0.010)
-
+        while True:
+            try:
+                data = os.read(in_pipe.fileno(), _OUTPUT_READ_SIZE)
+            except (OSError, ValueError):
+                # The OutputDebugString pipe is closed once the process ended
+                break
+            if not data:
+                break
+
+            # Stop reading data from stdout if data has arrived on OutputDebugString
+            if index == 2:
+                debug_info[0] = True
+            elif index == 0 and debug_info[0]:
+                logging.info('Stopping stdout monitoring (OutputDebugString is active)')
+                all_pipes[0].close()
+                return
+
+            all_streams[index].write(data)
+        all_streams[index].close()
 
     # Default threads
-    all_workers = [threading.Thread(target=_output_worker, args=(i, encoding)) for i in range(3)]
+    if nimp.sys.platform.is_windows():
+        all_workers = [threading.Thread(target=_pipe_output_worker, args=(i, )) for i in range(3)]
+    else:
+        all_workers = [threading.Thread(target=_output_worker)]
 
     # Thread to feed stdin data if necessary
     if stdin is not None:
@@ -152,9 +168,9 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
         thread.start()
 
     try:
-        exit_code = process.wait(timeout)
+        exit_code, usage = _wait_process(process, timeout, trace is not None)
     finally:
-        process = None
+        process_ended.set()
         # For some reason, must be done _before_ threads are joined, or
         # we get stuck waiting for something!
         if debug_pipe:
@@ -163,14 +179,367 @@ def call(command, cwd='.', heartbeat=0, stdin=None, encoding='utf-8',
         for thread in all_workers:
             thread.join()
 
+    if trace is not None:
+        trace.record(command, cwd, job_tag, process.pid, start_time, time.perf_counter() - start_counter,
+                     exit_code, usage, all_streams[0].byte_count, all_streams[1].byte_count)
+
     if not hide_output:
-        logging.info('Finished with exit code %d (0x%08x)', exit_code, exit_code)
+        logging.info('%sFinished with exit code %d (0x%08x)', job_prefix, exit_code, exit_code)
 
     if capture_output:
-        return exit_code, ''.join(all_captures[0]), ''.join(all_captures[1])
+        return exit_code, all_streams[0].get_captured_output(), all_streams[1].get_captured_output()
     return exit_code
 
 
+def call_all(all_commands, workers=None, **kwargs):
+    ''' Calls processes in parallel, at most a given number at once. Commands
+        are given with the tag prefixing their output, and exit codes are
+        returned in the same order. Other arguments are passed to call. '''
+    with JobPool(workers) as job_pool:
+        for tag, command in all_commands:
+            job_pool.submit(tag, call, command, **kwargs)
+        return job_pool.wait()
+
+
+# Tag of the job running on the current thread, if any
+_job_context = threading.local()
+
+
+class JobPool():
+    ''' Runs jobs in parallel, at most a given number at once. The output of
+        processes called by a job is prefixed with the tag of the job in
+        stream handlers, so that interleaved lines can be told apart. Other
+        handlers, such as summary handlers, still get lines as they were
+        output, with the tag in the job_tag record attribute. Capturing
+        OutputDebugString isn't supported by parallel jobs.
+        When stopping on failure, jobs which were not started yet are
+        cancelled once a job raises or returns a false value, so a single
+        worker stops at the first failure as a loop would. '''
+    def __init__(self, workers=None, stop_on_failure=False):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers if workers else (os.cpu_count() or 1))
+        self._stop_on_failure = stop_on_failure
+        self._has_failed = False
+        self._all_futures = []
+        # Reentrant, as callbacks of jobs already done run while submitting
+        self._lock = threading.RLock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.shutdown()
+
+    def submit(self, tag, action, *args, **kwargs):
+        ''' Queues a job calling an action with the given arguments '''
+        # Jobs submitted by a job are tagged with both tags
+        parent_tag = getattr(_job_context, 'tag', None)
+        if parent_tag:
+            tag = '%s/%s' % (parent_tag, tag)
+        with self._lock:
+            if self._has_failed:
+                future = concurrent.futures.Future()
+                future.cancel()
+            else:
+                future = self._executor.submit(_run_job, tag, action, args, kwargs)
+                if self._stop_on_failure:
+                    future.add_done_callback(self._on_job_done)
+            self._all_futures.append(future)
+
+    def wait(self):
+        ''' Waits for all jobs and returns their results, in the order they
+            were submitted, with None for cancelled jobs. Exceptions raised
+            by jobs are raised again. '''
+        concurrent.futures.wait(self._all_futures)
+        return [ None if future.cancelled() else future.result() for future in self._all_futures ]
+
+    def _on_job_done(self, future):
+        if future.cancelled() or (future.exception() is None and future.result()):
+            return
+        with self._lock:
+            if not self._has_failed:
+                logging.debug('A job failed, cancelling jobs not started yet')
+            self._has_failed = True
+            for pending_future in self._all_futures:
+                pending_future.cancel()
+
+
+def _run_job(tag, action, args, kwargs):
+    _job_context.tag = tag
+    try:
+        return action(*args, **kwargs)
+    finally:
+        _job_context.tag = None
+
+
+class OutputSearch():
+    ''' Output callback recording which of some strings appear in the output
+        of a process, so that it can be searched without being captured '''
+    def __init__(self, *all_strings):
+        self._all_pending_strings = list(all_strings)
+        self.all_found_strings = set()
+
+    def __call__(self, text):
+        for string in self._all_pending_strings:
+            if string in text:
+                self.all_found_strings.add(string)
+        self._all_pending_strings = [ string for string in self._all_pending_strings if string not in self.all_found_strings ]
+
+    def __contains__(self, string):
+        return string in self.all_found_strings
+
+
+# Trace recording the processes being called, and the step they are attributed to
+_active_trace = None
+_trace_step = None
+
+
+class ProcessTrace():
+    ''' Records the command, duration, CPU times, peak memory and output size
+        of every process called while it is active, as JSON lines appended
+        to a file, and totals them by step. CPU times and peak memory are
+        null on platforms where they can't be measured. '''
+    def __init__(self, path):
+        self.path = path
+        self.all_step_totals = {}
+        self._lock = threading.Lock()
+        self._previous_trace = None
+
+    def __enter__(self):
+        global _active_trace # pylint: disable = global-statement
+        self._previous_trace, _active_trace = _active_trace, self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _active_trace # pylint: disable = global-statement
+        _active_trace = self._previous_trace
+
+    def record(self, command, cwd, tag, pid, start_time, wall_time, exit_code, usage, output_size, error_size):
+        ''' Writes the record of a process that ended, and adds it to the
+            totals of the current step '''
+        user_time, system_time, max_rss = usage if usage is not None else (None, None, None)
+        entry = { 'command': command, 'cwd': os.path.abspath(cwd), 'step': _trace_step, 'tag': tag, 'pid': pid,
+                  'start': round(start_time, 3), 'wall_time': round(wall_time, 3),
+                  'user_time': user_time, 'system_time': system_time, 'max_rss': max_rss,
+                  'stdout_bytes': output_size, 'stderr_bytes': error_size, 'exit_code': exit_code }
+        line = json.dumps(entry, separators = (',', ':')) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding = 'utf-8') as trace_file:
+                trace_file.write(line)
+            totals = self.all_step_totals.setdefault(_trace_step, { 'processes': 0, 'wall_time': 0, 'cpu_time': 0,
+                                                                     'max_rss': 0, 'output_bytes': 0 })
+            totals['processes'] += 1
+            totals['wall_time'] += wall_time
+            totals['cpu_time'] += (user_time or 0) + (system_time or 0)
+            totals['max_rss'] = max(totals['max_rss'], max_rss or 0)
+            totals['output_bytes'] += output_size + error_size
+
+
+@contextlib.contextmanager
+def trace_step(name):
+    ''' Attributes the processes called within, including by parallel jobs,
+        to a step of the active trace '''
+    global _trace_step # pylint: disable = global-statement
+    previous_step, _trace_step = _trace_step, name
+    try:
+        yield
+    finally:
+        _trace_step = previous_step
+
+
+def _wait_process(process, timeout, measure_usage):
+    ''' Waits for a process to end and returns its exit code, with its CPU
+        times and peak memory if asked to and if they can be measured '''
+    if not measure_usage:
+        return process.wait(timeout), None
+    if nimp.sys.platform.is_windows():
+        exit_code = process.wait(timeout)
+        return exit_code, _get_win32_process_usage(getattr(process, '_handle', None))
+    if not hasattr(os, 'wait4'):
+        return process.wait(timeout), None
+
+    # Reaping the process with wait4 gives the resources used by this process
+    # only, where getrusage would also count other jobs running in parallel
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    delay = 0.0005
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG if deadline is not None else 0)
+        except ChildProcessError:
+            return process.wait(timeout), None
+        if pid == process.pid:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    # Peak memory is given in kilobytes, except on macOS
+    max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return process.returncode, (round(rusage.ru_utime, 3), round(rusage.ru_stime, 3), max_rss)
+
+
+# Output is read in large chunks, split into lines and decoded a chunk at a time
+_OUTPUT_READ_SIZE = 64 * 1024
+# Captured output bigger than this is spooled to a temporary file instead of memory
+_CAPTURE_MAX_SIZE = 16 * 1024 * 1024
+
+
+class _OutputStream():
+    ''' Splits the output of a child process into lines. Whole chunks are
+        decoded at once with the encoding of the stream, falling back to
+        decoding each line with other encodings when a chunk fails. '''
+    def __init__(self, encoding, sink, capture_output, output_callback = None):
+        force_ascii = locale.getpreferredencoding().lower() != 'utf-8'
+        # Try to decode as UTF-8 with BOM first; if it fails, try CP850 on
+        # Windows, or UTF-8 with BOM and error substitution elsewhere. If
+        # it fails again, try CP850 with error substitution.
+        self._all_encodings = [
+            (encoding, 'strict'),
+            ('ascii', 'backslashreplace') if force_ascii else ('utf-8-sig', 'strict'),
+            ('cp850', 'strict') if nimp.sys.platform.is_windows() else ('utf-8-sig', 'replace'),
+            ('cp850', 'replace')
+        ]
+        # Decoding several lines at once gives the same text as decoding them
+        # one by one only if new lines are encoded as such
+        try:
+            self._encoding = encoding if '\r\n'.encode(encoding) == b'\r\n' else None
+        except LookupError:
+            self._encoding = None
+        self._sink = sink
+        self._output_callback = output_callback
+        self._capture = None
+        if capture_output:
+            self._capture = tempfile.SpooledTemporaryFile(max_size = _CAPTURE_MAX_SIZE, mode = 'w+', encoding = 'utf-8',
+                                                          errors = 'surrogatepass', newline = '')
+        self._pending_data = b''
+        self.byte_count = 0
+
+    def write(self, data):
+        ''' Processes the complete lines of some output, and keeps the last
+            line until it is complete '''
+        self.byte_count += len(data)
+        if self._pending_data:
+            data = self._pending_data + data
+        line_end = data.rfind(b'\n') + 1
+        self._pending_data = data[line_end:]
+        if line_end > 0:
+            self._write_lines(data[:line_end])
+
+    def close(self):
+        ''' Processes the last line of the output, even if it is incomplete '''
+        if self._pending_data:
+            self._write_lines(self._pending_data)
+            self._pending_data = b''
+
+    def get_captured_output(self):
+        ''' Returns all the output decoded so far, and discards it '''
+        with self._capture:
+            self._capture.seek(0)
+            return self._capture.read()
+
+    def _write_lines(self, data):
+        text = None
+        if self._encoding is not None:
+            try:
+                text = data.decode(self._encoding)
+            except UnicodeError:
+                pass
+
+        if text is not None:
+            all_lines = text.split('\n')
+            if text.endswith('\n'):
+                all_lines.pop()
+            all_messages = [ line.strip('\r') for line in all_lines ]
+        else:
+            all_lines = [ line + b'\n' for line in data.split(b'\n') ]
+            all_lines[-1] = all_lines[-1][:-1]
+            all_lines = [ self._decode_line(line) for line in all_lines if line ]
+            text = ''.join(all_lines)
+            all_messages = [ line.strip('\n').strip('\r') for line in all_lines ]
+
+        if self._capture is not None:
+            self._capture.write(text)
+        if self._output_callback is not None:
+            self._output_callback(text)
+        if self._sink is not None:
+            self._sink.write_lines(all_messages)
+
+    def _decode_line(self, line):
+        for encoding, errors in self._all_encodings:
+            try:
+                return line.decode(encoding, errors=errors)
+            except UnicodeError:
+                pass
+        return None
+
+
+class _LogSink():
+    ''' Logs lines of child processes a chunk at a time. Stream handlers get
+        a single write and flush per chunk, instead of one per line, and
+        other handlers get a record per line as usual. Lines of a job are
+        prefixed with its tag in all stream handlers. '''
+
+    _BUFFERED_HANDLER_TYPES = (logging.StreamHandler, logging.FileHandler, logging.handlers.WatchedFileHandler)
+
+    def __init__(self, logger, job_tag = None):
+        self._logger = logger
+        self._job_tag = job_tag
+
+    def write_lines(self, all_lines):
+        ''' Logs lines at info level, as logger.info would for each line '''
+        logger = self._logger
+        if logger.disabled or not logger.isEnabledFor(logging.INFO):
+            return
+        if logger.filters:
+            all_lines = [ line for line in all_lines if logger.filter(self._make_record(line)) ]
+
+        all_tagged_lines = all_lines
+        if self._job_tag:
+            all_tagged_lines = [ '[%s] %s' % (self._job_tag, line) for line in all_lines ]
+        for handler in self._get_handlers():
+            if logging.INFO < handler.level:
+                continue
+            all_handler_lines = all_tagged_lines if isinstance(handler, logging.StreamHandler) else all_lines
+            if type(handler) in _LogSink._BUFFERED_HANDLER_TYPES and handler.stream is not None and not handler.filters:
+                self._write_stream(handler, all_handler_lines)
+            else:
+                for line in all_handler_lines:
+                    handler.handle(self._make_record(line))
+
+    def _get_handlers(self):
+        all_handlers = []
+        logger = self._logger
+        while logger is not None:
+            all_handlers.extend(logger.handlers)
+            logger = logger.parent if logger.propagate else None
+        return all_handlers
+
+    def _make_record(self, line):
+        extra = { 'job_tag': self._job_tag } if self._job_tag else None
+        return self._logger.makeRecord(self._logger.name, logging.INFO, __file__, 0, line, None, None, extra = extra)
+
+    def _write_stream(self, handler, all_lines):
+        # Records of a chunk only differ by their message, one is enough
+        record = self._make_record('')
+        all_messages = []
+        for line in all_lines:
+            record.msg = line
+            all_messages.append(handler.format(record))
+
+        handler.acquire()
+        try:
+            if isinstance(handler, logging.handlers.WatchedFileHandler):
+                handler.reopenIfNeeded()
+            handler.stream.write(''.join(message + handler.terminator for message in all_messages))
+            handler.flush()
+        except Exception: #pylint: disable=broad-except
+            handler.handleError(record)
+        finally:
+            handler.release()
+
+
 def _sanitize_command(command):
     new_command = []
     for it in command:
@@ -215,6 +584,35 @@ if nimp.sys.platform.is_windows():
     PROCESS_QUERY_INFORMATION = 0x0400 # pylint: disable = invalid-name
     PROCESS_SYNCHRONIZE = 0x00100000 # pylint: disable = invalid-name
 
+    class _ProcessMemoryCounters(ctypes.Structure):
+        ''' PROCESS_MEMORY_COUNTERS structure of GetProcessMemoryInfo '''
+        _fields_ = [ ('cb', ctypes.c_ulong),
+                     ('PageFaultCount', ctypes.c_ulong),
+                     ('PeakWorkingSetSize', ctypes.c_size_t),
+                     ('WorkingSetSize', ctypes.c_size_t),
+                     ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                     ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                     ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                     ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                     ('PagefileUsage', ctypes.c_size_t),
+                     ('PeakPagefileUsage', ctypes.c_size_t) ]
+
+    def _get_win32_process_usage(handle):
+        ''' Returns the CPU times and peak memory of a process that ended,
+            which can still be queried while its handle is open '''
+        if _KERNEL32 is None or handle is None:
+            return None
+        handle = ctypes.c_void_p(int(handle))
+        # FILETIME values are in 100 nanosecond units
+        all_times = [ ctypes.c_ulonglong() for _ in range(4) ]
+        if not _KERNEL32.GetProcessTimes(handle, *[ ctypes.byref(value) for value in all_times ]):
+            return None
+        counters = _ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not _KERNEL32.K32GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return None
+        return round(all_times[3].value / 1e7, 3), round(all_times[2].value / 1e7, 3), counters.PeakWorkingSetSize
+
     def _disable_win32_dialogs():
         ''' Disable “Entry Point Not Found” and “Application Error” dialogs for
             child processes '''
@@ -22,22 +22,27 @@
 
 ''' System utilities (paths, processes) '''
 
+import collections
+import concurrent.futures
 import fnmatch
+import functools
 import json
 import logging
 import os
 import re
 import shutil
 import stat
+import sys
 import time
 import importlib
-import pkg_resources
+import itertools
 
 import glob2
 
 import nimp.environment
 import nimp.sys.platform
 import nimp.sys.process
+import nimp.utils.python
 
 def try_import(module_name):
     ''' Tries to import a module, return none if unavailable '''
@@ -65,6 +70,14 @@ def try_execute(action, exception_types, attempt_maximum = 5, retry_delay = 10):
             time.sleep(retry_delay)
             attempt += 1
 
+def get_worker_count(workers):
+    ''' Returns the number of workers to use for parallel file operations,
+        defaulting to a count based on the number of processors '''
+    if workers is not None and workers > 0:
+        return workers
+    # Same default as concurrent.futures.ThreadPoolExecutor, work is mostly I/O bound
+    return min(32, (os.cpu_count() or 1) + 4)
+
 def try_remove(file_path, dry_run):
     if os.path.exists(file_path):
         logging.info("Removing %s", file_path)
@@ -233,6 +246,728 @@ def map_files(env):
     ctx[0] = ret
     return ret
 
+class _FileSystemView():
+    ''' Directory listings gathered while evaluating a file mapper, so that
+        every directory is listed only once whatever the number of rules.
+        When a maximum listing count is given, only the most recently used
+        listings are kept. With several workers, directories and files about
+        to be used are read in parallel, which hides the latency of network
+        file systems. '''
+    def __init__(self, listing_cache = None, maximum_listing_count = None, workers = None):
+        self._all_listings = collections.OrderedDict()
+        self._listing_cache = listing_cache
+        self._maximum_listing_count = maximum_listing_count
+        self._workers = workers
+        # Number of directory listings and stats read from the file system
+        self.call_count = 0
+        self.profile = None
+
+    def list_directory(self, path):
+        ''' Returns the entries of a directory, indexed by their case
+            normalized name, or None if it is not a directory '''
+        path = path or os.curdir
+        try:
+            listing = self._all_listings[path]
+            if self._maximum_listing_count is not None:
+                self._all_listings.move_to_end(path)
+            return listing
+        except KeyError:
+            pass
+        self.call_count += 1
+        return self._add_listing(path, self._read_directory(path))
+
+    def prefetch_directories(self, all_paths):
+        ''' Lists directories in parallel, before they are walked '''
+        if not self._workers or self._workers < 2:
+            return
+        all_paths = [ path or os.curdir for path in all_paths ]
+        all_paths = [ path for path in dict.fromkeys(all_paths) if path not in self._all_listings ]
+        if self._maximum_listing_count is not None:
+            all_paths = all_paths[:self._maximum_listing_count]
+        if len(all_paths) < 2:
+            return
+        self.call_count += len(all_paths)
+        for path, listing in zip(all_paths, _get_metadata_executor(self._workers).map(self._read_directory, all_paths)):
+            self._add_listing(path, listing)
+
+    def stat_all(self, all_paths):
+        ''' Returns the result of os.stat for each path, or None for paths
+            which don't exist '''
+        self.call_count += len(all_paths)
+        if not self._workers or self._workers < 2 or len(all_paths) < 2:
+            return [ _try_stat(path) for path in all_paths ]
+        return list(_get_metadata_executor(self._workers).map(_try_stat, all_paths))
+
+    def _read_directory(self, path):
+        if self._listing_cache is not None:
+            return self._listing_cache.list_directory(path)
+        return _scan_directory(path)
+
+    def _add_listing(self, path, listing):
+        self._all_listings[path] = listing
+        if self._maximum_listing_count is not None and len(self._all_listings) > self._maximum_listing_count:
+            self._all_listings.popitem(last = False)
+        return listing
+
+    def get_entry(self, path):
+        ''' Returns the listing entry of a path, or None if it doesn't exist
+            or can't be found in a listing '''
+        parent, name = os.path.split(path)
+        if name in ('', os.curdir, os.pardir):
+            return None
+        listing = self.list_directory(parent)
+        if listing is None:
+            return None
+        entry = listing.get(_normcase(name))
+        if entry is None and not _IS_CASE_INSENSITIVE:
+            # Names are only folded on Windows, file systems of other
+            # platforms may still ignore case, as macOS ones do by default
+            self.call_count += 1
+            entry = _DirectoryEntry.from_path(path)
+        return entry
+
+    def exists(self, path):
+        ''' Same as os.path.lexists, using directory listings when possible '''
+        if os.path.basename(path) in ('', os.curdir, os.pardir):
+            self.call_count += 1
+            return os.path.lexists(path)
+        return self.get_entry(path) is not None
+
+    def is_file(self, path):
+        ''' Same as os.path.isfile, using directory listings when possible '''
+        if os.path.basename(path) in ('', os.curdir, os.pardir):
+            self.call_count += 1
+            return os.path.isfile(path)
+        entry = self.get_entry(path)
+        return entry is not None and entry.is_file
+
+    def is_directory(self, path):
+        ''' Same as os.path.isdir, using directory listings when possible '''
+        if os.path.basename(path) in ('', os.curdir, os.pardir):
+            self.call_count += 1
+            return os.path.isdir(path)
+        entry = self.get_entry(path)
+        return entry is not None and entry.is_dir
+
+    def save(self):
+        ''' Saves listings which changed, if they are cached between runs '''
+        if self._listing_cache is not None:
+            self._listing_cache.save()
+
+
+def _try_stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+# Metadata is read by a thread pool shared by all file mappers, as creating
+# threads for each node would cost more than the reads themselves
+_metadata_executor = None
+_metadata_executor_workers = None
+
+def _get_metadata_executor(workers):
+    global _metadata_executor, _metadata_executor_workers # pylint: disable = global-statement
+    if _metadata_executor is None or _metadata_executor_workers != workers:
+        if _metadata_executor is not None:
+            _metadata_executor.shutdown(wait = False)
+        _metadata_executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers)
+        _metadata_executor_workers = workers
+    return _metadata_executor
+
+
+def _scan_directory(path):
+    try:
+        with os.scandir(path) as all_entries:
+            return { _normcase(entry.name): _DirectoryEntry.from_scandir(entry) for entry in all_entries }
+    except OSError:
+        return None
+
+
+class _DirectoryEntry():
+    ''' Information about an entry returned by os.scandir '''
+    __slots__ = [ 'name', 'is_dir', 'is_file', 'is_symlink' ]
+
+    def __init__(self, name, is_dir, is_file, is_symlink):
+        self.name = name
+        self.is_dir = is_dir
+        self.is_file = is_file
+        self.is_symlink = is_symlink
+
+    @staticmethod
+    def from_scandir(entry):
+        ''' Gets information from a os.DirEntry, following symbolic links '''
+        try:
+            is_dir = entry.is_dir()
+            is_file = entry.is_file()
+        except OSError:
+            is_dir = is_file = False
+        return _DirectoryEntry(entry.name, is_dir, is_file, entry.is_symlink())
+
+    @staticmethod
+    def from_path(path):
+        ''' Gets information from the file system, following symbolic links,
+            or returns None if the path doesn't exist '''
+        try:
+            is_symlink = stat.S_ISLNK(os.lstat(path).st_mode)
+        except OSError:
+            return None
+        return _DirectoryEntry(os.path.basename(path), os.path.isdir(path), os.path.isfile(path), is_symlink)
+
+
+class _DirectoryListingCache():
+    ''' Directory listings saved between runs. A listing stays valid as long
+        as the modification time of its directory doesn't change, which
+        happens whenever an entry is added, removed or renamed in it. '''
+
+    # Directories modified this recently may still change without their
+    # modification time changing, given its resolution on some file systems
+    _MINIMUM_AGE = 2
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._all_listings = {}
+        self._is_modified = False
+        try:
+            with open(cache_path, 'r', encoding = 'utf-8') as cache_file:
+                cache = json.load(cache_file)
+            if cache.get('version') == _DirectoryListingCache._VERSION:
+                self._all_listings = cache['listings']
+        except (OSError, ValueError, KeyError) as exception:
+            if os.path.exists(cache_path):
+                logging.debug('Ignoring directory listing cache %s: %s', cache_path, exception)
+
+    _VERSION = 1
+
+    def list_directory(self, path):
+        ''' Returns a directory listing, from the cache when its directory
+            didn't change since it was cached '''
+        try:
+            directory_stat = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(directory_stat.st_mode):
+            return None
+        cache_key = os.path.abspath(path)
+        cached_listing = self._all_listings.get(cache_key)
+        if cached_listing is not None and cached_listing[0] == directory_stat.st_mtime_ns:
+            return { _normcase(entry[0]): _DirectoryEntry(*entry) for entry in cached_listing[1] }
+
+        listing = _scan_directory(path)
+        if listing is not None and time.time_ns() - directory_stat.st_mtime_ns > _DirectoryListingCache._MINIMUM_AGE * 10**9:
+            all_entries = [ (entry.name, entry.is_dir, entry.is_file, entry.is_symlink) for entry in listing.values() ]
+            self._all_listings[cache_key] = (directory_stat.st_mtime_ns, all_entries)
+            self._is_modified = True
+        return listing
+
+    def save(self):
+        ''' Saves the cache if listings were added or updated '''
+        if not self._is_modified:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+            temporary_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            with open(temporary_path, 'w', encoding = 'utf-8') as cache_file:
+                json.dump({ 'version': _DirectoryListingCache._VERSION, 'listings': self._all_listings }, cache_file)
+            os.replace(temporary_path, self.cache_path)
+            self._is_modified = False
+        except OSError as exception:
+            logging.warning('Failed to save directory listing cache %s: %s', self.cache_path, exception)
+
+
+# Listing caches are loaded once per process, and shared by all file mappers
+_all_directory_listing_caches = {}
+
+def _get_directory_listing_cache(cache_path):
+    if cache_path not in _all_directory_listing_caches:
+        _all_directory_listing_caches[cache_path] = _DirectoryListingCache(cache_path)
+    return _all_directory_listing_caches[cache_path]
+
+
+class _FilesetModuleCache():
+    ''' Plugin modules providing filesets, saved between runs. A module stays
+        valid as long as the set of plugins is the same and the directories
+        of the plugins searched before finding it weren't modified. '''
+
+    _VERSION = 1
+
+    def __init__(self, cache_path, all_plugins):
+        self.cache_path = cache_path
+        self._all_plugins = all_plugins
+        self._all_modules = {}
+        try:
+            with open(cache_path, 'r', encoding = 'utf-8') as cache_file:
+                cache = json.load(cache_file)
+            if cache.get('version') == _FilesetModuleCache._VERSION and cache['plugins'] == all_plugins:
+                self._all_modules = cache['modules']
+        except (OSError, ValueError, KeyError) as exception:
+            if os.path.exists(cache_path):
+                logging.debug('Ignoring fileset module cache %s: %s', cache_path, exception)
+
+    def get_module_name(self, set_module_name):
+        ''' Returns the module providing a fileset, if it was found in a
+            previous run and none of the searched directories changed '''
+        cached_module = self._all_modules.get(set_module_name)
+        if cached_module is None:
+            return None
+        for path, mtime_ns in cached_module['directories']:
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return None
+            except OSError:
+                return None
+        return cached_module['module']
+
+    def add_module_name(self, set_module_name, module_name, all_searched_directories):
+        ''' Saves the module providing a fileset, along with the directories
+            where it could have been found before '''
+        try:
+            all_directories = [ (path, os.stat(path).st_mtime_ns) for path in all_searched_directories ]
+        except OSError:
+            return
+        # Directories modified this recently may still change without their
+        # modification time changing, given its resolution on some file systems
+        if any(time.time_ns() - mtime_ns <= _DirectoryListingCache._MINIMUM_AGE * 10**9 for _, mtime_ns in all_directories):
+            return
+        self._all_modules[set_module_name] = { 'module': module_name, 'directories': all_directories }
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+            temporary_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            with open(temporary_path, 'w', encoding = 'utf-8') as cache_file:
+                json.dump({ 'version': _FilesetModuleCache._VERSION, 'plugins': self._all_plugins, 'modules': self._all_modules }, cache_file)
+            os.replace(temporary_path, self.cache_path)
+        except OSError as exception:
+            logging.warning('Failed to save fileset module cache %s: %s', self.cache_path, exception)
+
+
+# Fileset modules resolved in this process, by fileset name
+_all_fileset_module_names = {}
+_all_fileset_module_caches = {}
+
+def _import_fileset_module(set_module_name, module_cache_path):
+    module_name = _all_fileset_module_names.get(set_module_name)
+    if module_name is not None:
+        return importlib.import_module(module_name)
+    # Project filesets take precedence over the ones of plugins
+    try:
+        set_module = importlib.import_module('filesets.' + set_module_name)
+    except ModuleNotFoundError:
+        set_module = _import_plugin_fileset_module(set_module_name, module_cache_path)
+    _all_fileset_module_names[set_module_name] = set_module.__name__
+    return set_module
+
+
+def _import_plugin_fileset_module(set_module_name, module_cache_path):
+    all_plugin_modules = [ nimp.utils.python.get_entry_point_module_name(entry_point)
+                           for entry_point in nimp.utils.python.get_plugin_entry_points() ]
+    module_cache = None
+    if module_cache_path is not None:
+        if module_cache_path not in _all_fileset_module_caches:
+            _all_fileset_module_caches[module_cache_path] = _FilesetModuleCache(module_cache_path, all_plugin_modules)
+        module_cache = _all_fileset_module_caches[module_cache_path]
+        module_name = module_cache.get_module_name(set_module_name)
+        if module_name is not None:
+            try:
+                return importlib.import_module(module_name)
+            except ModuleNotFoundError:
+                pass
+
+    all_searched_directories = []
+    for plugin_module in all_plugin_modules:
+        module_name = plugin_module + '.filesets.' + set_module_name
+        try:
+            set_module = importlib.import_module(module_name)
+        except ModuleNotFoundError:
+            # Adding the fileset to this plugin modifies one of these directories
+            for package_name in [ plugin_module + '.filesets', plugin_module ]:
+                package_path = getattr(sys.modules.get(package_name), '__path__', None)
+                if package_path:
+                    all_searched_directories.extend(package_path)
+                    break
+            continue
+        if module_cache is not None:
+            module_cache.add_module_name(set_module_name, module_name, all_searched_directories)
+        return set_module
+    raise ModuleNotFoundError(f"No module named 'filesets.{set_module_name}'")
+
+
+_IS_CASE_INSENSITIVE = os.path.normcase('A') == 'a'
+
+def _normcase(path):
+    return os.path.normcase(path) if _IS_CASE_INSENSITIVE else path
+
+
+class _GlobPattern():
+    ''' A glob pattern split as glob2 does, into a literal base path and
+        the components matched against directory listings '''
+    def __init__(self, path):
+        self.path = path
+        self.base = path
+        self.all_components = []
+        self.all_matchers = []
+        if not glob2.has_magic(path):
+            return
+        while True:
+            directory, name = os.path.split(self.base)
+            self.all_components.insert(0, name)
+            is_root = directory == self.base
+            self.base = directory
+            if is_root or not glob2.has_magic(directory):
+                break
+        for component in self.all_components:
+            if component == '**' or not glob2.has_magic(component):
+                self.all_matchers.append(None)
+            else:
+                self.all_matchers.append(_get_glob_matcher(_normcase(component)))
+
+
+@functools.lru_cache(maxsize = 4096)
+def _get_glob_matcher(component):
+    # glob2.glob ends up matching wildcards ignoring case, even
+    # though its case_sensitive argument defaults to True
+    return re.compile(glob2.fnmatch.translate(component), re.IGNORECASE).match
+
+
+def _glob(all_patterns, file_system):
+    ''' Resolves glob patterns with the same results as glob2, walking
+        directories shared by several patterns only once. Returns, for each
+        pattern, the matched paths and the names matched after its base. '''
+    all_matches = [ [] for _ in all_patterns ]
+    for index, order, path, all_names in itertools.chain.from_iterable(_iglob(all_patterns, file_system)):
+        all_matches[index].append((order, path, all_names))
+
+    # Matches are returned in the same order as glob2 would
+    for matches in all_matches:
+        matches.sort(key = lambda match: match[0])
+    return [ [ (path, all_names) for _, path, all_names in matches ] for matches in all_matches ]
+
+
+def _iglob(all_patterns, file_system):
+    ''' Walks the directories matched by glob patterns, yielding after each
+        directory the matches found in it, unsorted. Each match is the index
+        of its pattern, its glob2 order key, its path and the names matched
+        after the base of the pattern. '''
+    all_states_by_base = {}
+    for index, pattern in enumerate(all_patterns):
+        if not pattern.all_components:
+            if file_system.exists(pattern.path):
+                yield [ (index, (), pattern.path, ()) ]
+        else:
+            all_states_by_base.setdefault(pattern.base, []).append((index, 0, (), ()))
+
+    # A state is the index of a pattern, the index of the component to match
+    # in the directory, the order glob2 would have found the directory in and,
+    # while expanding **, the position of the directory below the ** root.
+    for base, all_states in all_states_by_base.items():
+        stack = [ (base, (), all_states) ]
+        while stack:
+            directory, all_names, all_states = stack.pop()
+            listing = file_system.list_directory(directory)
+            all_matches = []
+            all_child_states = {}
+            for index, component_index, order, star_position in all_states:
+                _glob_directory(all_patterns[index], index, component_index, order, star_position,
+                                directory, all_names, listing, all_matches, all_child_states)
+            all_children = [ (os.path.join(directory, name), all_names + (name,), all_states)
+                             for name, all_states in all_child_states.items() ]
+            file_system.prefetch_directories([ child[0] for child in all_children ])
+            stack += reversed(all_children)
+            if all_matches:
+                yield all_matches
+
+
+def _glob_directory(pattern, index, component_index, order, star_position,
+                    directory, all_names, listing, all_matches, all_child_states):
+    component = pattern.all_components[component_index]
+    is_last = component_index == len(pattern.all_components) - 1
+
+    if component == '**':
+        if is_last:
+            # A trailing ** matches everything below the directory, but not
+            # the directory itself, listing each directory in pre-order
+            if listing is not None:
+                for entry_index, entry in enumerate(listing.values()):
+                    all_matches.append((index, order + ((star_position, entry_index),),
+                                        os.path.join(directory, entry.name), all_names + (entry.name,)))
+                    if entry.is_dir and not entry.is_symlink:
+                        all_child_states.setdefault(entry.name, []).append((index, component_index, order, star_position + (entry_index,)))
+            return
+        # Other ** also match the directory itself, and are not expanded below
+        # symbolic links. glob2 lists directories below ** in pre-order, each
+        # directory listing its entries.
+        star_order = order + (((), -1) if not star_position else (star_position[:-1], star_position[-1]),)
+        _glob_directory(pattern, index, component_index + 1, star_order, (),
+                        directory, all_names, listing, all_matches, all_child_states)
+        if listing is not None:
+            for entry_index, entry in enumerate(listing.values()):
+                if entry.is_dir and not entry.is_symlink:
+                    all_child_states.setdefault(entry.name, []).append((index, component_index, order, star_position + (entry_index,)))
+                elif entry.is_dir:
+                    child_order = order + ((star_position, entry_index),)
+                    all_child_states.setdefault(entry.name, []).append((index, component_index + 1, child_order, ()))
+        return
+
+    if component == '':
+        # Trailing separator, only directories match
+        if directory != '' and listing is not None:
+            all_matches.append((index, order + (0,), os.path.join(directory, ''), all_names))
+        return
+
+    matcher = pattern.all_matchers[component_index]
+    if matcher is None:
+        if component in (os.curdir, os.pardir):
+            exists = os.path.lexists(os.path.join(directory, component))
+        else:
+            exists = listing is not None and _normcase(component) in listing
+            if listing is not None and not exists and not _IS_CASE_INSENSITIVE:
+                # The file system may still ignore case, see _FileSystemView.get_entry
+                exists = os.path.lexists(os.path.join(directory, component))
+        if exists and is_last:
+            all_matches.append((index, order + (0,), os.path.join(directory, component), all_names + (component,)))
+        elif exists:
+            all_child_states.setdefault(component, []).append((index, component_index + 1, order + (0,), ()))
+        return
+
+    if listing is None:
+        return
+    for entry_index, (normalized_name, entry) in enumerate(listing.items()):
+        if matcher(normalized_name):
+            if is_last:
+                all_matches.append((index, order + (entry_index,), os.path.join(directory, entry.name), all_names + (entry.name,)))
+            elif entry.is_dir:
+                all_child_states.setdefault(entry.name, []).append((index, component_index + 1, order + (entry_index,), ()))
+
+
+def _glob_nodes(all_nodes, all_inputs, file_system):
+    ''' Evaluates glob nodes for all inputs in a single walk of the
+        directories they share, returning the results of each node '''
+    all_jobs = []
+    all_patterns = []
+    for node in all_nodes:
+        for input_index, (src, dest) in enumerate(all_inputs):
+            src = sanitize_path(src)
+            dest = sanitize_path(dest)
+            for pattern in node._glob_patterns:
+                glob_path = pattern if src is None else os.path.join(src, pattern)
+                all_jobs.append((node, input_index, src, dest, pattern, glob_path))
+                all_patterns.append(_GlobPattern(glob_path))
+    all_matches = _glob(all_patterns, file_system)
+
+    all_node_results = { id(node): [ [] for _ in all_inputs ] for node in all_nodes }
+    for (node, input_index, src, dest, pattern, glob_path), glob_pattern, matches in zip(all_jobs, all_patterns, all_matches):
+        if not matches:
+            logging.info("No match for “%s” in “%s” (aka. “%s”)", pattern, src, glob_path)
+            #raise Exception("No match for “%s” in “%s” (aka. “%s”)" % (pattern, src, glob_path))
+            if file_system.profile is not None:
+                file_system.profile.get_node_statistics(node).all_unmatched_patterns.append((pattern, glob_path))
+            continue
+        all_node_results[id(node)][input_index] += _get_glob_results(src, dest, glob_pattern, matches)
+    return [ all_node_results[id(node)] for node in all_nodes ]
+
+
+def _stream_glob_node(node, src, dest, file_system):
+    ''' Evaluates a glob node for a single input, yielding files directory
+        by directory in walk order instead of sorting them '''
+    src = sanitize_path(src)
+    dest = sanitize_path(dest)
+    for pattern in node._glob_patterns:
+        glob_path = pattern if src is None else os.path.join(src, pattern)
+        glob_pattern = _GlobPattern(glob_path)
+        found = False
+        for all_matches in _iglob([ glob_pattern ], file_system):
+            found = True
+            yield from _get_glob_results(src, dest, glob_pattern, [ (path, all_names) for _, _, path, all_names in all_matches ])
+        if not found:
+            logging.info("No match for “%s” in “%s” (aka. “%s”)", pattern, src, glob_path)
+
+
+def _get_glob_results(src, dest, glob_pattern, matches):
+    if src is None or src == '.':
+        source_path_len = 0
+    else:
+        source_path_len = len(split_path(src))
+
+    # Paths below a normalized base only need to be joined, instead of being
+    # normalized and split again for each file
+    base = glob_pattern.base
+    base_names = split_path(base) if base else []
+    if not _is_normalized_path(base, base_names):
+        return [ _get_glob_result(source_path_len, dest, glob_source) for glob_source, _ in matches ]
+    # Destinations keeping the root of an absolute base are left to the generic code
+    has_root = base != '' and (os.path.isabs(base) or os.path.splitdrive(base)[0] != '')
+    dest_base = os.path.normpath(dest) if dest is not None else None
+    is_dest_normalized = dest is not None and source_path_len >= int(has_root) and os.path.splitdrive(dest_base)[1] != ''
+
+    results = []
+    for glob_source, all_names in matches:
+        if os.curdir in all_names or os.pardir in all_names:
+            results.append(_get_glob_result(source_path_len, dest, glob_source))
+            continue
+        glob_source = _join_normalized(base or os.curdir, all_names)
+        if dest is None:
+            results.append((glob_source, None))
+        elif is_dest_normalized:
+            all_dest_names = (base_names + list(all_names))[source_path_len:]
+            results.append((glob_source, _join_normalized(dest_base, all_dest_names)))
+        else:
+            results.append(_get_glob_result(source_path_len, dest, glob_source))
+    return results
+
+
+def _is_normalized_path(path, all_names):
+    if path == '':
+        return True
+    drive, path_without_drive = os.path.splitdrive(path)
+    return (os.path.normpath(path) == path and (drive == '' or path_without_drive != '')
+            and os.curdir not in all_names and os.pardir not in all_names)
+
+
+def _get_glob_result(source_path_len, dest, glob_source):
+    # This is merely equivalent to os.path.relpath(src, self._source_path)
+    # except it will handle globs pattern in the base path.
+    glob_source = os.path.normpath(glob_source)
+    if dest is not None:
+        new_dest = split_path(glob_source)[source_path_len:]
+        new_dest = '/'.join(new_dest)
+        new_dest = os.path.join(dest, new_dest)
+        new_dest = os.path.normpath(new_dest)
+    else:
+        new_dest = None
+    return (glob_source, new_dest)
+
+
+def _join_normalized(base, all_names):
+    ''' Same as os.path.normpath(os.path.join(base, *all_names)) for a
+        normalized base and plain names '''
+    if not all_names:
+        return base
+    if base == os.curdir:
+        return os.sep.join(all_names)
+    if base.endswith(os.sep):
+        return base + os.sep.join(all_names)
+    return base + os.sep + os.sep.join(all_names)
+
+
+def _compile_fnmatch_patterns(all_patterns, ignore_case):
+    ''' Compiles fnmatch patterns into a single regular expression, so that
+        a path is tested against all of them at once. The returned function
+        expects paths already normalized with os.path.normcase, and None
+        is returned when there are no patterns. '''
+    if not all_patterns:
+        return None
+    regex = '|'.join(fnmatch.translate(os.path.normcase(pattern)) for pattern in all_patterns)
+    return re.compile(regex, re.IGNORECASE if ignore_case else 0).match
+
+
+# Format arguments computed for overrides, by base format arguments and
+# overridden values, with a snapshot of the base they were computed from
+_all_override_format_args = collections.OrderedDict()
+_OVERRIDE_CACHE_SIZE = 64
+
+def _get_override_format_args(base_format_args, fmt):
+    # Values equal to the base ones give the same arguments to load
+    fmt = { key: value for key, value in fmt.items() if key not in base_format_args or base_format_args[key] != value }
+
+    try:
+        cache_key = (id(base_format_args), tuple(sorted(fmt.items())))
+        hash(cache_key)
+        # Lists and dicts filled by argument loaders may be changed in place,
+        # so the base arguments are compared with a deep snapshot
+        base_snapshot = _get_snapshot(base_format_args)
+    except (TypeError, RecursionError):
+        cache_key = None
+    if cache_key is not None and cache_key in _all_override_format_args:
+        cached_snapshot, format_args = _all_override_format_args[cache_key]
+        if cached_snapshot == base_snapshot:
+            _all_override_format_args.move_to_end(cache_key)
+            return format_args
+
+    format_args = base_format_args.copy()
+    # Hackish : We construct a new Environment to load load_arguments so
+    # values computed from others parameters are correctly set
+    # (like unreal_config, for example)
+    new_env = nimp.environment.Environment()
+    format_args.update(fmt)
+    for key, value in format_args.items():
+        setattr(new_env, key, value)
+    new_env.load_arguments()
+    format_args = vars(new_env)
+
+    if cache_key is not None:
+        _all_override_format_args[cache_key] = (base_snapshot, format_args)
+        if len(_all_override_format_args) > _OVERRIDE_CACHE_SIZE:
+            _all_override_format_args.popitem(last = False)
+    return format_args
+
+
+def _get_snapshot(value):
+    # Copies the content of containers, other objects are compared as is
+    if isinstance(value, dict):
+        return (dict, tuple((key, _get_snapshot(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_get_snapshot(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, frozenset(value))
+    return value
+
+
+def _get_caller_location():
+    # Nodes are described by the first line outside this module, usually in a fileset
+    frame = sys._getframe(1) # pylint: disable = protected-access
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '%s:%d' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+
+
+class FileMapperProfile():
+    ''' Statistics gathered for each node while evaluating a file mapper '''
+    def __init__(self):
+        self._all_node_statistics = {}
+
+    def get_node_statistics(self, node):
+        ''' Returns the statistics of a node, created when first needed '''
+        if id(node) not in self._all_node_statistics:
+            self._all_node_statistics[id(node)] = FileMapperNodeStatistics()
+        return self._all_node_statistics[id(node)]
+
+    def add_evaluation(self, node, all_inputs, all_results, elapsed_time, call_count):
+        ''' Records the evaluation of a node, not including its children '''
+        node_statistics = self.get_node_statistics(node)
+        node_statistics.time += elapsed_time
+        node_statistics.input_count += len(all_inputs)
+        node_statistics.output_count += sum(len(results) for results in all_results)
+        node_statistics.file_system_call_count += call_count
+
+    def get_tree(self, root):
+        ''' Returns the depth, node and statistics of each node below root,
+            in the order they are declared '''
+        all_nodes = []
+        stack = [ (0, root) ]
+        while stack:
+            depth, node = stack.pop()
+            all_nodes.append((depth, node, self.get_node_statistics(node)))
+            stack += [ (depth + 1, next_mapper) for next_mapper in reversed(node._next) ]
+        return all_nodes
+
+
+class FileMapperNodeStatistics():
+    ''' Time spent, files processed and patterns which matched nothing
+        in a file mapper node '''
+    def __init__(self):
+        self.time = 0
+        self.input_count = 0
+        self.output_count = 0
+        self.file_system_call_count = 0
+        self.all_unmatched_patterns = []
+
+
+# Number of directory listings kept while streaming a file mapper
+_STREAM_LISTING_COUNT = 1024
+
+
 class FileMapper():
     ''' A file mapper is a tree of rules used to enumerate files.
         TODO : Eventuellement utiliser les PurePath, de python 3.4, qui simplifieraient
@@ -243,57 +978,141 @@ class FileMapper():
         self._mapper = mapper
         self._next = []
         self._format_args = format_args if format_args is not None else {}
+        # Patterns of glob nodes, which are evaluated together with their siblings
+        self._glob_patterns = None
+        # Evaluates the node for all inputs at once, using shared directory listings
+        self._batch_mapper = None
+        self._location = _get_caller_location()
         # True for legacy mode: filesets are relative to {root_dir}, not current directory
         # Newer filesets should explicitly use {root_dir} or {unreal_dir} etc.
         self.root_based = True
 
     def __call__(self, src = None, dest = None):
-        results = self._mapper(src, dest) if self._mapper else [(src, dest)]
-        for result in sorted(results, key = lambda t: t[1] or t[0] or ""):
+        # The tree is evaluated one node at a time for all files, instead of
+        # one file at a time through all nodes, so that glob nodes can share
+        # their directory walks. Results are yielded in the same order.
+        file_system = _FileSystemView(self._get_listing_cache(), workers = self._get_metadata_workers())
+        all_results = self._evaluate([ (src, dest) ], file_system)[0]
+        file_system.save()
+        yield from all_results
+
+    def profile(self, src = None, dest = None):
+        ''' Evaluates the file mapper as calling it would, gathering statistics
+            for each node. Returns the files and a FileMapperProfile. '''
+        file_system = _FileSystemView(self._get_listing_cache(), workers = self._get_metadata_workers())
+        file_system.profile = FileMapperProfile()
+        all_results = self._evaluate([ (src, dest) ], file_system)[0]
+        file_system.save()
+        return all_results, file_system.profile
+
+    def get_description(self):
+        ''' Describes this node by its kind, and where it was created '''
+        if self._glob_patterns is not None:
+            description = 'glob(%s)' % ', '.join(repr(pattern) for pattern in self._glob_patterns)
+        elif self._mapper is not None:
+            description = re.sub(r'^_?(.*?)(_mapper)?$', r'\1', getattr(self._mapper, '__name__', 'mapper'))
+        else:
+            description = 'root'
+        return '%s at %s' % (description, self._location) if self._location else description
+
+    def stream(self, src = None, dest = None, unique = False):
+        ''' Yields files as soon as they are found, in the order directories
+            are walked, instead of sorting them at each node. Only recently
+            used directory listings are kept, so memory doesn't grow with the
+            size of the fileset, unless unique is set to skip duplicates.
+            Different rules may map the same file, so every result yielded is
+            then kept, and memory grows with the number of files. '''
+        file_system = _FileSystemView(self._get_listing_cache(), maximum_listing_count = _STREAM_LISTING_COUNT,
+                                      workers = self._get_metadata_workers())
+        all_yielded_results = set() if unique else None
+        for result in self._stream(src, dest, file_system):
+            if all_yielded_results is not None:
+                if result in all_yielded_results:
+                    continue
+                all_yielded_results.add(result)
+            yield result
+        file_system.save()
+
+    def _stream(self, src, dest, file_system):
+        if self._glob_patterns is not None:
+            results = _stream_glob_node(self, src, dest, file_system)
+        elif self._mapper:
+            results = self._mapper(src, dest)
+        else:
+            results = [ (src, dest) ]
+        for result in results:
             for next_mapper in self._next:
-                for next_result in next_mapper(*result):
-                    yield next_result
+                yield from next_mapper._stream(*result, file_system)
             # Only test the left element because some filemappers only worry about source
             if not self._next and result[0] is not None:
                 yield result
 
-    def glob(self, *patterns):
-        ''' Globs given patterns, feedding the resulting files '''
-        def _glob_mapper(src, dest):
-            src = sanitize_path(src)
-            dest = sanitize_path(dest)
-            if src is None or src == '.':
-                source_path_len = 0
+    def _get_metadata_workers(self):
+        # Reading metadata in parallel only pays off on network file systems,
+        # where each read is a round trip. Local reads are faster serially.
+        workers = self._format_args.get('fileset_metadata_workers')
+        return int(workers) if workers else None
+
+    def _get_listing_cache(self):
+        # Directory listings are only kept between runs when the project
+        # configuration enables it, as they may be stale when a symbolic link
+        # is retargeted without its parent directory being modified
+        if not self._format_args.get('fileset_listing_cache') or not self._format_args.get('root_dir'):
+            return None
+        cache_path = os.path.join(self._format_args['root_dir'], '.nimp', 'cache', 'fileset_listings.json')
+        return _get_directory_listing_cache(os.path.abspath(cache_path))
+
+    def _evaluate(self, all_inputs, file_system, all_results = None):
+        ''' Evaluates this node and its children for all inputs, returning
+            the list of results of each input '''
+        start_time = time.perf_counter()
+        start_call_count = file_system.call_count
+        if all_results is None:
+            if self._glob_patterns is not None:
+                all_results = _glob_nodes([ self ], all_inputs, file_system)[0]
+            elif self._batch_mapper is not None:
+                all_results = self._batch_mapper(all_inputs, file_system)
+            elif self._mapper:
+                all_results = [ list(self._mapper(src, dest)) for src, dest in all_inputs ]
             else:
-                source_path_len = len(split_path(src))
+                all_results = [ [ file_input ] for file_input in all_inputs ]
+        for results in all_results:
+            results.sort(key = lambda t: t[1] or t[0] or "")
+        if file_system.profile is not None:
+            file_system.profile.add_evaluation(self, all_inputs, all_results,
+                                               time.perf_counter() - start_time, file_system.call_count - start_call_count)
 
-            for pattern in patterns:
-                found = False
-                pattern = self._format(pattern)
-                if src is None:
-                    glob_path = pattern
-                else:
-                    glob_path = os.path.join(src, pattern)
-
-                for glob_source in glob2.glob(glob_path, include_hidden=True):
-                    found = True
-                    glob_source = str(glob_source)
-                    # This is merely equivalent to os.path.relpath(src, self._source_path)
-                    # except it will handle globs pattern in the base path.
-                    glob_source = os.path.normpath(glob_source)
-                    if dest is not None:
-                        new_dest = split_path(glob_source)[source_path_len:]
-                        new_dest = '/'.join(new_dest)
-                        new_dest = os.path.join(dest, new_dest)
-                        new_dest = os.path.normpath(new_dest)
-                    else:
-                        new_dest = None
+        if not self._next:
+            # Only test the left element because some filemappers only worry about source
+            return [ [ result for result in results if result[0] is not None ] for results in all_results ]
+
+        all_next_inputs = [ result for results in all_results for result in results ]
+        # Glob nodes are profiled separately, rather than sharing their walks
+        all_glob_nodes = [ next_mapper for next_mapper in self._next
+                           if next_mapper._glob_patterns is not None and file_system.profile is None ]
+        all_glob_results = _glob_nodes(all_glob_nodes, all_next_inputs, file_system) if all_glob_nodes else []
+        all_glob_results = dict(zip(map(id, all_glob_nodes), all_glob_results))
+        all_next_outputs = [ next_mapper._evaluate(all_next_inputs, file_system, all_glob_results.get(id(next_mapper)))
+                             for next_mapper in self._next ]
+
+        all_outputs = []
+        next_index = 0
+        for results in all_results:
+            outputs = []
+            for _ in results:
+                for next_outputs in all_next_outputs:
+                    outputs += next_outputs[next_index]
+                next_index += 1
+            all_outputs.append(outputs)
+        return all_outputs
 
-                    yield (glob_source, new_dest)
-                if not found:
-                    logging.info("No match for “%s” in “%s” (aka. “%s”)", pattern, src, glob_path)
-                    #raise Exception("No match for “%s” in “%s” (aka. “%s”)" % (pattern, src, glob_path))
-        return self.append(_glob_mapper)
+    def glob(self, *patterns):
+        ''' Globs given patterns, feedding the resulting files '''
+        def _glob_mapper(src, dest):
+            return _glob_nodes([ next_mapper ], [ (src, dest) ], _FileSystemView())[0][0]
+        next_mapper = self.append(_glob_mapper)
+        next_mapper._glob_patterns = [ self._format(pattern) for pattern in patterns ]
+        return next_mapper
 
     def xglob(self, src = '.', dest = '.', pattern = '**'):
         ''' More user-friendly glob '''
@@ -308,19 +1127,9 @@ class FileMapper():
     def load_set(self, set_name):
         ''' Loads a file mapper from a configuration file '''
         set_module_name = self._format(set_name)
-        set_module = None
-        try:
-            set_module = importlib.import_module('filesets.' + set_module_name)
-        except ModuleNotFoundError:
-            for entry in pkg_resources.iter_entry_points('nimp.plugins'):
-                try:
-                    set_module = importlib.import_module(entry.module_name + '.filesets.' + set_module_name)
-                    break
-                except ModuleNotFoundError:
-                    pass
-        if set_module is None:
-            raise ModuleNotFoundError(f"No module named 'filesets.{set_module_name}'")
-
+        root_dir = self._format_args.get('root_dir')
+        module_cache_path = os.path.join(root_dir, '.nimp', 'cache', 'fileset_modules.json') if root_dir else None
+        set_module = _import_fileset_module(set_module_name, module_cache_path)
         set_module.map(self)
         return self.get_leaves()
 
@@ -338,16 +1147,7 @@ class FileMapper():
         def _identity_mapper(src, dest):
             yield src, dest
 
-        format_args = self._format_args.copy()
-        # Hackish : We construct a new Environment to load load_arguments so
-        # values computed from others parameters are correctly set
-        # (like unreal_config, for example)
-        new_env = nimp.environment.Environment()
-        format_args.update(fmt)
-        for key, value in format_args.items():
-            setattr(new_env, key, value)
-        new_env.load_arguments()
-        format_args = vars(new_env)
+        format_args = _get_override_format_args(self._format_args, fmt)
         return self.append(_identity_mapper, format_args = format_args)
 
     def exclude(self, *patterns):
@@ -359,14 +1159,11 @@ class FileMapper():
         return self._exclude(True, *patterns)
 
     def _exclude(self, ignore_case, *patterns):
+        match = _compile_fnmatch_patterns([ self._format(pattern) for pattern in patterns ], ignore_case)
         def _exclude_mapper(src, dest):
-            for pattern in patterns:
-                pattern = self._format(pattern)
-                real_src = src.lower() if ignore_case else src
-                real_pattern = pattern.lower() if ignore_case else pattern
-                if fnmatch.fnmatch(real_src, real_pattern):
-                    logging.debug("Excluding file %s", src)
-                    return
+            if match is not None and match(os.path.normcase(src)):
+                logging.debug("Excluding file %s", src)
+                return
             yield (src, dest)
         return self.append(_exclude_mapper)
 
@@ -375,7 +1172,12 @@ class FileMapper():
         def _files_mapper(src, dest):
             if os.path.isfile(src):
                 yield (src, dest)
-        return self.append(_files_mapper)
+        def _files_batch_mapper(all_inputs, file_system):
+            file_system.prefetch_directories([ os.path.dirname(src) for src, _ in all_inputs ])
+            return [ [ (src, dest) ] if file_system.is_file(src) else [] for src, dest in all_inputs ]
+        next_mapper = self.append(_files_mapper)
+        next_mapper._batch_mapper = _files_batch_mapper
+        return next_mapper
 
     def src(self, from_src):
         ''' Prepends 'src' to path given to subsequent calls.
@@ -413,8 +1215,24 @@ class FileMapper():
                 yield (src, dest)
             elif os.path.getmtime(src) > os.path.getmtime(dest):
                 yield (src, dest)
+        def _newer_batch_mapper(all_inputs, file_system):
+            if any(src is None or dest is None for src, dest in all_inputs):
+                raise Exception("newer() called on empty fileset")
+            all_stats = file_system.stat_all([ path for file_input in all_inputs for path in file_input ])
+            all_results = []
+            for index, (src, dest) in enumerate(all_inputs):
+                source_stat, destination_stat = all_stats[2 * index], all_stats[2 * index + 1]
+                if destination_stat is None:
+                    all_results.append([ (src, dest) ])
+                elif (source_stat.st_mtime if source_stat is not None else os.path.getmtime(src)) > destination_stat.st_mtime:
+                    all_results.append([ (src, dest) ])
+                else:
+                    all_results.append([])
+            return all_results
 
-        return self.append(_newer_mapper)
+        next_mapper = self.append(_newer_mapper)
+        next_mapper._batch_mapper = _newer_batch_mapper
+        return next_mapper
 
     def recursive(self):
         ''' Recurvively list all children of processed source if it is a
@@ -433,7 +1251,35 @@ class FileMapper():
                         child_dest = os.path.normpath(file)
                     for child_source, child_destination in _recursive_mapper(child_source, child_dest):
                         yield (child_source, child_destination)
-        return self.append(_recursive_mapper)
+        def _recursive_batch_mapper(all_inputs, file_system):
+            all_results = []
+            for src, dest in all_inputs:
+                if src is None:
+                    raise Exception("recursive() called on empty fileset")
+                results = []
+                stack = [ (src, dest) ]
+                while stack:
+                    src, dest = stack.pop()
+                    results.append((src, dest))
+                    if not file_system.is_directory(src):
+                        continue
+                    listing = file_system.list_directory(src)
+                    file_system.prefetch_directories([ os.path.join(src, entry.name) for entry in (listing or {}).values() if entry.is_dir ])
+                    all_children = []
+                    for entry in (listing or {}).values():
+                        child_source = os.path.normpath(os.path.join(src, entry.name))
+                        if dest is not None:
+                            child_dest = os.path.normpath(os.path.join(dest, entry.name))
+                        else:
+                            child_dest = os.path.normpath(entry.name)
+                        all_children.append((child_source, child_dest))
+                    # Children are pushed in reverse, to be yielded in listing order
+                    stack += reversed(all_children)
+                all_results.append(results)
+            return all_results
+        next_mapper = self.append(_recursive_mapper)
+        next_mapper._batch_mapper = _recursive_batch_mapper
+        return next_mapper
 
     def replace(self, pattern, repl, flags = 0):
         ''' Performs a re.sub on destination
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' File mapper benchmark over a synthetic project tree.
+    Run with: python -m nimp.tests.benchmark_file_mapper [--scale <n>] '''
+
+import argparse
+import os
+import tempfile
+import time
+
+import nimp.system
+
+
+def create_synthetic_tree(root, scale = 1):
+    ''' Creates the same tree of empty files for a given scale, laid out
+        like an Unreal project with content, binaries and intermediates '''
+    all_paths = []
+    for package_index in range(10 * scale):
+        for directory_index in range(10):
+            directory = 'Content/Package%d/Directory%d' % (package_index, directory_index)
+            for asset_index in range(10):
+                for extension in [ 'uasset', 'uexp', 'ubulk' ]:
+                    all_paths.append('%s/Asset%d.%s' % (directory, asset_index, extension))
+    for platform in [ 'Win64', 'PS5', 'XSX' ]:
+        for module_index in range(20 * scale):
+            for extension in [ 'exe', 'dll', 'pdb' ]:
+                all_paths.append('Binaries/%s/Module%d.%s' % (platform, module_index, extension))
+        for module_index in range(20 * scale):
+            all_paths.append('Intermediate/Build/%s/Module%d/Module%d.obj' % (platform, module_index, module_index))
+
+    for path in all_paths:
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, 'w', encoding = 'utf-8'):
+            pass
+    return len(all_paths)
+
+
+def map_benchmark_fileset(file_mapper):
+    ''' Maps rules similar to the ones of packaging and binaries filesets '''
+    content = file_mapper.src('{root_dir}').to('.')
+    content.glob('Content/**/*.uasset', 'Content/**/*.uexp', 'Content/**/*.ubulk').exclude('*/Package1/*', '*/Directory9/*').files()
+    content.glob('Content/Package2*').recursive().files()
+    content.glob('Content/Missing/**')
+    binaries = file_mapper.src('{root_dir}/Binaries/{platform}').to('Binaries/{platform}')
+    binaries.glob('*.exe', '*.dll').files()
+    binaries.glob('*.pdb').exclude_ignore_case('*MODULE1*.PDB')
+    file_mapper.src('{root_dir}/Intermediate').to('Intermediate').glob('**/*.obj').newer()
+
+
+def run_benchmark(root, repeat = 3):
+    ''' Evaluates the benchmark fileset, returning its files, its profile
+        and the best time of several runs '''
+    best_time = None
+    for _ in range(repeat):
+        file_mapper = nimp.system.FileMapper(None, { 'root_dir': root, 'platform': 'Win64' })
+        map_benchmark_fileset(file_mapper)
+        start_time = time.perf_counter()
+        all_files, profile = file_mapper.profile()
+        elapsed_time = time.perf_counter() - start_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+    return file_mapper, all_files, profile, best_time
+
+
+def main():
+    ''' Creates a synthetic tree and prints the time spent in each rule '''
+    parser = argparse.ArgumentParser(description = 'Benchmarks file mappers over a synthetic tree')
+    parser.add_argument('--scale', type = int, default = 10, help = 'size of the tree, 1 is about 3000 files')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'number of runs, the best one is reported')
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        file_count = create_synthetic_tree(root, arguments.scale)
+        file_mapper, all_files, profile, best_time = run_benchmark(root, arguments.repeat)
+        print('%9s %9s %9s %9s  %s' % ('Time', 'Files in', 'Files out', 'FS calls', 'Rule'))
+        for depth, node, node_statistics in profile.get_tree(file_mapper):
+            print('%8.3fs %9d %9d %9d  %s%s' % (node_statistics.time, node_statistics.input_count, node_statistics.output_count,
+                                                node_statistics.file_system_call_count, '  ' * depth, node.get_description()))
+            for pattern, _ in node_statistics.all_unmatched_patterns:
+                print('%40s  %sNo match for %s' % ('', '  ' * (depth + 1), pattern))
+        print('Mapped %d files from a tree of %d files in %.3fs' % (len(all_files), file_count, best_time))
+
+
+if __name__ == '__main__':
+    main()
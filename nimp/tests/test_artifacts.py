@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Artifacts unit tests '''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import unittest
+import unittest.mock
+import zipfile
+
+import nimp.artifacts
+
+
+def _create_source_tree(root):
+    all_files = []
+    for index in range(20):
+        relative_path = 'dir%d/file%d.bin' % (index % 3, index)
+        source = os.path.join(root, 'source', relative_path)
+        os.makedirs(os.path.dirname(source), exist_ok = True)
+        with open(source, 'wb') as source_file:
+            source_file.write(os.urandom(index * 1000) + b'nimp' * index * 1000)
+        all_files.append((source, relative_path))
+    return all_files
+
+def _read_file(path):
+    with open(path, 'rb') as file_handle:
+        return file_handle.read()
+
+class _ArtifactTests(unittest.TestCase):
+
+    def test_create_directory_artifact(self):
+        ''' Directory artifacts should contain a copy of every mapped file '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            artifact_path = os.path.join(root, 'artifact')
+            nimp.artifacts.create_artifact(artifact_path, all_files, False, False, False, workers = 4)
+            for source, destination in all_files:
+                self.assertEqual(_read_file(source), _read_file(os.path.join(artifact_path, destination)))
+            self.assertFalse(os.path.exists(artifact_path + '.tmp'))
+
+    def test_create_archive_artifact(self):
+        ''' Archive artifacts should be valid zip files, compressed or not '''
+        for compress in [ False, True ]:
+            with tempfile.TemporaryDirectory() as root:
+                all_files = _create_source_tree(root)
+                artifact_path = os.path.join(root, 'artifact')
+                nimp.artifacts.create_artifact(artifact_path, all_files, True, compress, False, workers = 4)
+                with zipfile.ZipFile(artifact_path + '.zip') as archive_file:
+                    self.assertIsNone(archive_file.testzip())
+                    self.assertListEqual(archive_file.namelist(), [ destination for _, destination in all_files ])
+                    for source, destination in all_files:
+                        self.assertEqual(_read_file(source), archive_file.read(destination))
+
+    def test_create_archive_artifact_sequentially(self):
+        ''' Archives should still be created if zipfile internals change,
+            and their hash should match their content '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            artifact_path = os.path.join(root, 'artifact')
+            with unittest.mock.patch('nimp.artifacts._ZIPFILE_INTERNALS', [ '_missing_internal' ]):
+                file_hash = nimp.artifacts.create_artifact(artifact_path, all_files, True, True, False, hash_method = 'md5', workers = 4)
+            self.assertEqual(file_hash, hashlib.md5(_read_file(artifact_path + '.zip')).hexdigest())
+            with zipfile.ZipFile(artifact_path + '.zip') as archive_file:
+                self.assertIsNone(archive_file.testzip())
+                for source, destination in all_files:
+                    self.assertEqual(_read_file(source), archive_file.read(destination))
+
+    def test_duplicate_files(self):
+        ''' Files streamed more than once should only be added once to artifacts '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            all_destinations = [ destination for _, destination in all_files ]
+            all_repeated_files = all_files[:5] + all_files + all_files[::-1]
+            for archive, blob_store in [ (False, None), (True, None), (False, os.path.join(root, 'blobs')) ]:
+                artifact_path = os.path.join(root, 'artifact%d%d' % (archive, blob_store is not None))
+                file_hash = nimp.artifacts.create_artifact(artifact_path, iter(all_repeated_files), archive, True, False,
+                                                           workers = 4, blob_store = blob_store, hash_method = 'md5')
+                if archive:
+                    with zipfile.ZipFile(artifact_path + '.zip') as archive_file:
+                        self.assertListEqual(sorted(archive_file.namelist()), sorted(all_destinations))
+                elif blob_store is not None:
+                    manifest = nimp.artifacts.load_manifest(artifact_path + '.manifest')
+                    self.assertListEqual(sorted(entry['path'] for entry in manifest['files']), sorted(all_destinations))
+                else:
+                    self.assertEqual(file_hash, nimp.artifacts.create_hash(artifact_path, 'md5', True))
+
+    def test_artifact_hash(self):
+        ''' Hashes computed while writing artifacts should match hashes of the written artifacts '''
+        for archive in [ False, True ]:
+            with tempfile.TemporaryDirectory() as root:
+                all_files = _create_source_tree(root)
+                artifact_path = os.path.join(root, 'artifact')
+                file_hash = nimp.artifacts.create_artifact(artifact_path, all_files, archive, True, False, workers = 4, hash_method = 'blake2b')
+                self.assertIsNotNone(file_hash)
+                self.assertEqual(file_hash, nimp.artifacts.create_hash(artifact_path, 'blake2b', True))
+                with open(nimp.artifacts._find_artifact(artifact_path) + '.hash', encoding = 'utf-8') as hash_file:
+                    self.assertEqual(json.load(hash_file)['blake2b'], file_hash)
+        self.assertFalse(nimp.artifacts.is_hash_method_available('not_a_hash'))
+
+    def test_retry_artifact(self):
+        ''' Artifacts should only be moved in place once their hash is saved, so failed attempts can be retried '''
+        for archive in [ False, True ]:
+            with tempfile.TemporaryDirectory() as root:
+                all_files = _create_source_tree(root)
+                artifact_path = os.path.join(root, 'artifact')
+                with unittest.mock.patch('nimp.artifacts._save_hash', side_effect = OSError('Failed to save hash')):
+                    with self.assertRaises(OSError):
+                        nimp.artifacts.create_artifact(artifact_path, all_files, archive, True, False, hash_method = 'md5')
+                self.assertIsNone(nimp.artifacts._find_artifact(artifact_path))
+                file_hash = nimp.artifacts.create_artifact(artifact_path, all_files, archive, True, False, hash_method = 'md5')
+                with open(nimp.artifacts._find_artifact(artifact_path) + '.hash', encoding = 'utf-8') as hash_file:
+                    self.assertEqual(json.load(hash_file)['md5'], file_hash)
+
+    def test_torrent_pieces(self):
+        ''' Torrent pieces hashed per segment should match pieces of the concatenated files '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            all_data = b''.join(_read_file(source) for source, _ in all_files)
+            piece_length = 16 * 1024
+            expected_pieces = b''.join(hashlib.sha1(all_data[offset:offset + piece_length]).digest()
+                                       for offset in range(0, len(all_data), piece_length))
+            all_segments = [ (source, 0, os.path.getsize(source)) for source, _ in all_files ]
+            self.assertEqual(expected_pieces, nimp.artifacts._TorrentPieces(all_segments, piece_length).hash_all(4))
+
+            # Pieces hashed sequentially while writing an archive
+            torrent_hasher = nimp.artifacts._TorrentPieceHasher(piece_length)
+            for offset in range(0, len(all_data), 10000):
+                torrent_hasher.update(all_data[offset:offset + 10000])
+            self.assertEqual(expected_pieces, torrent_hasher.digest())
+
+    def test_torrent_files(self):
+        ''' Torrent files of directory artifacts should be split into path elements, whichever the separator '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)[:2]
+            all_files[1] = (all_files[1][0], 'nested\\dir1\\file1.bin')
+            artifact_path = os.path.join(root, 'repository', 'artifact')
+            with unittest.mock.patch('nimp.artifacts.BitTornado'), \
+                 unittest.mock.patch('nimp.artifacts._write_torrent') as write_torrent:
+                nimp.artifacts.create_artifact(artifact_path, all_files, False, False, False, torrent = True)
+            torrent_info = write_torrent.call_args[0][1]
+            self.assertListEqual([ file['path'] for file in torrent_info['files'] ], [ [ 'dir0', 'file0.bin' ], [ 'nested', 'dir1', 'file1.bin' ] ])
+
+    def test_stored_artifact(self):
+        ''' Stored artifacts should only add missing blobs and download back identically '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            blob_store = os.path.join(root, 'repository', 'blobs')
+            first_path = os.path.join(root, 'repository', 'binaries', 'first')
+            second_path = os.path.join(root, 'repository', 'binaries', 'second')
+            nimp.artifacts.create_artifact(first_path, all_files, False, False, False, blob_store = blob_store)
+            blob_count = sum(len(files) for _, _, files in os.walk(blob_store))
+
+            with open(all_files[0][0], 'wb') as source_file:
+                source_file.write(b'modified')
+            all_files.append((all_files[1][0], 'copy/file1.bin'))
+            nimp.artifacts.create_artifact(second_path, all_files, False, False, False, blob_store = blob_store)
+            self.assertEqual(sum(len(files) for _, _, files in os.walk(blob_store)), blob_count + 1)
+
+            workspace = os.path.join(root, 'workspace')
+            local_artifact_path = nimp.artifacts.download_artifact(workspace, second_path + '.manifest')
+            for source, destination in all_files:
+                self.assertEqual(_read_file(source), _read_file(os.path.join(local_artifact_path, destination)))
+            all_downloaded_files = [ file_name for _, _, all_file_names in os.walk(workspace) for file_name in all_file_names ]
+            self.assertEqual(len(all_downloaded_files), len(all_files))
+
+            # Nothing is downloaded when no file changed, but there is still an artifact to install
+            manifest = nimp.artifacts.load_manifest(second_path + '.manifest')
+            local_artifact_path = nimp.artifacts.download_artifact(workspace, second_path + '.manifest', manifest, manifest)
+            self.assertListEqual(os.listdir(local_artifact_path), [])
+            nimp.artifacts.install_artifact(local_artifact_path, os.path.join(root, 'install'))
+
+    def test_stored_artifact_other_drive(self):
+        ''' Stored artifacts should find blob stores which can't be made relative to them '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            blob_store = os.path.join(root, 'blobs')
+            artifact_path = os.path.join(root, 'repository', 'binaries')
+            with unittest.mock.patch('os.path.relpath', side_effect = ValueError('path is on mount \'C:\', start on mount \'D:\'')):
+                nimp.artifacts.create_artifact(artifact_path, all_files, False, False, False, blob_store = blob_store)
+            manifest = nimp.artifacts.load_manifest(artifact_path + '.manifest')
+            self.assertEqual(manifest['blob_store'], blob_store.replace('\\', '/'))
+
+            local_artifact_path = nimp.artifacts.download_artifact(os.path.join(root, 'workspace'), artifact_path + '.manifest')
+            for source, destination in all_files:
+                self.assertEqual(_read_file(source), _read_file(os.path.join(local_artifact_path, destination)))
+
+    def test_executable_files(self):
+        ''' Executable files should be detected from their first bytes and recorded in manifests '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            script_path = os.path.join(root, 'source', 'script.sh')
+            with open(script_path, 'w', encoding = 'utf-8') as script_file:
+                script_file.write('#!/bin/sh\necho nimp\n')
+            all_files.append((script_path, 'script.sh'))
+            self.assertTrue(nimp.artifacts.is_executable_file(script_path))
+            self.assertFalse(nimp.artifacts.is_executable_file(all_files[1][0]))
+            truncated_path = os.path.join(root, 'source', 'truncated.elf')
+            for header in [ b'\x7fELF', b'\x7fELF\x02' ]:
+                with open(truncated_path, 'wb') as truncated_file:
+                    truncated_file.write(header)
+                self.assertFalse(nimp.artifacts.is_executable_file(truncated_path))
+
+            artifact_path = os.path.join(root, 'repository', 'artifact')
+            nimp.artifacts.create_artifact(artifact_path, all_files, False, False, False, blob_store = os.path.join(root, 'repository', 'blobs'))
+            manifest = nimp.artifacts.load_manifest(artifact_path + '.manifest')
+            self.assertSetEqual(nimp.artifacts.get_executable_paths(manifest), { 'script.sh' })
+            del manifest['has_executable_flags']
+            self.assertIsNone(nimp.artifacts.get_executable_paths(manifest))
+
+    def test_diff_manifests(self):
+        ''' Manifest diffs should list new and modified entries, and removed paths '''
+        previous_manifest = { 'files': [
+            { 'path': 'same', 'size': 1, 'hash': 'a' },
+            { 'path': 'modified', 'size': 1, 'hash': 'b' },
+            { 'path': 'removed', 'size': 1, 'hash': 'c' },
+        ] }
+        manifest = { 'files': [
+            { 'path': 'same', 'size': 1, 'hash': 'a' },
+            { 'path': 'modified', 'size': 2, 'hash': 'd' },
+            { 'path': 'added', 'size': 1, 'hash': 'c' },
+        ] }
+        all_changed_entries, all_removed_paths = nimp.artifacts.diff_manifests(previous_manifest, manifest)
+        self.assertListEqual([ entry['path'] for entry in all_changed_entries ], [ 'modified', 'added' ])
+        self.assertListEqual(all_removed_paths, [ 'removed' ])
+
+    def test_fileset_manifest(self):
+        ''' Fileset manifests should round trip and only hash changed files again '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            manifest_path = os.path.join(root, 'manifest.jsonl')
+            manifest = nimp.artifacts.create_fileset_manifest(all_files, 'sha256', workers = 4)
+            nimp.artifacts.save_fileset_manifest(manifest_path, manifest)
+            previous_manifest = nimp.artifacts.load_fileset_manifest(manifest_path)
+            self.assertDictEqual(previous_manifest, manifest)
+            all_hashes = { entry['path']: entry['hash'] for entry in manifest['files'] }
+            self.assertEqual(all_hashes[all_files[1][1]], hashlib.sha256(_read_file(all_files[1][0])).hexdigest())
+
+            # Same content with a new modification time, new content, and a removed file
+            os.utime(all_files[2][0], ns = (0, 0))
+            with open(all_files[3][0], 'ab') as source_file:
+                source_file.write(b'nimp')
+            os.remove(all_files[4][0])
+            all_files = [ file for file in all_files if os.path.exists(file[0]) ] + [ (all_files[0][0], 'added.bin') ]
+            manifest = nimp.artifacts.create_fileset_manifest(all_files, 'sha256', previous_manifest)
+            all_added_paths, all_modified_paths, all_removed_paths = nimp.artifacts.diff_fileset_manifests(previous_manifest, manifest)
+            self.assertListEqual(all_added_paths, [ 'added.bin' ])
+            self.assertListEqual(all_modified_paths, [ all_files[3][1] ])
+            self.assertListEqual(all_removed_paths, [ 'dir1/file4.bin' ])
+
+            # Without hashes, files are compared by modification time
+            previous_manifest = nimp.artifacts.create_fileset_manifest(all_files)
+            os.utime(all_files[0][0], ns = (0, 0))
+            manifest = nimp.artifacts.create_fileset_manifest(all_files)
+            all_modified_paths = nimp.artifacts.diff_fileset_manifests(previous_manifest, manifest)[1]
+            self.assertListEqual(all_modified_paths, [ 'added.bin', all_files[0][1] ])
+
+    def test_install_archive(self):
+        ''' Archives should be installed in place, including archives of archives '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            nimp.artifacts.create_artifact(os.path.join(root, 'inner'), all_files, True, True, False)
+            package_files = [ (os.path.join(root, 'inner.zip'), 'inner.zip') ]
+            nimp.artifacts.create_artifact(os.path.join(root, 'package'), package_files, True, False, False)
+
+            for archive_path in [ 'inner.zip', 'package.zip' ]:
+                destination_directory = os.path.join(root, 'install', archive_path)
+                nimp.artifacts.install_archive(os.path.join(root, 'workspace'), os.path.join(root, archive_path), destination_directory)
+                for source, destination in all_files:
+                    self.assertEqual(_read_file(source), _read_file(os.path.join(destination_directory, destination)))
+
+    def test_install_archive_without_length(self):
+        ''' Archives served without their length should be downloaded before being installed '''
+        head_response = unittest.mock.Mock(headers = { 'Accept-Ranges': 'bytes' })
+        session = unittest.mock.Mock(head = unittest.mock.Mock(return_value = head_response))
+        with tempfile.TemporaryDirectory() as root:
+            local_artifact_path = os.path.join(root, 'workspace', '.nimp', 'downloads', 'artifact')
+            os.makedirs(local_artifact_path)
+            with unittest.mock.patch('nimp.artifacts._get_http_session', return_value = session), \
+                 unittest.mock.patch('nimp.artifacts.download_artifact', return_value = local_artifact_path) as download_artifact, \
+                 unittest.mock.patch('nimp.artifacts.install_artifact') as install_artifact:
+                nimp.artifacts.install_archive(os.path.join(root, 'workspace'), 'http://repository/artifact.zip', os.path.join(root, 'install'))
+            download_artifact.assert_called_once_with(os.path.join(root, 'workspace'), 'http://repository/artifact.zip')
+            install_artifact.assert_called_once_with(local_artifact_path, os.path.join(root, 'install'))
+
+    def test_catalog(self):
+        ''' Registered artifacts should be listed from the catalog, with their
+            timestamps, until the collection holds an artifact which was not
+            registered or the catalog is damaged '''
+        with tempfile.TemporaryDirectory() as root:
+            all_files = _create_source_tree(root)
+            os.makedirs(os.path.join(root, 'repository'))
+            # Uploaded before the catalog existed
+            nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_099'), all_files, False, False, False)
+            for revision in [ '100', '101' ]:
+                artifact_path = os.path.join(root, 'repository', 'binaries_' + revision)
+                nimp.artifacts.create_artifact(artifact_path, all_files, True, False, False)
+                nimp.artifacts.register_artifact(artifact_path, revision, 'a' + revision)
+
+            artifact_pattern = os.path.join(root, 'repository', 'binaries_{revision}')
+            all_requested_revisions = []
+            def _get_timestamps(_, all_revisions):
+                all_requested_revisions.extend(all_revisions)
+                return { revision: 'b' + revision for revision in all_revisions }
+            with unittest.mock.patch('nimp.utils.git.get_gitea_commit_timestamps', _get_timestamps):
+                all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, {}, { 'url': 'gitea' })
+            self.assertListEqual(all_requested_revisions, [ '099' ])
+            self.assertListEqual(sorted(artifact['sortable_revision'] for artifact in all_artifacts), [ 'a100', 'a101', 'b099' ])
+
+            # Collections without registered artifacts are listed
+            all_artifacts = nimp.artifacts.list_artifacts(os.path.join(root, 'repository', 'other_{revision}'), {}, None)
+            self.assertListEqual(all_artifacts, [])
+
+            nimp.artifacts.register_artifact(os.path.join(root, 'repository', 'binaries_099'), '099')
+            with unittest.mock.patch('nimp.artifacts._list_files') as list_files:
+                all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, {}, None)
+            list_files.assert_not_called()
+            self.assertListEqual(sorted(artifact['revision'] for artifact in all_artifacts), [ '099', '100', '101' ])
+            self.assertTrue(all(artifact['is_cataloged'] for artifact in all_artifacts))
+
+            # Not registered, found by listing the collection again
+            nimp.artifacts.create_artifact(os.path.join(root, 'repository', 'binaries_102'), all_files, False, False, False)
+            all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, {}, None)
+            self.assertListEqual(sorted(artifact['revision'] for artifact in all_artifacts), [ '099', '100', '101', '102' ])
+            all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, {}, None, use_catalog = False)
+            self.assertListEqual(sorted(artifact['revision'] for artifact in all_artifacts), [ '099', '100', '101', '102' ])
+
+            # Entries may be lost in lines torn by concurrent uploads
+            with open(os.path.join(root, 'repository', '.catalog.jsonl'), 'a', encoding = 'utf-8') as catalog_file:
+                catalog_file.write('{"name": "binar\n')
+            with self.assertLogs(level = logging.WARNING):
+                all_artifacts = nimp.artifacts.list_artifacts(artifact_pattern, {}, None)
+            self.assertListEqual(sorted(artifact['revision'] for artifact in all_artifacts), [ '099', '100', '101', '102' ])
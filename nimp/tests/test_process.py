@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Process utilities unit tests '''
+
+import io
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import nimp.sys.process
+
+class _ProcessTests(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger('child_processes')
+        self.all_messages = []
+        self.stream = io.StringIO()
+        self.all_handlers = [ logging.StreamHandler(self.stream), _MessageHandler(self.all_messages) ]
+        self.all_handlers[0].setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+        self.propagate, self.level = self.logger.propagate, self.logger.level
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        for handler in self.all_handlers:
+            self.logger.addHandler(handler)
+
+    def tearDown(self):
+        for handler in self.all_handlers:
+            self.logger.removeHandler(handler)
+        self.logger.propagate, self.logger.level = self.propagate, self.level
+
+    def test_call_output(self):
+        ''' Output should be split in lines and decoded as if read line by line '''
+        output = b'first\r\n\rsecond\n\xff\xfe\n\xc3\xa9\n\n' + b'x' * 100000 + b'\nlast'
+        command = [ sys.executable, '-c', 'import sys; sys.stdout.buffer.write(%r); sys.stderr.write("error\\n")' % output ]
+        exit_code, captured_output, captured_error = nimp.sys.process.call(command, capture_output = True)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(captured_output, 'first\r\n\rsecond\n��\né\n\n' + 'x' * 100000 + '\nlast')
+        self.assertEqual(captured_error, 'error\n')
+
+        all_output_messages = [ message for message in self.all_messages if message != 'error' ]
+        self.assertListEqual(all_output_messages, [ 'first', 'second', '��', 'é', '', 'x' * 100000, 'last' ])
+        self.assertIn('[INFO] error\n', self.stream.getvalue())
+        self.assertIn('[INFO] second\n[INFO] ��\n', self.stream.getvalue())
+
+    def test_call_all(self):
+        ''' Parallel processes should return their exit codes in order, and
+            their output should be tagged in streams only '''
+        all_commands = [ (tag, [ sys.executable, '-c', 'import sys; print("%s"); sys.exit(%d)' % (tag, exit_code) ])
+                         for tag, exit_code in [ ('first', 0), ('second', 3), ('third', 0) ] ]
+        self.assertListEqual(nimp.sys.process.call_all(all_commands, workers = 2), [ 0, 3, 0 ])
+        self.assertListEqual(sorted(self.all_messages), [ 'first', 'second', 'third' ])
+        for tag in [ 'first', 'second', 'third' ]:
+            self.assertIn('[INFO] [%s] %s\n' % (tag, tag), self.stream.getvalue())
+
+    def test_call_all_handlers(self):
+        ''' Output of parallel processes should be tagged in every stream
+            handler, including subclasses and handlers with filters '''
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            log_path = os.path.join(temporary_directory, 'output.log')
+            file_handler = logging.handlers.RotatingFileHandler(log_path, encoding = 'utf-8')
+            filtered_stream = io.StringIO()
+            filtered_handler = logging.StreamHandler(filtered_stream)
+            filtered_handler.addFilter(lambda record: 'hidden' not in record.getMessage())
+            self.all_handlers += [ file_handler, filtered_handler ]
+            for handler in [ file_handler, filtered_handler ]:
+                self.logger.addHandler(handler)
+
+            all_commands = [ (tag, [ sys.executable, '-c', 'print("%s"); print("hidden")' % tag ]) for tag in [ 'first', 'second' ] ]
+            nimp.sys.process.call_all(all_commands, workers = 2)
+            file_handler.close()
+            with open(log_path, encoding = 'utf-8') as log_file:
+                log_content = log_file.read()
+
+        for tag in [ 'first', 'second' ]:
+            self.assertIn('[%s] %s\n' % (tag, tag), log_content)
+            self.assertIn('[%s] %s\n' % (tag, tag), filtered_stream.getvalue())
+        self.assertNotIn('hidden', filtered_stream.getvalue())
+        self.assertIn('first', self.all_messages)
+
+    def test_job_pool_stop_on_failure(self):
+        ''' Jobs not started yet should be cancelled once a job failed '''
+        all_started_jobs = []
+        def _job(index):
+            all_started_jobs.append(index)
+            if index == 1:
+                raise RuntimeError('failed')
+            return index != 3
+
+        for action, all_expected_jobs in [ (_job, [ 0, 1 ]), (lambda index: _job(index + 2), [ 2, 3 ]) ]:
+            all_started_jobs.clear()
+            with nimp.sys.process.JobPool(1, stop_on_failure = True) as job_pool:
+                for index in range(4):
+                    job_pool.submit(str(index), action, index)
+                if 1 in all_expected_jobs:
+                    self.assertRaises(RuntimeError, job_pool.wait)
+                else:
+                    self.assertListEqual(job_pool.wait(), [ True, False, None, None ])
+            self.assertListEqual(all_started_jobs, all_expected_jobs)
+
+        with nimp.sys.process.JobPool(1) as job_pool:
+            for index in range(4):
+                job_pool.submit(str(index), lambda index: index != 1, index)
+            self.assertListEqual(job_pool.wait(), [ True, False, True, True ])
+
+    def test_call_input(self):
+        ''' Input should be fed to the process, and hidden output only captured '''
+        command = [ sys.executable, '-c', 'import sys; print(sys.stdin.read().upper())' ]
+        result = nimp.sys.process.call(command, stdin = 'nimp', capture_output = True, hide_output = True)
+        self.assertEqual(result, (0, 'NIMP\n', ''))
+        self.assertListEqual(self.all_messages, [])
+
+    def test_call_output_search(self):
+        ''' Output should be searchable without being captured, and captured
+            output should be kept in a file past its maximum size '''
+        command = [ sys.executable, '-c', 'for i in range(10000): print("line", i)' ]
+        output = nimp.sys.process.OutputSearch('line 9999', 'line 10000')
+        self.assertEqual(nimp.sys.process.call(command, hide_output = True, output_callback = output), 0)
+        self.assertIn('line 9999', output)
+        self.assertNotIn('line 10000', output)
+
+        with unittest.mock.patch('nimp.sys.process._CAPTURE_MAX_SIZE', 1000):
+            _, captured_output, _ = nimp.sys.process.call(command, capture_output = True, hide_output = True)
+        self.assertEqual(captured_output, ''.join('line %d\n' % i for i in range(10000)))
+
+    def test_call_trace(self):
+        ''' Processes called while tracing should be recorded with the
+            resources they used, and totalled by step '''
+        command = [ sys.executable, '-c', 'import sys; data = bytearray(64 * 2 ** 20); print("x" * 99); sys.exit(3)' ]
+        with tempfile.TemporaryDirectory() as temporary_directory:
+            trace_path = os.path.join(temporary_directory, 'trace.jsonl')
+            with nimp.sys.process.ProcessTrace(trace_path) as trace:
+                with nimp.sys.process.trace_step('test'):
+                    self.assertEqual(nimp.sys.process.call(command, hide_output = True), 3)
+                nimp.sys.process.call(command[:2] + [ 'pass' ], hide_output = True)
+            self.assertEqual(nimp.sys.process.call(command[:2] + [ 'pass' ], hide_output = True), 0)
+            with open(trace_path, encoding = 'utf-8') as trace_file:
+                all_entries = [ json.loads(line) for line in trace_file ]
+
+        self.assertEqual(len(all_entries), 2)
+        self.assertEqual(all_entries[0]['command'], command)
+        self.assertEqual(all_entries[0]['step'], 'test')
+        self.assertEqual(all_entries[0]['exit_code'], 3)
+        self.assertEqual(all_entries[0]['stdout_bytes'], len(os.linesep) + 99)
+        self.assertEqual(all_entries[1]['step'], None)
+        if hasattr(os, 'wait4') or sys.platform == 'win32':
+            self.assertGreater(all_entries[0]['max_rss'], 64 * 2 ** 20)
+            self.assertGreater(all_entries[0]['user_time'] + all_entries[0]['system_time'], 0)
+        self.assertListEqual(list(trace.all_step_totals.keys()), [ 'test', None ])
+        self.assertEqual(trace.all_step_totals['test']['processes'], 1)
+
+class _MessageHandler(logging.Handler):
+    def __init__(self, all_messages):
+        super().__init__()
+        self.all_messages = all_messages
+
+    def emit(self, record):
+        self.all_messages.append(record.getMessage())
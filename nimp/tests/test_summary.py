@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014-2019 Dontnod Entertainment
+
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+''' Summary handlers unit tests '''
+
+import logging
+import re
+import unittest
+
+import nimp.summary
+
+class _Environment():
+    summary = 'stdout'
+    verbose = False
+    summary_error_patterns = [ r'.*LogCook: Error: (?P<message>.*)', r'(?i)fatal failure' ]
+    summary_ignore_patterns = [ r'.*LogCook: Error: Ignored' ]
+    summary_context_patterns = [ r'.*Context', r'.*Context: (?P<message>.*)' ]
+
+class _SummaryTests(unittest.TestCase):
+
+    def test_required_literal(self):
+        ''' Only text every match contains should be searched for '''
+        for pattern, literal in [ (r'[\w ]+:\d+: undefined reference to .*', ': undefined reference to '),
+                                  (r'(fatal )?error|warning', None),
+                                  (r'Chunk [0-9]+ is invalid\.', ' is invalid.'),
+                                  (r'(?i)error', None),
+                                  (r'\[Error\]\t.*', '[Error]\t'),
+                                  (r'x{2,3}yz?', 'y'),
+                                  (r'[]|(]+ (a|b) cd', ' cd'),
+                                  (r'\x41BC', 'ABC'),
+                                  (r'\101BC', 'ABC'),
+                                  (r'\u00e9t\U000000e9', '\u00e9t\u00e9'),
+                                  (r'foo\N{SPACE}bar', 'foo bar'),
+                                  (r'\0x', '\0x'),
+                                  (r'(a+)\1bc', 'bc'),
+                                  (r'.*', None) ]:
+            self.assertEqual(nimp.summary._get_required_literal(re.compile(pattern)), literal)
+
+    def test_emit(self):
+        ''' Messages should be classified by the first matching pattern, with
+            context messages shortened by the first pattern with a message '''
+        handler = nimp.summary.DefaultSummaryHandler(_Environment())
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        for message in [ 'a Context: first', 'second', 'LogCook: Error: Ignored', 'LogCook: Error: broken',
+                         'src/main.cpp:12:3: warning: unused variable', 'FATAL FAILURE', 'LogCook: Display: nothing' ]:
+            handler.emit(logging.LogRecord('child_processes', logging.INFO, '', 0, message, None, None))
+
+        self.assertListEqual([ line for line in handler._summary['errors'] if not line.startswith('\n') ],
+                             [ '[  NOTIF  ] first\n', '[  NOTIF  ] second\n', '[  NOTIF  ] LogCook: Error: Ignored\n',
+                               '[  NOTIF  ] LogCook: Error: broken\n', '[ ERROR ] broken\n', '[ ERROR ] FATAL FAILURE\n' ])
+        self.assertListEqual([ line for line in handler._summary['warnings'] if not line.startswith('\n') ],
+                             [ '[ WARNING ] src/main.cpp:12:3: warning: unused variable\n' ])
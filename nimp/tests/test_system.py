@@ -22,10 +22,16 @@
 
 ''' System utilities unit tests '''
 
+import importlib
+import importlib.metadata
 import os
 import itertools
+import sys
+import tempfile
 import unittest
+import unittest.mock
 
+import nimp.tests.benchmark_file_mapper
 import nimp.tests.utils
 import nimp.system
 
@@ -84,6 +90,14 @@ class _FileSetTests(unittest.TestCase):
         src.glob('foo/bar/corge.ext1', 'foo/bar/corge.ext2').exclude_ignore_case('*rGE.ext2')
         self._check_files(files(), ('foo/bar/corge.ext1', 'foo/bar/corge.ext1'))
 
+    def test_exclude_patterns(self):
+        ''' Exclude should test each file against all patterns at once '''
+        files, src = _file_mapper(ext='ext1')
+        src.glob('**').exclude_ignore_case('*/BAR', '*/[B]AR/*.{ext}', '*.EXT3').exclude('*/foo', '*.EXT2')
+        self._check_files(files(), ('foo/bar/corge.ext2', 'foo/bar/corge.ext2'),
+                          ('foo/quux.ext1', 'foo/quux.ext1'),
+                          ('qux.ext1', 'qux.ext1'))
+
     def test_files(self):
         ''' Files mapper should discard directories '''
         files, src = _file_mapper()
@@ -108,12 +122,126 @@ class _FileSetTests(unittest.TestCase):
                           ('foo/quux.ext1', 'foo/quux.ext1'),
                           ('qux.ext1', 'qux.ext1'))
 
+    def test_glob_siblings(self):
+        ''' Sibling globs should each yield their files, in order '''
+        files, src = _file_mapper()
+        src.glob('**/*.ext1')
+        src.glob('foo/**', 'qux.ext1')
+        self._check_files(files(), ('foo/bar/corge.ext1', 'foo/bar/corge.ext1'),
+                          ('foo/quux.ext1', 'foo/quux.ext1'),
+                          ('qux.ext1', 'qux.ext1'),
+                          ('foo/bar', 'foo/bar'),
+                          ('foo/bar/corge.ext1', 'foo/bar/corge.ext1'),
+                          ('foo/bar/corge.ext2', 'foo/bar/corge.ext2'),
+                          ('foo/quux.ext1', 'foo/quux.ext1'),
+                          ('qux.ext1', 'qux.ext1'))
+
     def test_glob_src(self):
         ''' Glob src should be handled '''
         files, src = _file_mapper()
         src.src('fo*').glob('quux.ext1')
         self._check_files(files(), ('foo/quux.ext1', 'quux.ext1'))
 
+    def test_listing_cache(self):
+        ''' Cached directory listings should be used until the modification
+            time of their directory changes '''
+        with tempfile.TemporaryDirectory() as root_dir:
+            directory = os.path.join(root_dir, 'dir')
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'a.ext1'), 'w', encoding = 'utf-8'):
+                pass
+            os.utime(directory, ns = (10**18, 10**18))
+
+            files = nimp.system.FileMapper(None, { 'root_dir': root_dir, 'fileset_listing_cache': True })
+            files.src('{root_dir}/dir').to('.').glob('*').files()
+            self.assertListEqual([ dst for _, dst in files() ], [ 'a.ext1' ])
+            self.assertTrue(os.path.isfile(os.path.join(root_dir, '.nimp', 'cache', 'fileset_listings.json')))
+
+            # Restoring the modification time makes the cached listing stale
+            with open(os.path.join(directory, 'b.ext1'), 'w', encoding = 'utf-8'):
+                pass
+            os.utime(directory, ns = (10**18, 10**18))
+            self.assertListEqual([ dst for _, dst in files() ], [ 'a.ext1' ])
+
+            os.utime(directory, ns = (10**18, 10**18 + 1))
+            self.assertListEqual([ dst for _, dst in files() ], [ 'a.ext1', 'b.ext1' ])
+
+    def test_listing_ignore_case(self):
+        ''' Names listed with another case should still be found on file
+            systems ignoring case '''
+        with tempfile.TemporaryDirectory() as root_dir:
+            nimp.tests.utils.create_file(os.path.join(root_dir, 'dir', 'file.ext1'), '')
+            def _ignore_case(function):
+                return lambda path: function(root_dir + path[len(root_dir):].lower() if path.startswith(root_dir) else path)
+
+            with unittest.mock.patch('os.lstat', _ignore_case(os.lstat)), \
+                 unittest.mock.patch('os.path.lexists', _ignore_case(os.path.lexists)), \
+                 unittest.mock.patch('os.path.isfile', _ignore_case(os.path.isfile)):
+                for pattern in [ 'dir/File.ext1', 'd*/File.ext1' ]:
+                    files = nimp.system.FileMapper(None, { 'root_dir': root_dir })
+                    files.src('{root_dir}').to('.').glob(pattern).files()
+                    self.assertListEqual([ dst for _, dst in files() ], [ 'dir/File.ext1' ])
+
+    def test_load_set(self):
+        ''' Fileset modules of plugins should be found again only when a
+            plugin searched before them is modified '''
+        with tempfile.TemporaryDirectory() as root_dir:
+            fileset_content = 'def map(file_mapper):\n    file_mapper.src(__name__.split(".")[0])\n'
+            for path in [ 'test_plugin_a/__init__.py', 'test_plugin_b/__init__.py', 'test_plugin_b/filesets/__init__.py' ]:
+                nimp.tests.utils.create_file(os.path.join(root_dir, path), '')
+            nimp.tests.utils.create_file(os.path.join(root_dir, 'test_plugin_b/filesets/test_set.py'), fileset_content)
+            for directory in [ 'test_plugin_a', 'test_plugin_b', 'test_plugin_b/filesets' ]:
+                os.utime(os.path.join(root_dir, directory), ns = (10**18, 10**18))
+
+            all_entry_points = tuple(importlib.metadata.EntryPoint(name, name, 'nimp.plugins') for name in [ 'test_plugin_a', 'test_plugin_b' ])
+            all_imported_modules = []
+            def _import_module(name):
+                all_imported_modules.append(name)
+                return real_import_module(name)
+
+            def _load_set():
+                # Each load runs as a new process would, with nothing imported
+                for module_name in list(sys.modules):
+                    if module_name.startswith('test_plugin_'):
+                        del sys.modules[module_name]
+                all_imported_modules.clear()
+                with unittest.mock.patch.dict('nimp.system._all_fileset_module_names', clear = True), \
+                     unittest.mock.patch.dict('nimp.system._all_fileset_module_caches', clear = True):
+                    files = nimp.system.FileMapper(None, { 'root_dir': root_dir })
+                    files.load_set('test_set')
+                    return [ src for src, _ in files() ]
+
+            real_import_module = importlib.import_module
+            # Bytecode written next to plugins would modify their directories
+            with unittest.mock.patch.object(sys, 'path', [ root_dir ] + sys.path), \
+                 unittest.mock.patch.object(sys, 'dont_write_bytecode', True), \
+                 unittest.mock.patch('nimp.utils.python.get_plugin_entry_points', return_value = all_entry_points), \
+                 unittest.mock.patch('importlib.import_module', side_effect = _import_module):
+                self.assertListEqual(_load_set(), [ 'test_plugin_b' ])
+                self.assertIn('test_plugin_a.filesets.test_set', all_imported_modules)
+                self.assertListEqual(_load_set(), [ 'test_plugin_b' ])
+                self.assertNotIn('test_plugin_a.filesets.test_set', all_imported_modules)
+
+                nimp.tests.utils.create_file(os.path.join(root_dir, 'test_plugin_a/filesets/__init__.py'), '')
+                nimp.tests.utils.create_file(os.path.join(root_dir, 'test_plugin_a/filesets/test_set.py'), fileset_content)
+                importlib.invalidate_caches()
+                self.assertListEqual(_load_set(), [ 'test_plugin_a' ])
+
+    def test_newer(self):
+        ''' Newer should only keep files missing or older in the destination '''
+        with tempfile.TemporaryDirectory() as root_dir:
+            for name, source_time, destination_time in [ ('a', 2, 1), ('b', 1, 2), ('c', 1, None) ]:
+                nimp.tests.utils.create_file(os.path.join(root_dir, 'src', name), '')
+                os.utime(os.path.join(root_dir, 'src', name), (source_time, source_time))
+                if destination_time is not None:
+                    nimp.tests.utils.create_file(os.path.join(root_dir, 'dst', name), '')
+                    os.utime(os.path.join(root_dir, 'dst', name), (destination_time, destination_time))
+
+            for workers in [ None, 4 ]:
+                files = nimp.system.FileMapper(None, { 'root_dir': root_dir, 'fileset_metadata_workers': workers })
+                files.src('{root_dir}/src').to('{root_dir}/dst').glob('*').files().newer()
+                self.assertListEqual([ os.path.basename(src) for src, _ in files() ], [ 'a', 'c' ])
+
     def test_once(self):
         ''' Multiple calls to the same once mapper shouldn't append
             already processed files '''
@@ -122,6 +250,45 @@ class _FileSetTests(unittest.TestCase):
         files = itertools.chain(mapper(), mapper())
         self._check_files(files, ('qux.ext1', 'qux.ext1'))
 
+    def test_override(self):
+        ''' Overrides should only load arguments once for the same values,
+            and again when nested base values change '''
+        all_loaded_values = []
+        def _load_arguments(env):
+            env.derived = env.value + '_derived_' + '_'.join(env.all_suffixes)
+            all_loaded_values.append(env.value)
+            return True
+
+        with unittest.mock.patch('nimp.environment.Environment.argument_loaders', [ _load_arguments ]):
+            format_args = { 'value': 'base', 'all_suffixes': [ 'a' ], 'derived': 'base_derived_a' }
+            for _ in range(3):
+                src = nimp.system.FileMapper(None, format_args)
+                self.assertEqual(src.override(value = 'other').derived, 'other_derived_a')
+                self.assertEqual(src.override(value = 'base').derived, 'base_derived_a')
+            self.assertListEqual(all_loaded_values, [ 'other', 'base' ])
+
+            format_args['all_suffixes'].append('b')
+            self.assertEqual(src.override(value = 'other').derived, 'other_derived_a_b')
+            self.assertListEqual(all_loaded_values, [ 'other', 'base', 'other' ])
+
+    def test_profile(self):
+        ''' Profiling should count the files and file system calls of each
+            node, which are stable for the benchmark tree '''
+        with tempfile.TemporaryDirectory() as root_dir:
+            nimp.tests.benchmark_file_mapper.create_synthetic_tree(root_dir)
+            file_mapper, all_files, profile, _ = nimp.tests.benchmark_file_mapper.run_benchmark(root_dir, repeat = 1)
+            self.assertListEqual(all_files, list(file_mapper()))
+
+            all_node_statistics = { node.get_description().split(' at ')[0]: node_statistics
+                                    for _, node, node_statistics in profile.get_tree(file_mapper) }
+            content_statistics = all_node_statistics["glob('Content/**/*.uasset', 'Content/**/*.uexp', 'Content/**/*.ubulk')"]
+            # Each content directory should only be listed once
+            self.assertEqual(content_statistics.output_count, 3000)
+            self.assertEqual(content_statistics.file_system_call_count, 111)
+            self.assertEqual(all_node_statistics['newer'].file_system_call_count, 2 * 60)
+            self.assertListEqual([ pattern for pattern, _ in all_node_statistics["glob('Content/Missing/**')"].all_unmatched_patterns ],
+                                 [ 'Content/Missing/**' ])
+
     def test_recursive(self):
         ''' Recursive mapper should include all childrens of an added
             directory. '''
@@ -145,6 +312,14 @@ class _FileSetTests(unittest.TestCase):
         src.src('{dir}').glob('quux.ext1')
         self._check_files(files(), ('foo/quux.ext1', 'quux.ext1'))
 
+    def test_stream(self):
+        ''' Streaming should yield the same files, in walk order '''
+        files, src = _file_mapper()
+        src.glob('foo/**', '*.ext1').files()
+        src.glob('qux.ext1')
+        self.assertListEqual(sorted(files.stream()), sorted(files()))
+        self.assertListEqual(sorted(files.stream(unique = True)), sorted(set(files())))
+
     def test_src_dst(self):
         ''' src is used in every test, just testing format here. '''
         files, src = _file_mapper()
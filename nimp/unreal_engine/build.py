@@ -67,28 +67,31 @@ def build(env):
     # Bootstrap if necessary
     if hasattr(env, 'bootstrap') and env.bootstrap:
         # Now generate project files
-        if _unreal_generate_project(env) != 0:
-            logging.error("Error generating Unreal project files")
-            return False
+        with nimp.sys.process.trace_step('bootstrap'):
+            if _unreal_generate_project(env) != 0:
+                logging.error("Error generating Unreal project files")
+                return False
 
     if not hook_triggers_before_unreal_generate_project:
         nimp.environment.execute_hook('prebuild', env)
 
     # Build tools that all targets require
-    if not _unreal_build_common_tools(env, solution=solution, vs_version=vs_version):
-        return False
-
-    if env.target == 'tools':
-        if not _unreal_build_extra_tools(env, solution=solution, vs_version=vs_version):
+    with nimp.sys.process.trace_step('common tools'):
+        if not _unreal_build_common_tools(env, solution=solution, vs_version=vs_version):
             return False
 
-    if env.target == 'game':
-        if not _unreal_build_game(env, solution=solution, vs_version=vs_version):
-            return False
+    with nimp.sys.process.trace_step(env.target):
+        if env.target == 'tools':
+            if not _unreal_build_extra_tools(env, solution=solution, vs_version=vs_version):
+                return False
 
-    if env.target == 'editor':
-        if not _unreal_build_editor(env, solution=solution, vs_version=vs_version):
-            return False
+        if env.target == 'game':
+            if not _unreal_build_game(env, solution=solution, vs_version=vs_version):
+                return False
+
+        if env.target == 'editor':
+            if not _unreal_build_editor(env, solution=solution, vs_version=vs_version):
+                return False
 
     nimp.environment.execute_hook('postbuild', env)
 
@@ -205,11 +208,11 @@ def _unreal_generate_project(env):
     return nimp.build._try_excecute(command, cwd=env.unreal_dir)
 
 
-def _unreal_build_tool_ubt(env, tool, vs_version=None):
+def _unreal_build_tool_ubt(env, tool, vs_version=None, flags=None):
     platform = env.unreal_host_platform
     configuration = _unreal_select_tool_configuration(tool)
     if not _unreal_run_ubt(env, tool, platform, configuration,
-                           vs_version=vs_version):
+                           vs_version=vs_version, flags=flags):
         logging.error('Could not build %s', tool)
         return False
     return True
@@ -425,9 +428,15 @@ def _unreal_build_extra_tools(env, solution, vs_version):
         # extra_tools.append('PS4MapFileUtil') # removed in 4.22
         _unreal_build_ps4_tools_workaround(env, solution, vs_version)
 
-    # use UBT for remaining extra tool targets
-    for tool in extra_tools:
-        if not _unreal_build_tool_ubt(env, tool, vs_version):
+    # use UBT for remaining extra tool targets, which are independent
+    # programs; UBT only allows a single instance unless told otherwise,
+    # and tools not started yet are skipped once one of them failed
+    workers = env.tools_workers if hasattr(env, 'tools_workers') and env.tools_workers else 1
+    flags = [ '-NoMutex' ] if workers > 1 else None
+    with nimp.sys.process.JobPool(workers, stop_on_failure=True) as job_pool:
+        for tool in extra_tools:
+            job_pool.submit(tool, _unreal_build_tool_ubt, env, tool, vs_version, flags=flags)
+        if not all(job_pool.wait()):
             return False
 
     # Build DNEAssetRegistry
@@ -21,11 +21,14 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 ''' Git utilities '''
+import concurrent.futures
+import json
 import logging
+import os
+import tempfile
 import giteapy
 from giteapy.rest import ApiException
 from datetime import datetime, timezone
-import time
 
 import nimp.sys.process
 
@@ -108,16 +111,72 @@ def initialize_gitea_api_context(env):
     configuration.host = env.gitea_host
     configuration.api_key['access_token'] = env.gitea_access_token
     api_instance = giteapy.RepositoryApi(giteapy.ApiClient(configuration))
+    cache_file_name = f'{env.gitea_repo_owner}-{env.gitea_repo_name}.json'
     return {
         'instance': api_instance,
         'repo_owner': env.gitea_repo_owner,
-        'repo_name': env.gitea_repo_name
+        'repo_name': env.gitea_repo_name,
+        'timestamp_cache_path': os.path.join(env.root_dir, '.nimp', 'cache', 'gitea_commit_timestamps_v2', cache_file_name),
     }
 
 def get_gitea_commit_timestamp(gitea_context, commit_sha):
     if not commit_sha:
         return None
-
+    return get_gitea_commit_timestamps(gitea_context, [ commit_sha ])[commit_sha]
+
+_GITEA_REQUEST_WORKERS = 8
+
+def get_gitea_commit_timestamps(gitea_context, all_commit_shas):
+    ''' Returns a dictionary of commit timestamps. A commit timestamp never
+        changes, so they are cached on disk and only the missing ones are
+        requested, concurrently, from gitea. '''
+    all_timestamps = _load_gitea_timestamp_cache(gitea_context)
+    all_missing_shas = list({ sha for sha in all_commit_shas if sha and sha not in all_timestamps })
+    if all_missing_shas:
+        with concurrent.futures.ThreadPoolExecutor(max_workers = _GITEA_REQUEST_WORKERS) as executor:
+            all_results = executor.map(lambda sha: _request_gitea_commit_timestamp(gitea_context, sha), all_missing_shas)
+            for commit_sha, timestamp in zip(all_missing_shas, all_results):
+                # Unknown commits are not cached, they may be pushed later
+                if timestamp is not None:
+                    all_timestamps[commit_sha] = timestamp
+        _save_gitea_timestamp_cache(gitea_context)
+    return { sha: all_timestamps.get(sha) if sha else None for sha in all_commit_shas }
+
+def _load_gitea_timestamp_cache(gitea_context):
+    if 'timestamps' not in gitea_context:
+        gitea_context['timestamps'] = {}
+        cache_path = gitea_context.get('timestamp_cache_path')
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with open(cache_path, 'r', encoding = 'utf-8') as cache_file:
+                    gitea_context['timestamps'] = json.load(cache_file)
+            except ValueError as exception:
+                logging.warning('Ignoring invalid gitea cache %s: %s', cache_path, exception)
+    return gitea_context['timestamps']
+
+def _save_gitea_timestamp_cache(gitea_context):
+    cache_path = gitea_context.get('timestamp_cache_path')
+    if not cache_path:
+        return
+    temporary_path = None
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok = True)
+        # Each process writes its own file, as several nimp instances may
+        # save the cache of a workspace at once
+        with tempfile.NamedTemporaryFile('w', encoding = 'utf-8', dir = os.path.dirname(cache_path),
+                                         prefix = os.path.basename(cache_path) + '.', suffix = '.tmp', delete = False) as cache_file:
+            temporary_path = cache_file.name
+            json.dump(gitea_context['timestamps'], cache_file)
+        os.replace(temporary_path, cache_path)
+    except OSError as exception:
+        logging.warning('Failed to save gitea cache %s: %s', cache_path, exception)
+        if temporary_path is not None and os.path.exists(temporary_path):
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+
+def _request_gitea_commit_timestamp(gitea_context, commit_sha):
     api_commit_timestamp = None
     try:
         api_response = gitea_context['instance'].repo_get_single_commit(
@@ -126,8 +185,12 @@ def get_gitea_commit_timestamp(gitea_context, commit_sha):
             commit_sha
         )
         api_commit_date = api_response.commit.committer._date
-        api_commit_date = datetime.fromisoformat(api_commit_date).astimezone(timezone.utc)
-        api_commit_timestamp = str(round(time.mktime(api_commit_date.timetuple())))
+        api_commit_date = datetime.fromisoformat(api_commit_date)
+        if api_commit_date.tzinfo is None:
+            api_commit_date = api_commit_date.replace(tzinfo = timezone.utc)
+        # Timestamps are shared by catalogs and caches, so they must not
+        # depend on the timezone of the machine computing them
+        api_commit_timestamp = str(round(api_commit_date.timestamp()))
     except ApiException as e:
         reason = str(e.reason).lower() if hasattr(e, 'reason') else ''
         logging.debug(f'[GITEA API] {gitea_context["repo_owner"]}@{gitea_context["repo_name"]}@{commit_sha} {reason}')
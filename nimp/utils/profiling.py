@@ -23,8 +23,11 @@
 ''' Nimp profiling utilities '''
 
 import logging
+import os
 from contextlib import contextmanager
 
+import nimp.sys.process
+
 try:
     from nimp.plugins.dne.agrou import profiling
     IS_PROFILING_API_AVAILABLE = True
@@ -43,3 +46,33 @@ def nimp_profile(env):
             yield
     finally:
         pass
+
+
+@contextmanager
+def process_trace(env):
+    ''' Records the resources used by every child process if asked to, next
+        to the log file by default, and logs their totals by step '''
+    trace_path = env.process_trace_file if hasattr(env, 'process_trace_file') else None
+    if not trace_path and not (hasattr(env, 'process_trace') and env.process_trace):
+        yield
+        return
+
+    if not trace_path:
+        log_path = os.environ.get('NIMP_LOG_FILE')
+        trace_path = os.path.splitext(log_path)[0] + '.processes.jsonl' if log_path else 'nimp_processes.jsonl'
+
+    with nimp.sys.process.ProcessTrace(trace_path) as trace:
+        try:
+            yield
+        finally:
+            _log_process_trace(trace)
+
+
+def _log_process_trace(trace):
+    if not trace.all_step_totals:
+        return
+    logging.info('Process trace written to %s', trace.path)
+    logging.info('%-16s %9s %10s %10s %10s %10s', 'Step', 'Processes', 'Wall', 'CPU', 'Peak RSS', 'Output')
+    for step, totals in trace.all_step_totals.items():
+        logging.info('%-16s %9d %9.1fs %9.1fs %6.0f MiB %6.1f MiB', step or '-', totals['processes'], totals['wall_time'],
+                     totals['cpu_time'], totals['max_rss'] / 2 ** 20, totals['output_bytes'] / 2 ** 20)
@@ -1,6 +1,8 @@
 
 ''' Helper functions for module handling '''
 
+import functools
+import importlib.metadata
 import inspect
 import logging
 
@@ -32,3 +34,18 @@ def get_class_instances(module, instance_type, result, instance_args=[], instanc
                 result[attribute_value.__name__] = attribute_value(*instance_args, **instance_kwargs)
             except Exception as ex:
                 logging.warning('Error creating %s %s: %s', instance_type.__name__, attribute_value.__name__, ex)
+
+
+@functools.lru_cache(maxsize = None)
+def get_plugin_entry_points():
+    ''' Returns the entry points of nimp plugins. Installed distributions are
+        only scanned once per process, however many times plugins are used. '''
+    all_entry_points = importlib.metadata.entry_points()
+    if hasattr(all_entry_points, 'select'):
+        return tuple(all_entry_points.select(group = 'nimp.plugins'))
+    return tuple(all_entry_points.get('nimp.plugins', ()))
+
+
+def get_entry_point_module_name(entry_point):
+    ''' Returns the name of the module an entry point refers to '''
+    return entry_point.value.partition(':')[0].strip()
@@ -48,6 +48,9 @@ setup_info = dict(
         'nimp/utils',
     ],
 
+    # importlib.metadata is required to find plugins
+    python_requires = '>=3.8',
+
     install_requires = [
         'glob2',
         'packaging',
@@ -74,9 +77,11 @@ setup_info = dict(
         'Operating System :: POSIX',
         'Operating System :: Unix',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'Topic :: Software Development :: Build Tools',
     ],
 